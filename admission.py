@@ -0,0 +1,199 @@
+"""
+Контроль допуска к генерации: лимит на пользователя и общая очередь с приоритетами
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+import llm
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимит на пользователя: сколько генераций в минуту и размер «запаса»
+USER_RATE_PER_MINUTE = float(os.getenv('ADMISSION_USER_RATE', '6'))
+USER_BURST = float(os.getenv('ADMISSION_USER_BURST', '3'))
+# Сколько генераций выполняется одновременно и сколько может ждать в очереди
+MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', str(llm.MAX_CONCURRENCY)))
+MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '200'))
+# Дольше этого в очереди не держим - просим попробовать позже
+MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '60'))
+POSITION_UPDATE_INTERVAL = 3.0
+
+# Приоритеты (меньше - раньше). Ответы из кэша в очередь не попадают вовсе.
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+
+
+class Rejected(Exception):
+    """Запрос не допущен к генерации"""
+
+    user_message = "🌙 Магические силы сейчас перегружены. Попробуй чуть позже."
+
+
+class RateLimited(Rejected):
+    """Пользователь исчерпал свой лимит"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+        self.user_message = (
+            f"⏳ Карты устали от частых вопросов. "
+            f"Попробуй снова через {max(1, round(retry_after))} сек."
+        )
+
+
+class Overloaded(Rejected):
+    """Очередь переполнена или ожидание слишком долгое"""
+
+
+class TokenBucket:
+    """Классическое «ведро с токенами»"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount: float = 1.0) -> float:
+        """Списывает токены; возвращает 0 при успехе или сколько секунд ждать"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Через сколько секунд можно будет списать amount (без списания)"""
+        self._refill(time.monotonic())
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class UserBuckets:
+    """Ведра по пользователям с вытеснением давно неактивных"""
+
+    def __init__(self, rate: float, capacity: float, max_users: int = 100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_users = max_users
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def consume(self, user_id: int) -> float:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket.consume()
+
+    def wait_time(self, user_id: int) -> float:
+        """Через сколько секунд пользователь сможет поставить генерацию (без списания)"""
+        bucket = self._buckets.get(user_id)
+        return bucket.wait_time() if bucket is not None else 0.0
+
+
+class PriorityGate:
+    """Ограниченное число одновременных генераций и очередь ожидающих с приоритетами"""
+
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self._heap = []
+        self._seq = itertools.count()
+
+    def position(self, entry) -> int:
+        """Сколько ожидающих стоит впереди (начиная с 1)"""
+        return 1 + sum(1 for other in self._heap if other < entry and not other[2].done())
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE,
+                      on_queued: Optional[Callable[[int], Awaitable]] = None,
+                      max_wait: float = MAX_WAIT):
+        if self.active < self.capacity and self.waiting == 0:
+            self.active += 1
+            return
+        if self.waiting >= self.max_queue:
+            raise Overloaded("queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._heap, entry)
+        self.waiting += 1
+        deadline = time.monotonic() + max_wait
+        shown = None
+
+        try:
+            while True:
+                position = self.position(entry)
+                if on_queued is not None and position != shown:
+                    shown = position
+                    await on_queued(position)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Overloaded("waited too long")
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(future), min(POSITION_UPDATE_INTERVAL, remaining)
+                    )
+                    return
+                except asyncio.TimeoutError:
+                    continue
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Слот уже был передан нам - возвращаем его следующему
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        """Освобождает слот: передаёт его первому живому ожидающему"""
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+@asynccontextmanager
+async def slot(priority: int = PRIORITY_INTERACTIVE, max_wait: float = MAX_WAIT):
+    """Слот генерации с заданным приоритетом"""
+    await gate.acquire(priority, max_wait=max_wait)
+    try:
+        yield
+    finally:
+        gate.release()
+
+
+def background_slot(max_wait: float = 3600.0):
+    """Слот для фоновой генерации: пропускает пользователей вперёд"""
+    return slot(PRIORITY_BACKGROUND, max_wait)
+
+
+user_buckets = UserBuckets(USER_RATE_PER_MINUTE / 60.0, USER_BURST)
+gate = PriorityGate(MAX_ACTIVE, MAX_QUEUE)
+
+metrics.Gauge("admission_queue_depth", "Генерации, ждущие в очереди", func=lambda: gate.waiting)
+metrics.Gauge("admission_active", "Генерации, выполняющиеся сейчас", func=lambda: gate.active)
+rejected_total = metrics.Counter("admission_rejected_total", "Отклонённые генерации", ["reason"])
+
@@ -4,6 +4,10 @@
 """
 import os
 import logging
+import argparse
+from datetime import date
+from typing import Optional, Tuple
+import startup  # первым: от него отсчитывается время запуска
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -11,16 +15,31 @@ from telegram.ext import (
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
 from dotenv import load_dotenv
-from openai import OpenAI
 import tarot
-import base64
-from datetime import datetime
-from PIL import Image
-import io
+import llm
+import horoscope
+import corpus
+import server
+import supervisor
+import persistence
+import metrics
+from persistence import SharedConversationHandler
+from horoscope import ZODIAC_SIGNS
+import palm
+import generation
+import outbound
+import subscriptions
+import questions
+import prompts
+import degraded
+import routes
+import admission
+import tracing
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -31,77 +50,100 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+startup.mark("импорт")
 
-# Инициализация DeepSeek API
-deepseek_client = OpenAI(
-    api_key=os.getenv('DEEPSEEK_API_KEY'),
-    base_url="https://api.deepseek.com"
-)
+# Сколько апдейтов обрабатывать одновременно
+CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '256'))
+
+# Адрес Bot API (свой сервер Bot API или заглушка для нагрузочного теста)
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL')
+
+# Группа обработчиков, которая выполняется после всех остальных
+LAST_GROUP = 100
 
 # Состояния для ConversationHandler
 WAITING_QUESTION, WAITING_ZODIAC, WAITING_BIRTHDATE, WAITING_PALM_PHOTO = range(4)
 
 
-def get_main_menu():
-    """Создает главное меню бота"""
-    keyboard = [
-        [InlineKeyboardButton("🔮 Таро", callback_data="tarot")],
-        [InlineKeyboardButton("✋ Хиромантия", callback_data="palmistry")],
-        [InlineKeyboardButton("⭐ Астрология", callback_data="astrology")],
-        [InlineKeyboardButton("🎱 Предсказание", callback_data="prediction")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
-def get_tarot_menu():
-    """Меню раскладов Таро"""
-    keyboard = [
-        [InlineKeyboardButton("Карта дня", callback_data="tarot_day")],
-        [InlineKeyboardButton("Три карты (прошлое-настоящее-будущее)", callback_data="tarot_three")],
-        [InlineKeyboardButton("Расклад на любовь", callback_data="tarot_love")],
-        [InlineKeyboardButton("Ответ Да/Нет", callback_data="tarot_yesno")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
-def get_astrology_menu():
-    """Меню астрологии"""
-    keyboard = [
-        [InlineKeyboardButton("Гороскоп на сегодня", callback_data="horoscope_today")],
-        [InlineKeyboardButton("Гороскоп на неделю", callback_data="horoscope_week")],
-        [InlineKeyboardButton("Натальная карта", callback_data="natal_chart")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
-async def ask_deepseek(prompt: str, system_prompt: str = None) -> str:
-    """
-    Отправляет запрос к DeepSeek API
-    """
-    try:
-        messages = []
-
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-
-        messages.append({"role": "user", "content": prompt})
-
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=messages,
-            temperature=0.9,
-            max_tokens=1500
-        )
+# ============= КЛАВИАТУРЫ =============
+# Клавиатуры не меняются - собираем их один раз
+
+MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔮 Таро", callback_data="tarot")],
+    [InlineKeyboardButton("✋ Хиромантия", callback_data="palmistry")],
+    [InlineKeyboardButton("⭐ Астрология", callback_data="astrology")],
+    [InlineKeyboardButton("🎱 Предсказание", callback_data="prediction")],
+    [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
+])
+
+TAROT_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Карта дня", callback_data="tarot_day")],
+    [InlineKeyboardButton("Три карты (прошлое-настоящее-будущее)", callback_data="tarot_three")],
+    [InlineKeyboardButton("Расклад на любовь", callback_data="tarot_love")],
+    [InlineKeyboardButton("Ответ Да/Нет", callback_data="tarot_yesno")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]
+])
+
+ASTROLOGY_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Гороскоп на сегодня", callback_data="horoscope_today")],
+    [InlineKeyboardButton("Гороскоп на неделю", callback_data="horoscope_week")],
+    [InlineKeyboardButton("Натальная карта", callback_data="natal_chart")],
+    [InlineKeyboardButton("🔔 Гороскоп каждый день", callback_data="subscribe")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]
+])
+
+BACK_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]])
+
+TAROT_RESULT_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔮 Ещё расклад", callback_data="tarot")],
+    [InlineKeyboardButton("⬅️ Главное меню", callback_data="back_main")]
+])
+
+TAROT_YESNO_RESULT_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔮 Ещё вопрос", callback_data="tarot")],
+    [InlineKeyboardButton("⬅️ Главное меню", callback_data="back_main")]
+])
+
+HOROSCOPE_WEEK_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⬅️ Назад", callback_data="astrology")],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
+])
+
+# Главное меню с предложением получать гороскоп знака каждый день
+ZODIAC_RESULT_MENUS = {
+    sign: InlineKeyboardMarkup(
+        [[InlineKeyboardButton("🔔 Присылать каждый день", callback_data=f"sub:{sign}")]]
+        + list(MAIN_MENU.inline_keyboard)
+    )
+    for sign in ZODIAC_SIGNS
+}
+
+HELP_TEXT = (
+    "ℹ️ Помощь\n\n"
+    "Команды бота:\n"
+    "/start - Главное меню\n"
+    "/help - Эта справка\n\n"
+    "Возможности:\n"
+    "• Таро - различные расклады карт\n"
+    "• Хиромантия - анализ линий на ладони\n"
+    "• Астрология - гороскопы и натальные карты\n"
+    "• Предсказания - ответы на твои вопросы\n\n"
+    "Все предсказания генерируются с помощью AI."
+)
 
-        return response.choices[0].message.content
-    except Exception as e:
-        logger.error(f"Ошибка при обращении к DeepSeek API: {e}")
-        return "Извините, произошла ошибка при обращении к магическим силам. Попробуйте позже."
+PALMISTRY_TEXT = (
+    "✋ Хиромантия\n\n"
+    "Отправь мне фото своей ладони (желательно правой руки) "
+    "с хорошим освещением. Или опиши основные линии:\n\n"
+    "• Линия жизни (дуга от большого пальца)\n"
+    "• Линия сердца (горизонтальная линия вверху)\n"
+    "• Линия ума (горизонтальная линия в центре)\n"
+    "• Линия судьбы (вертикальная линия)\n\n"
+    "Какие из них длинные, короткие, прерывистые?"
+)
 
 
+@metrics.timed("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
@@ -116,251 +158,138 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Выбери, что тебя интересует:"
     )
 
-    await update.message.reply_text(welcome_text, reply_markup=get_main_menu())
-
-
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
-    query = update.callback_query
-    await query.answer()
-
-    if query.data == "back_main":
-        await query.edit_message_text(
-            "🔮 Главное меню. Выбери интересующую тебя область:",
-            reply_markup=get_main_menu()
-        )
-        return ConversationHandler.END
-
-    elif query.data == "tarot":
-        await query.edit_message_text(
-            "🃏 Выбери расклад Таро:",
-            reply_markup=get_tarot_menu()
-        )
-
-    elif query.data == "astrology":
-        await query.edit_message_text(
-            "⭐ Выбери тип астрологического прогноза:",
-            reply_markup=get_astrology_menu()
-        )
-
-    elif query.data == "palmistry":
-        await query.edit_message_text(
-            "✋ Хиромантия\n\n"
-            "Отправь мне фото своей ладони (желательно правой руки) "
-            "с хорошим освещением. Или опиши основные линии:\n\n"
-            "• Линия жизни (дуга от большого пальца)\n"
-            "• Линия сердца (горизонтальная линия вверху)\n"
-            "• Линия ума (горизонтальная линия в центре)\n"
-            "• Линия судьбы (вертикальная линия)\n\n"
-            "Какие из них длинные, короткие, прерывистые?"
-        )
-        return WAITING_PALM_PHOTO
-
-    elif query.data == "prediction":
-        await query.edit_message_text(
-            "🎱 Задай мне свой вопрос, и я загляну в будущее...\n\n"
-            "Напиши свой вопрос одним сообщением."
-        )
-        return WAITING_QUESTION
-
-    elif query.data == "help":
-        help_text = (
-            "ℹ️ Помощь\n\n"
-            "Команды бота:\n"
-            "/start - Главное меню\n"
-            "/help - Эта справка\n\n"
-            "Возможности:\n"
-            "• Таро - различные расклады карт\n"
-            "• Хиромантия - анализ линий на ладони\n"
-            "• Астрология - гороскопы и натальные карты\n"
-            "• Предсказания - ответы на твои вопросы\n\n"
-            "Все предсказания генерируются с помощью AI."
-        )
-        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]]
-        await query.edit_message_text(help_text, reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Обработчики Таро
-    elif query.data == "tarot_day":
-        await handle_tarot_day(query)
-    elif query.data == "tarot_three":
-        await handle_tarot_three(query)
-    elif query.data == "tarot_love":
-        await handle_tarot_love(query)
-    elif query.data == "tarot_yesno":
-        await handle_tarot_yesno(query)
-
-    # Обработчики астрологии
-    elif query.data == "horoscope_today":
-        await query.edit_message_text("⭐ Введите ваш знак зодиака:")
-        return WAITING_ZODIAC
-    elif query.data == "horoscope_week":
-        await handle_horoscope_week(query, context)
-    elif query.data == "natal_chart":
-        await query.edit_message_text(
-            "🌟 Для натальной карты введите дату рождения в формате ДД.ММ.ГГГГ\n"
-            "Например: 15.03.1990"
-        )
-        return WAITING_BIRTHDATE
+    await update.message.reply_text(welcome_text, reply_markup=MAIN_MENU)
 
 
 # ============= ОБРАБОТЧИКИ ТАРО =============
 
-async def handle_tarot_day(query):
-    """Карта дня"""
-    await query.edit_message_text("🔮 Вытягиваю карту дня...")
-
-    card = tarot.draw_cards(1)[0]
-
-    system_prompt = (
-        "Ты опытный таролог с глубокими знаниями карт Таро. "
-        "Дай подробное толкование карты дня. Объясни, что эта карта означает "
-        "для человека на сегодняшний день. Пиши мистически и загадочно, но содержательно. "
-        "ВАЖНО: Отвечай ТОЛЬКО на русском языке с АБСОЛЮТНО ГРАМОТНОЙ орфографией и пунктуацией. "
-        "Проверяй каждое слово на правильность написания. Используй литературный русский язык."
+async def reply_tarot(query, spread: str, cards, placeholder: str, header: str,
+                      request: Tuple[str, str], reply_markup: InlineKeyboardMarkup,
+                      on_done: Optional[Tuple[str, dict]] = None):
+    """Толкование расклада: из корпуса без API или потоком от DeepSeek"""
+    reading = corpus.serve(spread, cards)
+    if reading:
+        generation.run_hook(on_done, reading)
+        await query.edit_message_text(header + reading, reply_markup=reply_markup, parse_mode='Markdown')
+        return
+
+    await query.edit_message_text(placeholder)
+
+    await generation.submit(
+        query.from_user.id,
+        query.message,
+        *request,
+        header=header,
+        reply_markup=reply_markup,
+        parse_mode='Markdown',
+        fallback=corpus.fallback(spread, cards),
+        fallback_timeout=corpus.FALLBACK_TIMEOUT,
+        on_done=on_done,
+        # Прошлое толкование имеет смысл только для той же самой карты
+        stale_key=f"{spread}:{cards[0].index}:{int(cards[0].reversed)}" if len(cards) == 1 else None,
+        local=degraded.local_tarot(corpus.SPREADS[spread][1], cards)
     )
 
-    interpretation = await ask_deepseek(
-        f"Выпала карта: {card}. Дай толкование этой карты как карты дня.",
-        system_prompt
-    )
-
-    response = f"🃏 Карта дня: *{card}*\n\n{interpretation}"
 
-    keyboard = [[InlineKeyboardButton("🔮 Ещё расклад", callback_data="tarot")],
-                [InlineKeyboardButton("⬅️ Главное меню", callback_data="back_main")]]
-
-    await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard),
-                                   parse_mode='Markdown')
+async def handle_tarot_day(query, context):
+    """Карта дня: одна и та же для пользователя до конца дня"""
+    day = horoscope.today()
+    card = tarot.daily_card(query.from_user.id, day)
+    header = f"🃏 Карта дня: *{card}*\n\n"
+
+    cached = horoscope.get_store().get_card_of_day(card.index, card.reversed, day)
+    if cached:
+        await query.edit_message_text(header + cached, reply_markup=TAROT_RESULT_MENU, parse_mode='Markdown')
+        return
+
+    await reply_tarot(
+        query, "tarot_day", [card],
+        placeholder="🔮 Вытягиваю карту дня...",
+        header=header,
+        request=prompts.TAROT_DAY.render(card=card),
+        reply_markup=TAROT_RESULT_MENU,
+        on_done=("tarot_day", {"index": card.index, "reversed": card.reversed, "day": day.isoformat()})
+    )
 
 
-async def handle_tarot_three(query):
+async def handle_tarot_three(query, context):
     """Расклад на три карты"""
-    await query.edit_message_text("🔮 Делаю расклад на три карты...")
+    cards = tarot.draw(3)
 
-    cards = tarot.draw_cards(3)
-
-    system_prompt = (
-        "Ты опытный таролог. Сделай расклад на три карты: "
-        "прошлое, настоящее и будущее. Дай глубокое толкование каждой карты "
-        "и общую картину. Пиши мистически, но содержательно. "
-        "ВАЖНО: Отвечай ТОЛЬКО на русском языке с АБСОЛЮТНО ГРАМОТНОЙ орфографией и пунктуацией. "
-        "Проверяй каждое слово на правильность написания. Используй литературный русский язык."
-    )
-
-    interpretation = await ask_deepseek(
-        f"Выпали карты:\nПрошлое: {cards[0]}\nНастоящее: {cards[1]}\nБудущее: {cards[2]}\n\n"
-        f"Дай подробное толкование этого расклада.",
-        system_prompt
-    )
-
-    response = (
+    header = (
         f"🃏 Расклад «Прошлое-Настоящее-Будущее»\n\n"
         f"📜 Прошлое: *{cards[0]}*\n"
         f"⏳ Настоящее: *{cards[1]}*\n"
         f"🔮 Будущее: *{cards[2]}*\n\n"
-        f"{interpretation}"
     )
 
-    keyboard = [[InlineKeyboardButton("🔮 Ещё расклад", callback_data="tarot")],
-                [InlineKeyboardButton("⬅️ Главное меню", callback_data="back_main")]]
-
-    await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard),
-                                   parse_mode='Markdown')
+    await reply_tarot(
+        query, "tarot_three", cards,
+        placeholder="🔮 Делаю расклад на три карты...",
+        header=header,
+        request=prompts.TAROT_THREE.render(past=cards[0], present=cards[1], future=cards[2]),
+        reply_markup=TAROT_RESULT_MENU
+    )
 
 
-async def handle_tarot_love(query):
+async def handle_tarot_love(query, context):
     """Расклад на любовь"""
-    await query.edit_message_text("💕 Делаю расклад на любовь...")
-
-    cards = tarot.draw_cards(3)
+    cards = tarot.draw(3)
 
-    system_prompt = (
-        "Ты опытный таролог, специализирующийся на любовных раскладах. "
-        "Сделай расклад на любовь из трех карт: 1) Ты, 2) Партнер, 3) Отношения. "
-        "Дай глубокое толкование. Пиши романтично и мистически. "
-        "ВАЖНО: Отвечай ТОЛЬКО на русском языке с АБСОЛЮТНО ГРАМОТНОЙ орфографией и пунктуацией. "
-        "Проверяй каждое слово на правильность написания. Используй литературный русский язык."
-    )
-
-    interpretation = await ask_deepseek(
-        f"Любовный расклад:\nТы: {cards[0]}\nПартнер: {cards[1]}\nОтношения: {cards[2]}\n\n"
-        f"Дай подробное толкование.",
-        system_prompt
-    )
-
-    response = (
+    header = (
         f"💕 Любовный расклад\n\n"
         f"👤 Ты: *{cards[0]}*\n"
         f"💑 Партнер: *{cards[1]}*\n"
         f"❤️ Отношения: *{cards[2]}*\n\n"
-        f"{interpretation}"
     )
 
-    keyboard = [[InlineKeyboardButton("🔮 Ещё расклад", callback_data="tarot")],
-                [InlineKeyboardButton("⬅️ Главное меню", callback_data="back_main")]]
-
-    await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard),
-                                   parse_mode='Markdown')
+    await reply_tarot(
+        query, "tarot_love", cards,
+        placeholder="💕 Делаю расклад на любовь...",
+        header=header,
+        request=prompts.TAROT_LOVE.render(you=cards[0], partner=cards[1], relationship=cards[2]),
+        reply_markup=TAROT_RESULT_MENU
+    )
 
 
-async def handle_tarot_yesno(query):
+async def handle_tarot_yesno(query, context):
     """Ответ Да/Нет"""
-    await query.edit_message_text("🎱 Спрашиваю карты...")
-
-    card = tarot.draw_cards(1)[0]
-
-    system_prompt = (
-        "Ты таролог. Дай ответ Да или Нет на основе выпавшей карты. "
-        "Объясни почему карта говорит именно так. Будь загадочным. "
-        "ВАЖНО: Отвечай ТОЛЬКО на русском языке с АБСОЛЮТНО ГРАМОТНОЙ орфографией и пунктуацией. "
-        "Проверяй каждое слово на правильность написания. Используй литературный русский язык."
+    card = tarot.draw(1)[0]
+
+    await reply_tarot(
+        query, "tarot_yesno", [card],
+        placeholder="🎱 Спрашиваю карты...",
+        header=f"🎱 Карта: *{card}*\n\n",
+        request=prompts.TAROT_YESNO.render(card=card),
+        reply_markup=TAROT_YESNO_RESULT_MENU
     )
 
-    interpretation = await ask_deepseek(
-        f"Выпала карта: {card}. Это Да или Нет? Объясни.",
-        system_prompt
-    )
-
-    response = f"🎱 Карта: *{card}*\n\n{interpretation}"
-
-    keyboard = [[InlineKeyboardButton("🔮 Ещё вопрос", callback_data="tarot")],
-                [InlineKeyboardButton("⬅️ Главное меню", callback_data="back_main")]]
-
-    await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard),
-                                   parse_mode='Markdown')
-
 
 # ============= ОБРАБОТЧИКИ АСТРОЛОГИИ =============
 
-ZODIAC_SIGNS = [
-    "Овен", "Телец", "Близнецы", "Рак", "Лев", "Дева",
-    "Весы", "Скорпион", "Стрелец", "Козерог", "Водолей", "Рыбы"
-]
-
-
 async def handle_horoscope_week(query, context):
     """Недельный гороскоп для всех знаков"""
-    await query.edit_message_text("⭐ Составляю недельный гороскоп...")
+    cached = horoscope.get_store().get_weekly()
+    if cached:
+        await query.edit_message_text(f"⭐ Гороскоп на неделю\n\n{cached}", reply_markup=HOROSCOPE_WEEK_MENU)
+        return
 
-    system_prompt = (
-        "Ты профессиональный астролог. Составь краткий общий гороскоп на неделю. "
-        "Упомяни ключевые астрологические события недели. "
-        "Пиши загадочно и мистически. Ответ на русском языке."
-    )
+    await query.edit_message_text("⭐ Составляю недельный гороскоп...")
 
-    horoscope = await ask_deepseek(
-        f"Составь общий гороскоп на неделю. Сегодня {datetime.now().strftime('%d.%m.%Y')}",
-        system_prompt
+    day = horoscope.today()
+    await generation.submit(
+        query.from_user.id,
+        query.message,
+        *horoscope.weekly_prompt(day),
+        header="⭐ Гороскоп на неделю\n\n",
+        reply_markup=HOROSCOPE_WEEK_MENU,
+        on_done=("horoscope_weekly", {"day": day.isoformat()}),
+        stale_key=horoscope.stale_key(),
+        local=degraded.local_horoscope("неделя", horoscope.week_start(day))
     )
 
-    response = f"⭐ Гороскоп на неделю\n\n{horoscope}"
-
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="astrology")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]]
-
-    await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-
 
+@metrics.timed("zodiac_sign")
 async def handle_zodiac_horoscope(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Гороскоп по знаку зодиака"""
     zodiac = update.message.text.strip().capitalize()
@@ -372,119 +301,209 @@ async def handle_zodiac_horoscope(update: Update, context: ContextTypes.DEFAULT_
         )
         return WAITING_ZODIAC
 
-    await update.message.reply_text(f"⭐ Составляю гороскоп для {zodiac}...")
+    cached = horoscope.get_store().get_daily(zodiac)
+    if cached:
+        await update.message.reply_text(f"⭐ Гороскоп для {zodiac}\n\n{cached}",
+                                        reply_markup=ZODIAC_RESULT_MENUS[zodiac])
+        return ConversationHandler.END
 
-    system_prompt = (
-        "Ты профессиональный астролог. Составь подробный гороскоп на сегодня "
-        "для указанного знака зодиака. Пиши загадочно и мистически. "
-        "Ответ на русском языке."
+    placeholder = await update.message.reply_text(f"⭐ Составляю гороскоп для {zodiac}...")
+
+    day = horoscope.today()
+    await generation.submit(
+        update.effective_user.id,
+        placeholder,
+        *horoscope.daily_prompt(zodiac, day),
+        header=f"⭐ Гороскоп для {zodiac}\n\n",
+        reply_markup=ZODIAC_RESULT_MENUS[zodiac],
+        on_done=("horoscope_daily", {"sign": zodiac, "day": day.isoformat()}),
+        stale_key=horoscope.stale_key(zodiac),
+        local=degraded.local_horoscope(zodiac, day)
     )
+    return ConversationHandler.END
+
 
-    horoscope = await ask_deepseek(
-        f"Составь гороскоп на сегодня для знака {zodiac}. "
-        f"Сегодня {datetime.now().strftime('%d.%m.%Y')}",
-        system_prompt
+async def handle_subscribe_menu(query, context):
+    """Выбор знака для ежедневной рассылки"""
+    current = subscriptions.get_store().get_sign(query.message.chat_id)
+    text = (
+        f"🔔 Ты подписан на гороскоп для знака {current}.\nВыбери другой знак или отпишись:"
+        if current else
+        f"🔔 Выбери свой знак - гороскоп будет приходить каждый день "
+        f"в {subscriptions.SEND_TIME.strftime('%H:%M')}:"
     )
+    await query.edit_message_text(text, reply_markup=subscriptions.signs_keyboard(current))
 
-    response = f"⭐ Гороскоп для {zodiac}\n\n{horoscope}"
 
-    await update.message.reply_text(response, reply_markup=get_main_menu())
-    return ConversationHandler.END
+async def handle_subscribe(query, context, zodiac: str):
+    """Подписка на знак"""
+    if zodiac not in ZODIAC_SIGNS:
+        return
+    subscriptions.subscribe(query.message.chat_id, zodiac)
+    await query.edit_message_text(
+        f"✅ Готово! Гороскоп для знака {zodiac} будет приходить каждый день "
+        f"в {subscriptions.SEND_TIME.strftime('%H:%M')}.",
+        reply_markup=MAIN_MENU
+    )
+
 
+async def handle_unsubscribe(query, context):
+    """Отписка от рассылки"""
+    subscriptions.get_store().unsubscribe(query.message.chat_id)
+    await query.edit_message_text("🔕 Рассылка гороскопа отключена.", reply_markup=MAIN_MENU)
 
+
+@metrics.timed("natal_birthdate")
 async def handle_natal_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Натальная карта"""
-    birthdate = update.message.text.strip()
+    import natal  # расчёт на numpy: импортируется прогревом после запуска, а не при старте
 
-    await update.message.reply_text("🌟 Составляю натальную карту...")
+    day = natal.parse_date(update.message.text)
 
-    system_prompt = (
-        "Ты опытный астролог. Составь краткую натальную карту для человека, "
-        "родившегося в указанную дату. Опиши основные черты характера, "
-        "предназначение, сильные стороны. Пиши мистически и вдохновляюще. "
-        "Ответ на русском языке."
-    )
+    if day is None:
+        await update.message.reply_text(
+            "Не получилось разобрать дату. Введите дату рождения в формате ДД.ММ.ГГГГ\n"
+            "Например: 15.03.1990"
+        )
+        return WAITING_BIRTHDATE
 
-    natal = await ask_deepseek(
-        f"Составь натальную карту для человека, родившегося {birthdate}",
-        system_prompt
+    chart = natal.chart(day)
+    header = (
+        f"🌟 Натальная карта\nДата рождения: {day.strftime('%d.%m.%Y')}\n"
+        f"Знак Солнца: {natal.sun_sign(chart)}\n\n{natal.summary(chart)}\n\n"
     )
 
-    response = f"🌟 Натальная карта\nДата рождения: {birthdate}\n\n{natal}"
+    store = natal.get_store()
+    cached = store.get_reading(day) if store is not None else None
+    metrics.cache_result("natal", cached is not None)
+    if cached:
+        await update.message.reply_text(header + cached, reply_markup=MAIN_MENU)
+        return ConversationHandler.END
 
-    await update.message.reply_text(response, reply_markup=get_main_menu())
+    placeholder = await update.message.reply_text("🌟 Составляю натальную карту...")
+
+    await generation.submit(
+        update.effective_user.id,
+        placeholder,
+        *natal.prompt(chart),
+        header=header,
+        reply_markup=MAIN_MENU,
+        on_done=("natal", {"day": day.isoformat()}) if store is not None else None,
+        stale_key=f"natal:{day.isoformat()}",
+        local=degraded.LOCAL_NATAL
+    )
     return ConversationHandler.END
 
 
 # ============= ОБРАБОТЧИКИ ХИРОМАНТИИ =============
 
+@metrics.timed("palm_reading")
 async def handle_palm_reading(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Чтение по ладони"""
-    await update.message.reply_text("✋ Изучаю линии на твоей ладони...")
-
-    system_prompt = (
-        "Ты опытный хиромант с глубокими знаниями чтения по руке. "
-        "Проанализируй описание ладони или скажи что видишь фото и дай подробное толкование. "
-        "Опиши что означают линии жизни, сердца, ума, судьбы для этого человека. "
-        "Расскажи о характере человека, его судьбе и будущем. "
-        "Пиши загадочно и мистически. Ответ на русском языке."
-    )
+    placeholder = await update.message.reply_text("✋ Изучаю линии на твоей ладони...")
+
+    photo = None
 
     # Проверяем что прислал пользователь - текст или фото
     if update.message.photo:
-        prompt = (
-            "Пользователь прислал фото своей ладони. "
-            "Дай подробное хиромантическое толкование, основываясь на общих принципах хиромантии. "
-            "Опиши значение основных линий и что они говорят о характере и судьбе человека."
-        )
+        photo = await palm.load(update.message.photo)
+        if photo.reading is not None:
+            await placeholder.edit_text(f"✋ Чтение по ладони\n\n{photo.reading}",
+                                        reply_markup=MAIN_MENU)
+            return ConversationHandler.END
+        request = prompts.PALM.render(request=prompts.PALM_PHOTO_REQUEST)
     elif update.message.text:
-        description = update.message.text
-        prompt = f"Пользователь описал свою ладонь: {description}\n\nДай хиромантическое толкование на основе этого описания."
+        request = prompts.PALM.render(
+            request=prompts.PALM_TEXT_REQUEST.format(description=update.message.text)
+        )
     else:
         await update.message.reply_text(
             "Пожалуйста, отправьте фото ладони или опишите основные линии текстом."
         )
         return WAITING_PALM_PHOTO
 
-    try:
-        reading = await ask_deepseek(prompt, system_prompt)
-        result = f"✋ Чтение по ладони\n\n{reading}"
-
-    except Exception as e:
-        logger.error(f"Ошибка при анализе: {e}")
-        result = "Извините, произошла ошибка. Попробуйте позже."
-
-    await update.message.reply_text(result, reply_markup=get_main_menu())
+    await generation.submit(
+        update.effective_user.id,
+        placeholder,
+        *request,
+        header="✋ Чтение по ладони\n\n",
+        reply_markup=MAIN_MENU,
+        image=photo.jpeg if photo else None,
+        stream=False,
+        on_done=("palm", {"phash": photo.phash, "file_unique_id": photo.file_unique_id})
+        if photo else None,
+        stale_key=f"palm:{photo.phash}" if photo else None,
+        local=degraded.LOCAL_PALM
+    )
     return ConversationHandler.END
 
 
 # ============= ОБЩИЕ ПРЕДСКАЗАНИЯ =============
 
+@metrics.timed("prediction_question")
 async def handle_prediction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ответ на вопрос пользователя"""
     question = update.message.text.strip()
+    header = f"🔮 Предсказание\n\nТвой вопрос: _{question}_\n\n"
 
-    await update.message.reply_text("🔮 Заглядываю в будущее...")
+    # На похожий вопрос уже отвечали - отвечаем без генерации
+    cached = questions.cache.get(question)
+    if cached:
+        await update.message.reply_text(header + cached, reply_markup=MAIN_MENU,
+                                        parse_mode='Markdown')
+        return ConversationHandler.END
 
-    system_prompt = (
-        "Ты мистический предсказатель и ясновидящий. "
-        "Дай загадочное и глубокое предсказание на вопрос пользователя. "
-        "Будь мистичным, используй образы и метафоры. "
-        "Ответ на русском языке."
+    placeholder = await update.message.reply_text("🔮 Заглядываю в будущее...")
+
+    await generation.submit(
+        update.effective_user.id,
+        placeholder,
+        *prompts.PREDICTION.render(question=question),
+        header=header,
+        reply_markup=MAIN_MENU,
+        parse_mode='Markdown',
+        on_done=("prediction", {"question": question}),
+        stale_key=questions.stale_key(question),
+        local=degraded.local_prediction(question)
     )
+    return ConversationHandler.END
 
-    prediction = await ask_deepseek(
-        f"Вопрос: {question}\n\nДай предсказание.",
-        system_prompt
-    )
 
-    response = f"🔮 Предсказание\n\nТвой вопрос: _{question}_\n\n{prediction}"
+# ============= ДЕЙСТВИЯ С ГОТОВЫМИ ОТВЕТАМИ =============
 
-    await update.message.reply_text(response, reply_markup=get_main_menu(),
-                                     parse_mode='Markdown')
-    return ConversationHandler.END
+@generation.hook("horoscope_daily")
+def save_daily_horoscope(text: str, sign: str, day: str):
+    horoscope.get_store().put_daily(sign, text, date.fromisoformat(day))
+
+
+@generation.hook("horoscope_weekly")
+def save_weekly_horoscope(text: str, day: str):
+    horoscope.get_store().put_weekly(text, date.fromisoformat(day))
+
+
+@generation.hook("tarot_day")
+def save_card_of_day(text: str, index: int, reversed: bool, day: str):
+    horoscope.get_store().put_card_of_day(index, reversed, text, date.fromisoformat(day))
+
+
+@generation.hook("natal")
+def save_natal_reading(text: str, day: str):
+    import natal
+
+    natal.get_store().put_reading(date.fromisoformat(day), text)
+
+
+@generation.hook("prediction")
+def save_prediction(text: str, question: str):
+    questions.cache.put(question, text)
 
 
+@generation.hook("palm")
+def save_palm_reading(text: str, phash: int, file_unique_id: str):
+    palm.cache.put(phash, text, file_unique_id)
+
+
+@metrics.timed("help_command")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     help_text = (
@@ -494,60 +513,167 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help - Эта справка\n\n"
         "Используй меню для навигации по функциям бота."
     )
-    await update.message.reply_text(help_text, reply_markup=get_main_menu())
+    await update.message.reply_text(help_text, reply_markup=MAIN_MENU)
 
 
-def main():
-    """Главная функция запуска бота"""
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-
-    if not token:
-        raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
+# ============= МАРШРУТЫ КНОПОК =============
 
-    # Создание приложения
-    application = Application.builder().token(token).build()
+async def check_admission(query, route: routes.Route) -> Optional[str]:
+    """Отказ до заглушки, если генерацию всё равно не примут (лимит пользователя, полная очередь)"""
+    if not route.generates:
+        return None
+    retry_after = admission.user_buckets.wait_time(query.from_user.id)
+    if retry_after:
+        rejection = admission.RateLimited(retry_after)
+    elif generation.pool.store.depth() >= generation.pool.max_queue:
+        rejection = admission.Overloaded("queue is full")
+    else:
+        return None
+    admission.rejected_total.inc(type(rejection).__name__)
+    return rejection.user_message
+
+
+def observe_route(query, route: routes.Route, outcome: str, seconds: float):
+    """Время обработки кнопки по имени маршрута ("sub", а не "sub:Овен")"""
+    metrics.update_seconds.observe(seconds, route.name)
+    metrics.updates_total.inc(route.name, outcome)
+
+
+def build_router() -> routes.CallbackRouter:
+    """Таблица маршрутов кнопок (собирается один раз при запуске)"""
+    router = routes.CallbackRouter()
+
+    # Меню и экраны, с которых начинаются диалоги
+    router.screen("back_main", "🔮 Главное меню. Выбери интересующую тебя область:", MAIN_MENU,
+                  state=ConversationHandler.END)
+    router.screen("tarot", "🃏 Выбери расклад Таро:", TAROT_MENU)
+    router.screen("astrology", "⭐ Выбери тип астрологического прогноза:", ASTROLOGY_MENU)
+    router.screen("help", HELP_TEXT, BACK_MENU)
+    router.screen("palmistry", PALMISTRY_TEXT, state=WAITING_PALM_PHOTO)
+    router.screen("prediction", "🎱 Задай мне свой вопрос, и я загляну в будущее...\n\n"
+                                "Напиши свой вопрос одним сообщением.", state=WAITING_QUESTION)
+    router.screen("horoscope_today", "⭐ Введите ваш знак зодиака:", state=WAITING_ZODIAC)
+    router.screen("natal_chart", "🌟 Для натальной карты введите дату рождения в формате ДД.ММ.ГГГГ\n"
+                                 "Например: 15.03.1990", state=WAITING_BIRTHDATE)
+
+    # Таро
+    router.add("tarot_day", handle_tarot_day, generates=True)
+    router.add("tarot_three", handle_tarot_three, generates=True)
+    router.add("tarot_love", handle_tarot_love, generates=True)
+    router.add("tarot_yesno", handle_tarot_yesno, generates=True)
+
+    # Астрология и подписка
+    router.add("horoscope_week", handle_horoscope_week, generates=True)
+    router.add("subscribe", handle_subscribe_menu)
+    router.add_prefix("sub", handle_subscribe)
+    router.add("unsubscribe", handle_unsubscribe)
+
+    router.pre(check_admission)
+    router.post(observe_route)
+    return router
+
+
+async def on_startup(application: Application):
+    """Запуск пула генерации и сервера метрик (если задан METRICS_PORT), прогрев в фоне"""
+    await generation.pool.start(application.bot)
+    metrics.start_server()
+    startup.mark("запуск")
+    startup.start_warm_up()
+
+
+async def on_shutdown(application: Application):
+    """Освобождение ресурсов при остановке"""
+    await generation.pool.stop()
+    await llm.close()
+
+
+def build_application(token: str) -> Application:
+    """Создает приложение и регистрирует все обработчики"""
+    # Общее хранилище состояний диалогов (переживает рестарт, видно всем процессам)
+    store = persistence.create_store()
+    # Очередь генераций (воркеры стартуют в on_startup)
+    generation.create_pool()
+
+    builder = (
+        Application.builder()
+        .application_class(tracing.TracedApplication)
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(outbound.create_scheduler())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if store is not None:
+        builder = builder.persistence(persistence.StorePersistence(store))
+    if TELEGRAM_BASE_URL:
+        base_url = TELEGRAM_BASE_URL.rstrip('/')
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+
+    metrics.update_queue_size.func = application.update_queue.qsize
+    router = build_router()
+    # Кнопки, которыми начинаются диалоги: проверка по множеству вместо регулярных выражений
+    entries = {data: router.matcher(data) for data in ("horoscope_today", "natal_chart", "palmistry", "prediction")}
+
+    conversation_options = dict(
+        store=store,
+        persistent=store is not None,
+        conversation_timeout=persistence.CONVERSATION_TIMEOUT
+    )
 
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
 
     # ConversationHandler для астрологии (знак зодиака)
-    zodiac_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^horoscope_today$")],
+    zodiac_conv_handler = SharedConversationHandler(
+        entry_points=[CallbackQueryHandler(router.dispatch, pattern=entries["horoscope_today"])],
+        entry_callbacks=entries["horoscope_today"],
         states={
             WAITING_ZODIAC: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_zodiac_horoscope)]
         },
-        fallbacks=[CommandHandler("start", start)]
+        fallbacks=[CommandHandler("start", start)],
+        name="zodiac",
+        **conversation_options
     )
 
     # ConversationHandler для натальной карты
-    natal_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^natal_chart$")],
+    natal_conv_handler = SharedConversationHandler(
+        entry_points=[CallbackQueryHandler(router.dispatch, pattern=entries["natal_chart"])],
+        entry_callbacks=entries["natal_chart"],
         states={
             WAITING_BIRTHDATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_natal_chart)]
         },
-        fallbacks=[CommandHandler("start", start)]
+        fallbacks=[CommandHandler("start", start)],
+        name="natal",
+        **conversation_options
     )
 
     # ConversationHandler для хиромантии
-    palm_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^palmistry$")],
+    palm_conv_handler = SharedConversationHandler(
+        entry_points=[CallbackQueryHandler(router.dispatch, pattern=entries["palmistry"])],
+        entry_callbacks=entries["palmistry"],
         states={
             WAITING_PALM_PHOTO: [
                 MessageHandler(filters.PHOTO, handle_palm_reading),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_palm_reading)
             ]
         },
-        fallbacks=[CommandHandler("start", start)]
+        fallbacks=[CommandHandler("start", start)],
+        name="palm",
+        **conversation_options
     )
 
     # ConversationHandler для предсказаний
-    prediction_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^prediction$")],
+    prediction_conv_handler = SharedConversationHandler(
+        entry_points=[CallbackQueryHandler(router.dispatch, pattern=entries["prediction"])],
+        entry_callbacks=entries["prediction"],
         states={
             WAITING_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_prediction)]
         },
-        fallbacks=[CommandHandler("start", start)]
+        fallbacks=[CommandHandler("start", start)],
+        name="prediction",
+        **conversation_options
     )
 
     # Добавление ConversationHandlers
@@ -556,12 +682,65 @@ def main():
     application.add_handler(palm_conv_handler)
     application.add_handler(prediction_conv_handler)
 
-    # Обработчик кнопок (должен быть после ConversationHandlers)
-    application.add_handler(CallbackQueryHandler(button_handler))
+    # Остальные кнопки (должен быть после ConversationHandlers)
+    application.add_handler(CallbackQueryHandler(router.dispatch))
+    # Последняя группа: срабатывает, когда остальные обработчики апдейта уже отработали
+    application.add_handler(TypeHandler(Update, startup.first_update), group=LAST_GROUP)
+
+    # Ежедневный прогрев кэша гороскопов
+    horoscope.schedule(application)
+
+    # Ежедневная рассылка гороскопов подписчикам
+    subscriptions.schedule(application)
+
+    # Очистка брошенных диалогов в общем хранилище
+    if store is not None:
+        persistence.schedule(application, store)
+
+    startup.mark("сборка")
+    return application
+
+
+def main():
+    """Главная функция запуска бота"""
+    parser = argparse.ArgumentParser(description="Мистический Telegram бот")
+    parser.add_argument(
+        "--mode", choices=["polling", "webhook"], default=os.getenv('BOT_MODE', 'polling'),
+        help="polling - для локального запуска, webhook - для сервера"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv('BOT_WORKERS', '1')),
+        help="число процессов-обработчиков (больше 1 - режим с супервизором)"
+    )
+    parser.add_argument(
+        "--profile-startup", action="store_true",
+        help="показать, сколько занимают импорт модулей и этапы запуска, и выйти"
+    )
+    args = parser.parse_args()
+
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+
+    if args.profile_startup:
+        # Сборка приложения не обращается к Telegram - токен может быть любым
+        startup.profile(lambda: build_application(token or "0:profile"))
+        return
+
+    if not token:
+        raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
+
+    if args.workers > 1:
+        logger.info(f"Бот запущен! Режим: {args.mode}, процессов: {args.workers}")
+        supervisor.run(token, args.workers, args.mode)
+        return
+
+    application = build_application(token)
 
     # Запуск бота
-    logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Бот запущен! Режим: {args.mode}, параллельных апдейтов: {CONCURRENT_UPDATES}")
+    if args.mode == "webhook":
+        server.run(application)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
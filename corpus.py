@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Корпус заранее сгенерированных толкований карт Таро.
+
+Сборка (офлайн):
+    python corpus.py build --variants 3 --concurrency 8
+
+Бот читает корпус в режиме только для чтения и собирает из него
+расклады без обращения к API.
+"""
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+import tarot
+import metrics
+import prompts
+
+logger = logging.getLogger(__name__)
+
+CORPUS_PATH = os.getenv('TAROT_CORPUS_PATH', 'tarot_corpus.db')
+# off - не использовать, single - одиночные карты из корпуса, all - все расклады
+CORPUS_MODE = os.getenv('TAROT_CORPUS_MODE', 'single')
+# Сколько ждать первый фрагмент живого ответа, прежде чем ответить из корпуса
+FALLBACK_TIMEOUT = float(os.getenv('TAROT_CORPUS_FALLBACK_TIMEOUT', '8'))
+
+# Расклады и их позиции (совпадают с обработчиками в bot.py)
+SPREADS: Dict[str, Tuple[str, List[str]]] = {
+    "tarot_day": ("Карта дня", ["Карта дня"]),
+    "tarot_yesno": ("Ответ Да/Нет", ["Ответ"]),
+    "tarot_three": ("Прошлое-Настоящее-Будущее", ["Прошлое", "Настоящее", "Будущее"]),
+    "tarot_love": ("Любовный расклад", ["Ты", "Партнер", "Отношения"]),
+}
+SINGLE_CARD_SPREADS = {"tarot_day", "tarot_yesno"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interpretations (
+    spread   TEXT    NOT NULL,
+    position INTEGER NOT NULL,
+    card     INTEGER NOT NULL,
+    variant  INTEGER NOT NULL,
+    text     TEXT    NOT NULL,
+    PRIMARY KEY (spread, position, card, variant)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def position_prompt(spread: str, position: int, card: str, variant: int) -> str:
+    """Запрос на толкование одной карты в позиции расклада"""
+    title, positions = SPREADS[spread]
+    prompt = (
+        f"Расклад «{title}», позиция «{positions[position]}». Выпала карта: {card}. "
+        f"Дай толкование этой карты в этой позиции."
+    )
+    if spread == "tarot_yesno":
+        prompt += " Скажи, это Да или Нет, и объясни почему."
+    # Номер варианта делает запросы различимыми (и для single-flight тоже)
+    return prompt + f" Вариант толкования №{variant + 1}."
+
+
+# ============= СБОРКА КОРПУСА =============
+
+async def build(path: str, variants: int, concurrency: int, spreads: List[str]):
+    """Генерирует недостающие толкования с ограниченным параллелизмом"""
+    import llm  # клиент API нужен только при сборке
+
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    existing = set(db.execute("SELECT spread, position, card, variant FROM interpretations"))
+
+    deck = tarot.DECK
+    todo = [
+        (spread, position, card, variant)
+        for spread in spreads
+        for position in range(len(SPREADS[spread][1]))
+        for card in range(len(deck))
+        for variant in range(variants)
+        if (spread, position, card, variant) not in existing
+    ]
+    logger.info(f"Нужно сгенерировать {len(todo)} толкований")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+    started = time.monotonic()
+
+    async def generate(spread, position, card, variant):
+        nonlocal done
+        async with semaphore:
+            response = await llm.complete(
+                *prompts.TAROT_POSITION.render(request=position_prompt(spread, position, deck[card], variant)),
+                temperature=1.0,
+                max_tokens=400
+            )
+        text = response.choices[0].message.content.strip()
+        db.execute(
+            "INSERT OR REPLACE INTO interpretations VALUES (?, ?, ?, ?, ?)",
+            (spread, position, card, variant, text)
+        )
+        done += 1
+        if done % 50 == 0:
+            db.commit()
+            logger.info(f"{done}/{len(todo)} за {time.monotonic() - started:.0f} с")
+
+    results = await asyncio.gather(*(generate(*item) for item in todo), return_exceptions=True)
+    failed = sum(isinstance(r, Exception) for r in results)
+
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('variants', ?)", (str(variants),))
+    db.commit()
+    db.execute("VACUUM")
+    db.close()
+    await llm.close()
+    logger.info(f"Готово: {done} новых толкований, ошибок: {failed}")
+
+
+# ============= ЧТЕНИЕ КОРПУСА =============
+
+class TarotCorpus:
+    """Корпус толкований, открытый только для чтения"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.db.execute("PRAGMA mmap_size = 268435456")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'variants'").fetchone()
+        self.variants = int(row[0]) if row else 1
+        self.spreads = {
+            spread for (spread,) in self.db.execute("SELECT DISTINCT spread FROM interpretations")
+        }
+
+    def interpretation(self, spread: str, position: int, card: tarot.Card) -> Optional[str]:
+        """Случайный вариант толкования карты в позиции"""
+        # В корпусе только прямые карты: перевёрнутую толкует модель
+        if card.reversed:
+            return None
+        row = self.db.execute(
+            "SELECT text FROM interpretations "
+            "WHERE spread = ? AND position = ? AND card = ? AND variant = ?",
+            (spread, position, card.index, random.randrange(self.variants))
+        ).fetchone()
+        return row[0] if row else None
+
+    def reading(self, spread: str, cards: List[tarot.Card]) -> Optional[str]:
+        """Собирает текст расклада; None, если в корпусе чего-то не хватает"""
+        if spread not in self.spreads:
+            return None
+        texts = [self.interpretation(spread, i, card) for i, card in enumerate(cards)]
+        if None in texts:
+            return None
+        if len(texts) == 1:
+            return texts[0]
+        positions = SPREADS[spread][1]
+        return "\n\n".join(f"*{positions[i]}.* {text}" for i, text in enumerate(texts))
+
+
+_corpus: Optional[TarotCorpus] = None
+_loaded = False
+
+
+def get_corpus() -> Optional[TarotCorpus]:
+    """Открывает корпус при первом обращении (если он собран)"""
+    global _corpus, _loaded
+    if not _loaded:
+        _loaded = True
+        if CORPUS_MODE != 'off' and os.path.exists(CORPUS_PATH):
+            try:
+                _corpus = TarotCorpus(CORPUS_PATH)
+                logger.info(f"Корпус толкований загружен: {CORPUS_PATH}")
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось открыть корпус толкований: {e}")
+    return _corpus
+
+
+def serve(spread: str, cards: List[tarot.Card]) -> Optional[str]:
+    """Готовый расклад из корпуса, если режим позволяет отвечать без API"""
+    if CORPUS_MODE == 'single' and spread not in SINGLE_CARD_SPREADS:
+        return None
+    corpus = get_corpus()
+    if corpus is None:
+        return None
+    reading = corpus.reading(spread, cards)
+    metrics.cache_result("tarot_corpus", reading is not None)
+    return reading
+
+
+def fallback(spread: str, cards: List[tarot.Card]) -> Optional[str]:
+    """Расклад из корпуса на случай, если API не отвечает"""
+    corpus = get_corpus()
+    return corpus.reading(spread, cards) if corpus else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Корпус толкований карт Таро")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = sub.add_parser("build", help="сгенерировать корпус")
+    build_parser.add_argument("--db", default=CORPUS_PATH, help="путь к файлу корпуса")
+    build_parser.add_argument("--variants", type=int, default=3, help="вариантов на позицию")
+    build_parser.add_argument("--concurrency", type=int, default=8, help="параллельных запросов")
+    build_parser.add_argument("--spreads", nargs="+", choices=list(SPREADS), default=list(SPREADS))
+
+    sample_parser = sub.add_parser("sample", help="показать случайный расклад из корпуса")
+    sample_parser.add_argument("--db", default=CORPUS_PATH)
+    sample_parser.add_argument("spread", choices=list(SPREADS))
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.command == "build":
+        asyncio.run(build(args.db, args.variants, args.concurrency, args.spreads))
+    else:
+        cards = tarot.draw(len(SPREADS[args.spread][1]), reversals=0)
+        corpus = TarotCorpus(args.db)
+        started = time.perf_counter()
+        text = corpus.reading(args.spread, cards)
+        elapsed = (time.perf_counter() - started) * 1e6
+        print(f"{', '.join(card.title for card in cards)}\n\n{text}\n\n({elapsed:.0f} мкс)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Деградированный режим: что отвечать, когда DeepSeek не отвечает или медлит.
+
+Общий выключатель размыкается после нескольких ошибок подряд или ответов дольше SLO.
+Пока он разомкнут, запросы к API не отправляются: пользователь сразу получает
+последний удачный ответ по тому же ключу (stale-while-revalidate), толкование
+из корпуса или ответ, собранный локально по шаблону. Фоновая проба раз в
+PROBE_INTERVAL секунд проверяет API и замыкает выключатель, когда он оживает.
+"""
+import os
+import random
+import asyncio
+import logging
+import zlib
+from collections import OrderedDict
+from datetime import date
+from typing import List, Optional, Tuple
+
+import metrics
+from router import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+# Сколько ошибок или нарушений SLO подряд размыкают выключатель
+FAILURES = int(os.getenv('DEGRADED_FAILURES', '3'))
+# SLO: первый фрагмент потокового ответа и ответ целиком, секунды
+FIRST_TOKEN_SLO = float(os.getenv('DEGRADED_FIRST_TOKEN_SLO', '10'))
+COMPLETE_SLO = float(os.getenv('DEGRADED_COMPLETE_SLO', '45'))
+# Как часто проверять API, пока выключатель разомкнут, секунды
+PROBE_INTERVAL = float(os.getenv('DEGRADED_PROBE_INTERVAL', '15'))
+STALE_SIZE = int(os.getenv('DEGRADED_STALE_SIZE', '5000'))
+
+NOTICE = "\n\n🌙 Связь с высшими силами сейчас слабая, поэтому ответ пришёл из архива."
+
+breaker = CircuitBreaker(FAILURES, reset_timeout=PROBE_INTERVAL)
+_probe_task: Optional[asyncio.Task] = None
+
+answers_total = metrics.Counter(
+    "degraded_answers_total", "Ответы без API: stale, corpus, local или none (отвечать нечем)",
+    ["source"]
+)
+metrics.Gauge("llm_circuit_open", "Общий выключатель LLM разомкнут (деградированный режим)",
+              func=lambda: 0 if breaker.state == CircuitBreaker.CLOSED else 1)
+
+
+class CircuitOpen(Exception):
+    """API считается недоступным: запрос не отправлялся"""
+
+
+def is_open() -> bool:
+    return breaker.state != CircuitBreaker.CLOSED
+
+
+def record(latency: Optional[float], slo: float = FIRST_TOKEN_SLO):
+    """Итог обращения к API: latency=None - ошибка, дольше slo - нарушение SLO"""
+    if latency is not None and latency <= slo:
+        if is_open():
+            logger.info(f"API снова отвечает ({latency:.1f} с), деградированный режим выключен")
+        breaker.success()
+        return
+
+    was_open = is_open()
+    breaker.failure()
+    if is_open() and not was_open:
+        reason = "ошибки" if latency is None else f"ответ дольше SLO ({latency:.1f} с)"
+        logger.warning(f"Деградированный режим: {reason} {breaker.failures} раз подряд")
+        _start_probe()
+
+
+def _start_probe():
+    global _probe_task
+    if _probe_task is not None and not _probe_task.done():
+        return
+    try:
+        _probe_task = asyncio.get_running_loop().create_task(_probe())
+    except RuntimeError:
+        pass
+
+
+async def _probe():
+    """Проверяет API, пока выключатель не замкнётся"""
+    import llm  # llm сам импортирует этот модуль
+
+    while is_open():
+        # Разброс, чтобы пробы воркеров супервизора не совпадали
+        await asyncio.sleep(PROBE_INTERVAL * random.uniform(0.8, 1.2))
+        try:
+            latency = await llm.probe(FIRST_TOKEN_SLO)
+        except Exception as e:
+            logger.info(f"Проба API не удалась: {e}")
+            latency = None
+        record(latency)
+
+
+# ============= ПОСЛЕДНИЕ УДАЧНЫЕ ОТВЕТЫ =============
+
+class StaleStore:
+    """Последний удачный ответ по ключу, без срока годности (LRU по размеру)"""
+
+    def __init__(self, size: int = STALE_SIZE):
+        self.size = size
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def remember(self, key: Optional[str], text: str):
+        if not key or not text:
+            return
+        self._items[key] = text
+        self._items.move_to_end(key)
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def recall(self, key: Optional[str]) -> Optional[str]:
+        return self._items.get(key) if key else None
+
+
+stale = StaleStore()
+
+
+def reserve(stale_key: Optional[str], fallback: Optional[str],
+            local: Optional[str]) -> Tuple[Optional[str], str]:
+    """Лучший ответ без API и его источник: прошлый ответ, корпус или шаблон"""
+    text = stale.recall(stale_key)
+    if text:
+        return text + NOTICE, "stale"
+    if fallback:
+        return fallback, "corpus"
+    if local:
+        return local + NOTICE, "local"
+    return None, "none"
+
+
+# ============= ЛОКАЛЬНЫЕ ТОЛКОВАНИЯ =============
+
+def local_tarot(positions: List[str], cards) -> str:
+    """Толкование расклада по кратким значениям карт"""
+    if len(cards) == 1:
+        return f"{cards[0].title}: {cards[0].meaning}. Прислушайся к этому знаку сегодня."
+    return "\n\n".join(
+        f"*{position}.* {card.title}: {card.meaning}." for position, card in zip(positions, cards)
+    )
+
+
+_MOODS = (
+    "Звёзды советуют не спешить и присмотреться к мелочам",
+    "День благоволит смелым решениям и новым знакомствам",
+    "Энергия дня располагает к отдыху и восстановлению сил",
+    "Планеты подталкивают завершить начатое",
+    "Хорошее время, чтобы прислушаться к интуиции",
+    "Звёзды обещают приятную неожиданность",
+)
+_SPHERES = (
+    "В отношениях важнее всего искренность.",
+    "В делах поможет терпение и внимание к деталям.",
+    "Финансовые вопросы лучше отложить до конца недели.",
+    "Близкие люди ждут от тебя тепла и участия.",
+    "Разговор, которого ты избегаешь, принесёт облегчение.",
+    "Новая идея может оказаться удачнее, чем кажется.",
+)
+_ADVICE = (
+    "Береги силы для главного.",
+    "Доверься ходу событий.",
+    "Не отказывайся от помощи.",
+    "Слушай сердце, но проверяй разумом.",
+    "Оставь место для чуда.",
+    "Сделай первый шаг - дальше станет легче.",
+)
+
+
+def _pick(seed: str, options: Tuple[str, ...], salt: int) -> str:
+    return options[zlib.crc32(f"{seed}:{salt}".encode()) % len(options)]
+
+
+def local_horoscope(sign: str, day: date) -> str:
+    """Гороскоп из заготовок: один и тот же для знака (или недели) в течение дня"""
+    seed = f"{sign}:{day.isoformat()}"
+    return f"{_pick(seed, _MOODS, 0)}. {_pick(seed, _SPHERES, 1)} {_pick(seed, _ADVICE, 2)}"
+
+
+_ORACLE = (
+    "Ответ уже зреет в тебе - дай ему время проявиться.",
+    "Путь откроется, но не так, как ты ожидаешь.",
+    "Знаки говорят «да», если ты готов сделать первый шаг.",
+    "Сейчас не время торопить судьбу: ответ придёт с новой луной.",
+    "Туман рассеется, когда ты отпустишь страх.",
+    "Судьба благосклонна, но просит терпения.",
+    "То, что кажется препятствием, окажется поворотом к лучшему.",
+    "Ответ ближе, чем кажется: присмотрись к тем, кто рядом.",
+)
+
+
+def local_prediction(question: str) -> str:
+    """Предсказание из заготовок: на один вопрос - один ответ"""
+    return _pick(question.lower().strip(), _ORACLE, 0)
+
+
+LOCAL_PALM = (
+    "Линии ладони хранят историю характера: линия жизни говорит о запасе сил, "
+    "линия сердца - о том, как ты любишь, линия ума - о том, как принимаешь решения. "
+    "Подробное толкование станет доступно чуть позже - попробуй ещё раз через несколько минут."
+)
+
+LOCAL_NATAL = (
+    "Положения светил в твоей карте показаны выше. Солнце говорит о сути характера, "
+    "Луна - о чувствах, а Венера и Марс - о любви и воле. "
+    "Подробное толкование станет доступно чуть позже - попробуй ещё раз через несколько минут."
+)
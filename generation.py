@@ -0,0 +1,421 @@
+"""
+Фоновая генерация ответов: обработчик ставит задание в очередь и сразу
+освобождается, а пул воркеров выполняет задания и доставляет ответ,
+редактируя сообщение-заглушку.
+
+Очередь хранится в SQLite, поэтому задания переживают перезапуск бота:
+прерванные задания при старте возвращаются в очередь. Взятое задание помечено
+владельцем (номером воркера) и временем захвата: при старте возвращаются только
+свои задания и задания с истёкшей арендой, чужие выполняющиеся не трогаются.
+"""
+import os
+import json
+import time
+import base64
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram import Bot, Chat, InlineKeyboardMarkup, Message
+from telegram.error import TelegramError
+
+import llm
+import metrics
+import admission
+import degraded
+import tracing
+from streaming import stream_reply, with_fallback
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', 'jobs.db')
+# Число воркеров - столько генераций идёт одновременно
+WORKERS = int(os.getenv('GENERATION_WORKERS', str(admission.MAX_ACTIVE)))
+# Задания старше этого (например, пролежавшие в очереди, пока бот был выключен) не выполняем
+MAX_AGE = float(os.getenv('GENERATION_MAX_AGE', '600'))
+# Сколько секунд взятое задание считается выполняющимся, даже если его владелец не отвечает
+LEASE = float(os.getenv('GENERATION_LEASE', str(MAX_AGE)))
+# Владелец взятых заданий: номер воркера (задаёт супервизор), одинаковый после перезапуска
+OWNER = os.getenv('BOT_WORKER', '0')
+# Сколько раз повторять задание, упавшее с неожиданной ошибкой
+MAX_ATTEMPTS = 2
+POSITION_UPDATE_INTERVAL = admission.POSITION_UPDATE_INTERVAL
+
+QUEUED, RUNNING = "queued", "running"
+
+
+class JobStore:
+    """Очередь заданий в SQLite: порядок по приоритету и времени постановки"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  priority INTEGER NOT NULL,"
+            "  state TEXT NOT NULL,"
+            "  attempts INTEGER NOT NULL DEFAULT 0,"
+            "  created_at REAL NOT NULL,"
+            "  payload TEXT NOT NULL,"
+            "  owner TEXT NOT NULL DEFAULT '',"
+            "  claimed_at REAL NOT NULL DEFAULT 0"
+            ")"
+        )
+        # Очереди, созданные до появления владельца заданий
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            self.db.execute("ALTER TABLE jobs ADD COLUMN claimed_at REAL NOT NULL DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, priority, id)")
+        self._lock = threading.Lock()
+
+    def recover(self, owner: str = OWNER, lease: float = LEASE) -> int:
+        """
+        Возвращает в очередь задания, прерванные остановкой процесса: взятые
+        этим владельцем до перезапуска и те, чья аренда истекла
+        """
+        with self._lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET state = ?, owner = '' WHERE state = ? AND (owner = ? OR claimed_at < ?)",
+                (QUEUED, RUNNING, owner, time.time() - lease)
+            )
+        return cursor.rowcount
+
+    def push(self, payload: dict, priority: int) -> int:
+        with self._lock:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (priority, state, created_at, payload) VALUES (?, ?, ?, ?)",
+                (priority, QUEUED, time.time(), json.dumps(payload, ensure_ascii=False))
+            )
+        return cursor.lastrowid
+
+    def claim(self, owner: str = OWNER) -> Optional[Tuple[int, int, float, dict]]:
+        """Забирает первое задание из очереди: (id, attempts, created_at, payload)"""
+        with self._lock:
+            row = self.db.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, owner = ?, claimed_at = ? WHERE id = ("
+                "  SELECT id FROM jobs WHERE state = ? ORDER BY priority, id LIMIT 1"
+                ") RETURNING id, attempts, created_at, payload",
+                (RUNNING, owner, time.time(), QUEUED)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], json.loads(row[3])
+
+    def requeue(self, job_id: int):
+        with self._lock:
+            self.db.execute("UPDATE jobs SET state = ?, owner = '' WHERE id = ?", (QUEUED, job_id))
+
+    def delete(self, job_id: int):
+        with self._lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def queued(self) -> List[Tuple[int, dict]]:
+        """Ожидающие задания в порядке выполнения"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, payload FROM jobs WHERE state = ? ORDER BY priority, id", (QUEUED,)
+            ).fetchall()
+        return [(job_id, json.loads(payload)) for job_id, payload in rows]
+
+    def is_queued(self, job_id: int) -> bool:
+        """Задание всё ещё ждёт (не взято воркером и не завершено)"""
+        with self._lock:
+            row = self.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None and row[0] == QUEUED
+
+    def depth(self) -> int:
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+# ============= ДЕЙСТВИЯ ПОСЛЕ ГЕНЕРАЦИИ =============
+
+# Обработчики результата по имени: задание хранит только имя и параметры
+_hooks: Dict[str, Callable[..., None]] = {}
+
+
+def hook(name: str):
+    """Регистрирует действие, выполняемое с готовым текстом (например, запись в кэш)"""
+    def decorator(func):
+        _hooks[name] = func
+        return func
+    return decorator
+
+
+def run_hook(on_done: Optional[Tuple[str, dict]], text: str):
+    """Выполняет действие с готовым текстом; ответы-ошибки пропускает"""
+    if not on_done or not text or text == llm.ERROR_MESSAGE:
+        return
+    name, params = on_done
+    try:
+        _hooks[name](text, **params)
+    except Exception as e:
+        logger.error(f"Ошибка обработки результата {name}: {e}")
+
+
+# ============= ПУЛ ВОРКЕРОВ =============
+
+def _message(bot: Bot, chat_id: int, message_id: int) -> Message:
+    """Сообщение-заглушка, восстановленное по id (для edit_text и send_message)"""
+    message = Message(
+        message_id=message_id,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE)
+    )
+    message.set_bot(bot)
+    return message
+
+
+class GenerationPool:
+    """Фиксированный пул асинхронных воркеров поверх JobStore"""
+
+    def __init__(self, store: JobStore, workers: int = WORKERS, max_queue: int = admission.MAX_QUEUE,
+                 max_age: float = MAX_AGE):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_age = max_age
+        self.bot: Optional[Bot] = None
+        self.active = 0
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._shown: Dict[int, int] = {}
+
+    # Постановка в очередь
+
+    async def submit(self, user_id: int, placeholder: Message, payload: dict,
+                     priority: int = admission.PRIORITY_INTERACTIVE) -> bool:
+        """
+        Ставит задание в очередь; при отказе (лимит пользователя, переполнение)
+        объясняет причину в заглушке. Не ждёт выполнения.
+        """
+        reply_markup = payload.get("reply_markup")
+        try:
+            retry_after = admission.user_buckets.consume(user_id)
+            if retry_after:
+                raise admission.RateLimited(retry_after)
+            if self.store.depth() >= self.max_queue:
+                raise admission.Overloaded("queue is full")
+        except admission.Rejected as e:
+            logger.info(f"Запрос пользователя {user_id} отклонён: {e}")
+            admission.rejected_total.inc(type(e).__name__)
+            await self._edit(placeholder.chat_id, placeholder.message_id, e.user_message,
+                             reply_markup)
+            return False
+
+        payload = dict(payload, chat_id=placeholder.chat_id, message_id=placeholder.message_id)
+        self.store.push(payload, priority)
+        self._wakeup.set()
+        return True
+
+    # Выполнение
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        recovered = self.store.recover()
+        if recovered:
+            logger.info(f"Возвращено в очередь прерванных генераций: {recovered}")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._report_positions()))
+        self._wakeup.set()
+
+    async def stop(self):
+        """Останавливает воркеры; незавершённые задания останутся в очереди до перезапуска"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def drain(self):
+        """Ждёт, пока очередь опустеет и все задания завершатся"""
+        while self.active or self.store.depth():
+            await asyncio.sleep(0.1)
+
+    async def _worker(self, index: int):
+        while True:
+            job = self.store.claim()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Разбудим соседа: в очереди может быть ещё работа
+            self._wakeup.set()
+
+            job_id, attempts, created_at, payload = job
+            self._shown.pop(job_id, None)
+            self.active += 1
+            try:
+                # Трасса апдейта продолжается здесь: сколько задание ждало и выполнялось
+                with tracing.resume(payload.get("trace"), "generation",
+                                    queued=round(time.time() - created_at, 3), attempt=attempts):
+                    if time.time() - created_at > self.max_age:
+                        await self._shed(payload)
+                    else:
+                        async with admission.slot(admission.PRIORITY_INTERACTIVE, max_wait=self.max_age):
+                            await self._run(payload)
+                self.store.delete(job_id)
+            except asyncio.CancelledError:
+                # Остановка процесса: задание будет выполнено после перезапуска
+                raise
+            except admission.Rejected as e:
+                # Слот не освободился за max_age: повтор только продлил бы ожидание
+                logger.info(f"Генерация {job_id} отброшена: {e}")
+                admission.rejected_total.inc(type(e).__name__)
+                self.store.delete(job_id)
+                await self._edit(payload["chat_id"], payload["message_id"], e.user_message,
+                                 payload.get("reply_markup"))
+            except Exception as e:
+                logger.error(f"Ошибка выполнения генерации {job_id}: {e}")
+                if attempts < MAX_ATTEMPTS:
+                    self.store.requeue(job_id)
+                else:
+                    self.store.delete(job_id)
+                    await self._edit(payload["chat_id"], payload["message_id"], llm.ERROR_MESSAGE,
+                                     payload.get("reply_markup"))
+            finally:
+                self.active -= 1
+
+    async def _run(self, payload: dict):
+        message = _message(self.bot, payload["chat_id"], payload["message_id"])
+        markup = InlineKeyboardMarkup.de_json(payload["reply_markup"], self.bot) \
+            if payload.get("reply_markup") else None
+        header = payload.get("header", "")
+        parse_mode = payload.get("parse_mode")
+        # Ответ без API: прошлый удачный, из корпуса или по шаблону
+        reserve, source = degraded.reserve(payload.get("stale_key"), payload.get("fallback"),
+                                           payload.get("local"))
+
+        if degraded.is_open():
+            degraded.answers_total.inc(source)
+            await message.edit_text(header + (reserve or llm.ERROR_MESSAGE), reply_markup=markup,
+                                    parse_mode=parse_mode)
+            return
+
+        if payload.get("stream", True):
+            chunks = llm.stream_deepseek(payload["prompt"], payload.get("system_prompt"))
+            if reserve:
+                timeout = payload.get("fallback_timeout") or degraded.FIRST_TOKEN_SLO
+                chunks = with_fallback(chunks, reserve, timeout)
+            text = await stream_reply(message, chunks, header=header, reply_markup=markup,
+                                      parse_mode=parse_mode)
+        else:
+            image = base64.b64decode(payload["image"]) if payload.get("image") else None
+            request = llm.ask_deepseek(payload["prompt"], payload.get("system_prompt"), image=image)
+            try:
+                text = await asyncio.wait_for(request, degraded.COMPLETE_SLO if reserve else None)
+            except asyncio.TimeoutError:
+                text = llm.ERROR_MESSAGE
+            if text == llm.ERROR_MESSAGE and reserve:
+                text = reserve
+            await message.edit_text(header + text, reply_markup=markup, parse_mode=parse_mode)
+
+        if reserve and text == reserve:
+            # Запасной ответ не кэшируем как свежий
+            degraded.answers_total.inc(source)
+            return
+        if text and text != llm.ERROR_MESSAGE:
+            degraded.stale.remember(payload.get("stale_key"), text)
+        run_hook(payload.get("on_done"), text)
+
+    async def _shed(self, payload: dict):
+        """Задание ждало слишком долго (например, пока бот был остановлен)"""
+        logger.info(f"Генерация для чата {payload['chat_id']} отброшена: слишком долго в очереди")
+        admission.rejected_total.inc("Expired")
+        await self._edit(payload["chat_id"], payload["message_id"], admission.Rejected.user_message,
+                         payload.get("reply_markup"))
+
+    # Уведомления
+
+    async def _edit(self, chat_id: int, message_id: int, text: str, reply_markup: Optional[dict] = None):
+        bot = self.bot
+        if bot is None:
+            return
+        try:
+            await bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id,
+                reply_markup=InlineKeyboardMarkup.de_json(reply_markup, bot) if reply_markup else None
+            )
+        except TelegramError:
+            pass
+
+    async def _report_positions(self):
+        """Показывает ожидающим их место в очереди (только при изменении)"""
+        while True:
+            await asyncio.sleep(POSITION_UPDATE_INTERVAL)
+            await self._show_positions()
+
+    async def _show_positions(self):
+        queued = self.store.queued()
+        for position, (job_id, payload) in enumerate(queued, start=1):
+            if self._shown.get(job_id) == position:
+                continue
+            # Правки идут через планировщик отправки и могут ждать: за это время задание
+            # из снимка успевает уйти в работу и даже завершиться. Позднее «место в очереди»
+            # затёрло бы готовый ответ, поэтому проверяем состояние перед каждой правкой.
+            # Правки самого задания новее и важнее, так что уже стоящую в очереди отправки
+            # правку с местом планировщик заменит ими.
+            if not self.store.is_queued(job_id):
+                continue
+            self._shown[job_id] = position
+            await self._edit(
+                payload["chat_id"], payload["message_id"],
+                f"⏳ Сейчас много желающих заглянуть в будущее.\nТвоё место в очереди: {position}"
+            )
+        alive = {job_id for job_id, _ in queued}
+        for job_id in [j for j in self._shown if j not in alive]:
+            del self._shown[job_id]
+
+
+pool: Optional[GenerationPool] = None
+
+metrics.Gauge("generation_queue_depth", "Генерации, ждущие в очереди",
+              func=lambda: pool.store.depth() if pool else 0)
+metrics.Gauge("generation_active", "Генерации, выполняющиеся сейчас",
+              func=lambda: pool.active if pool else 0)
+
+
+def create_pool() -> GenerationPool:
+    """Создаёт пул процесса (воркеры запускаются в start)"""
+    global pool
+    pool = GenerationPool(JobStore(JOBS_DB_PATH))
+    return pool
+
+
+async def submit(user_id: int, placeholder: Message, prompt: str, system_prompt: Optional[str] = None,
+                 header: str = "", reply_markup: Optional[InlineKeyboardMarkup] = None,
+                 parse_mode: Optional[str] = None, fallback: Optional[str] = None,
+                 fallback_timeout: Optional[float] = None, image: Optional[bytes] = None,
+                 stream: bool = True, on_done: Optional[Tuple[str, dict]] = None,
+                 stale_key: Optional[str] = None, local: Optional[str] = None) -> bool:
+    """
+    Ставит генерацию в очередь. Ответ появится в placeholder: потоком (stream=True)
+    или целиком. on_done - (имя действия из hook(), параметры) для готового текста.
+    Если API недоступен или медлит, отвечаем без него: последним удачным ответом
+    по stale_key, текстом fallback (корпус) или local (шаблон).
+    """
+    payload = {
+        "prompt": prompt,
+        "system_prompt": system_prompt,
+        "header": header,
+        "reply_markup": reply_markup.to_dict() if reply_markup else None,
+        "parse_mode": parse_mode,
+        "fallback": fallback,
+        "fallback_timeout": fallback_timeout,
+        "image": base64.b64encode(image).decode() if image else None,
+        "stream": stream,
+        "on_done": list(on_done) if on_done else None,
+        "stale_key": stale_key,
+        "local": local,
+        "trace": tracing.context(),
+    }
+    return await pool.submit(user_id, placeholder, payload)
@@ -0,0 +1,230 @@
+"""
+Модуль гороскопов: общий кэш на день/неделю и его фоновый прогрев.
+
+Кэш лежит в SQLite и общий для всех воркеров: гороскоп, сгенерированный одним
+процессом, сразу отдают и остальные. Прогрев ведёт один процесс (в многопроцессном
+режиме - воркер 0), иначе после полуночи каждый воркер сгенерировал бы все
+гороскопы сам.
+"""
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from datetime import datetime, date, timedelta, time as dtime
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import llm
+import metrics
+import admission
+import prompts
+import degraded
+
+logger = logging.getLogger(__name__)
+
+ZODIAC_SIGNS = [
+    "Овен", "Телец", "Близнецы", "Рак", "Лев", "Дева",
+    "Весы", "Скорпион", "Стрелец", "Козерог", "Водолей", "Рыбы"
+]
+
+TIMEZONE = ZoneInfo(os.getenv('BOT_TIMEZONE', 'Europe/Moscow'))
+# Во сколько (после полуночи) заново генерировать гороскопы
+WARMUP_TIME = dtime(0, 5, tzinfo=TIMEZONE)
+WARMUP_ENABLED = os.getenv('HOROSCOPE_WARMUP', '1') == '1'
+HOROSCOPE_DB_PATH = os.getenv('HOROSCOPE_DB_PATH', 'horoscopes.db')
+
+
+def today() -> date:
+    """Текущая дата в часовом поясе бота"""
+    return datetime.now(TIMEZONE).date()
+
+
+def week_start(day: date) -> date:
+    """Понедельник недели, в которую входит дата"""
+    return day - timedelta(days=day.weekday())
+
+
+def daily_prompt(sign: str, day: date) -> Tuple[str, str]:
+    """Запрос и системный промпт для гороскопа знака на день"""
+    return prompts.HOROSCOPE_DAILY.render(sign=sign, day=day.strftime('%d.%m.%Y'))
+
+
+def weekly_prompt(day: date) -> Tuple[str, str]:
+    """Запрос и системный промпт для общего гороскопа на неделю"""
+    monday = week_start(day)
+    sunday = monday + timedelta(days=6)
+    return prompts.HOROSCOPE_WEEKLY.render(
+        monday=monday.strftime('%d.%m.%Y'), sunday=sunday.strftime('%d.%m.%Y')
+    )
+
+
+def stale_key(sign: Optional[str] = None) -> str:
+    """Ключ последнего удачного гороскопа знака (без знака - недельного) для деградированного режима"""
+    return f"horoscope_daily:{sign}" if sign else "horoscope_weekly"
+
+
+def _end_of(day: date) -> float:
+    """Момент окончания дня (полночь следующего дня) как unix-время"""
+    midnight = datetime.combine(day + timedelta(days=1), dtime(0), tzinfo=TIMEZONE)
+    return midnight.timestamp()
+
+
+class HoroscopeStore:
+    """Кэш гороскопов: ключ (знак, дата) или (неделя), с TTL (SQLite WAL, общий для процессов)"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS horoscopes ("
+            "  key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL"
+            ")"
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(key: tuple) -> str:
+        return "|".join(str(part) for part in key)
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT text FROM horoscopes WHERE key = ? AND expires_at > ?",
+                (self._key(key), time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: tuple, text: str, expires_at: float):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO horoscopes (key, text, expires_at) VALUES (?, ?, ?)",
+                (self._key(key), text, expires_at)
+            )
+
+    def purge(self):
+        """Удаляет устаревшие записи"""
+        with self._lock:
+            self.db.execute("DELETE FROM horoscopes WHERE expires_at <= ?", (time.time(),))
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    # Удобные обёртки над ключами
+
+    def get_daily(self, sign: str, day: date = None) -> Optional[str]:
+        text = self.get(("day", sign, day or today()))
+        metrics.cache_result("horoscope_day", text is not None)
+        return text
+
+    def put_daily(self, sign: str, text: str, day: date = None):
+        day = day or today()
+        self.put(("day", sign, day), text, _end_of(day))
+
+    def get_weekly(self, day: date = None) -> Optional[str]:
+        text = self.get(("week", week_start(day or today())))
+        metrics.cache_result("horoscope_week", text is not None)
+        return text
+
+    def put_weekly(self, text: str, day: date = None):
+        monday = week_start(day or today())
+        self.put(("week", monday), text, _end_of(monday + timedelta(days=6)))
+
+    def get_card_of_day(self, index: int, reversed: bool, day: date = None) -> Optional[str]:
+        """Толкование карты дня: одно на карту и день, общее для всех пользователей"""
+        text = self.get(("card", index, reversed, day or today()))
+        metrics.cache_result("tarot_day", text is not None)
+        return text
+
+    def put_card_of_day(self, index: int, reversed: bool, text: str, day: date = None):
+        day = day or today()
+        self.put(("card", index, reversed, day), text, _end_of(day))
+
+
+_store: Optional[HoroscopeStore] = None
+
+
+def get_store() -> HoroscopeStore:
+    global _store
+    if _store is None:
+        _store = HoroscopeStore(HOROSCOPE_DB_PATH)
+    return _store
+
+
+def is_cacheable(text: str) -> bool:
+    """Сообщения об ошибке не кэшируем"""
+    return bool(text) and text != llm.ERROR_MESSAGE
+
+
+async def _generate_daily(sign: str, day: date) -> str:
+    async with admission.background_slot():
+        response = await llm.complete(*daily_prompt(sign, day))
+    text = response.choices[0].message.content
+    get_store().put_daily(sign, text, day)
+    degraded.stale.remember(stale_key(sign), text)
+    return text
+
+
+async def daily(sign: str, day: date = None) -> str:
+    """Гороскоп на день из кэша, при промахе - сгенерированный в фоне"""
+    day = day or today()
+    cached = get_store().get_daily(sign, day)
+    if cached is not None:
+        return cached
+    try:
+        return await _generate_daily(sign, day)
+    except Exception as e:
+        logger.error(f"Ошибка генерации гороскопа для {sign}: {e}")
+        return llm.ERROR_MESSAGE
+
+
+async def _generate_weekly(day: date):
+    async with admission.background_slot():
+        response = await llm.complete(*weekly_prompt(day))
+    text = response.choices[0].message.content
+    get_store().put_weekly(text, day)
+    degraded.stale.remember(stale_key(), text)
+
+
+async def warm(day: date = None):
+    """Генерирует все недостающие гороскопы на день и неделю"""
+    day = day or today()
+    store = get_store()
+    store.purge()
+
+    tasks = [_generate_daily(sign, day) for sign in ZODIAC_SIGNS
+             if store.get_daily(sign, day) is None]
+    if store.get_weekly(day) is None:
+        tasks.append(_generate_weekly(day))
+    if not tasks:
+        return
+
+    started = time.monotonic()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = [r for r in results if isinstance(r, Exception)]
+    for error in failed:
+        logger.error(f"Ошибка прогрева гороскопа: {error}")
+    logger.info(
+        f"Гороскопы на {day.strftime('%d.%m.%Y')} прогреты: "
+        f"{len(tasks) - len(failed)}/{len(tasks)} за {time.monotonic() - started:.1f} с"
+    )
+
+
+async def warm_job(context):
+    """Задача JobQueue для прогрева кэша"""
+    await warm()
+
+
+def schedule(application):
+    """Регистрирует ежедневный прогрев кэша и прогрев при старте (в одном процессе)"""
+    if not WARMUP_ENABLED:
+        return
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна, гороскопы будут генерироваться по запросу")
+        return
+    application.job_queue.run_daily(warm_job, time=WARMUP_TIME, name="horoscope_warmup")
+    application.job_queue.run_once(warm_job, when=1, name="horoscope_warmup_start")
@@ -0,0 +1,446 @@
+"""
+Модуль работы с DeepSeek API
+"""
+import os
+import asyncio
+import json
+import base64
+import random
+import time
+import hashlib
+import logging
+import threading
+from typing import Optional, AsyncIterator, Callable, Awaitable, Dict, List
+
+from dotenv import load_dotenv
+
+import metrics
+import prompts
+import degraded
+import tracing
+from router import Endpoint, NoEndpointAvailable, Router, load_endpoints
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Настройки клиента (можно переопределить через переменные окружения)
+DEEPSEEK_BASE_URL = os.getenv('DEEPSEEK_BASE_URL', 'https://api.deepseek.com')
+DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
+# Модель, принимающая изображения (OpenAI-совместимый формат image_url).
+# Если не задана, картинки в запрос не передаются - только текст.
+VISION_MODEL = os.getenv('DEEPSEEK_VISION_MODEL')
+MAX_CONCURRENCY = int(os.getenv('DEEPSEEK_MAX_CONCURRENCY', '32'))
+POOL_SIZE = int(os.getenv('DEEPSEEK_POOL_SIZE', '64'))
+REQUEST_TIMEOUT = float(os.getenv('DEEPSEEK_TIMEOUT', '60'))
+MAX_RETRIES = int(os.getenv('DEEPSEEK_MAX_RETRIES', '3'))
+SINGLE_FLIGHT = os.getenv('DEEPSEEK_SINGLE_FLIGHT', '1') == '1'
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+
+ERROR_MESSAGE = "Извините, произошла ошибка при обращении к магическим силам. Попробуйте позже."
+
+# Ошибки, после которых имеет смысл повторить запрос (ошибки openai добавляет get_router)
+RETRYABLE_ERRORS: tuple = (NoEndpointAvailable,)
+
+# ============= КЛИЕНТЫ API =============
+# openai импортируется ~0.4 с, поэтому клиенты создаются при первом запросе
+# (или при прогреве после запуска бота, см. startup.py), а не при импорте модуля
+
+http_client = None
+deepseek_client = None
+router: Optional[Router] = None
+_clients_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    """Маршрутизатор запросов; при первом вызове создаёт пул соединений и клиентов"""
+    global http_client, deepseek_client, router, RETRYABLE_ERRORS
+    if router is not None:
+        return router
+    with _clients_lock:
+        if router is not None:
+            return router
+        import httpx
+        from openai import AsyncOpenAI, APIConnectionError, RateLimitError, InternalServerError
+
+        # Общий пул keep-alive соединений для всех запросов
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=POOL_SIZE,
+                max_keepalive_connections=POOL_SIZE,
+                keepalive_expiry=30
+            ),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0)
+        )
+
+        # Повторы делаем сами (с джиттером), поэтому встроенные отключены
+        deepseek_client = AsyncOpenAI(
+            api_key=os.getenv('DEEPSEEK_API_KEY'),
+            base_url=DEEPSEEK_BASE_URL,
+            http_client=http_client,
+            max_retries=0
+        )
+
+        RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError, NoEndpointAvailable)
+        # DeepSeek - основной API; дополнительные (LLM_ENDPOINTS) подключаются при медленных ответах и ошибках
+        router = Router(
+            [Endpoint("deepseek", deepseek_client, DEEPSEEK_MODEL, vision_model=VISION_MODEL)]
+            + load_endpoints(http_client)
+        )
+        logger.info("Клиенты API созданы")
+        return router
+
+
+# Ограничение числа одновременных запросов к API
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Задержка перед повтором: экспонента с полным джиттером"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def build_messages(prompt: str, system_prompt: Optional[str] = None,
+                   image: Optional[bytes] = None) -> list:
+    """Собирает список сообщений для chat completions (картинка - JPEG)"""
+    messages = []
+
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+
+    if image:
+        url = "data:image/jpeg;base64," + base64.b64encode(image).decode()
+        messages.append({"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": url}},
+        ]})
+    else:
+        messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def request_key(prompt: str, system_prompt: Optional[str], **params) -> str:
+    """Хэш запроса: одинаковые промпты с одинаковыми параметрами дают один ключ"""
+    payload = json.dumps(
+        [system_prompt, prompt, DEEPSEEK_MODEL, sorted(params.items())],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SingleFlight:
+    """Объединяет одинаковые одновременные запросы в один вызов API"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.shared = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            metrics.cache_result("singleflight", False)
+        else:
+            self.shared += 1
+            metrics.cache_result("singleflight", True)
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Future):
+        self._calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class SharedStream:
+    """Поток фрагментов от одного запроса, который могут читать несколько получателей"""
+
+    def __init__(self, source: AsyncIterator[str]):
+        self.chunks: List[str] = []
+        self.done = False
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator[str]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._wake()
+        finally:
+            self.done = True
+            self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def iterate(self) -> AsyncIterator[str]:
+        """Отдаёт все фрагменты с начала, затем новые по мере поступления"""
+        i = 0
+        while True:
+            if i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            elif self.done:
+                return
+            else:
+                await self._changed.wait()
+
+
+_flight = SingleFlight()
+_streams: Dict[str, SharedStream] = {}
+
+
+async def complete(prompt: str, system_prompt: Optional[str] = None,
+                   timeout: Optional[float] = None,
+                   temperature: float = 0.9, max_tokens: int = 1500,
+                   image: Optional[bytes] = None):
+    """
+    Выполняет запрос к DeepSeek с ограничением параллелизма и повторами.
+    Одинаковые одновременные запросы объединяются в один.
+    Картинка передаётся, только если настроена VISION_MODEL.
+    Возвращает объект ответа API, исключения пробрасывает наружу.
+    В деградированном режиме сразу бросает degraded.CircuitOpen.
+    """
+    with tracing.span("llm.complete", image=bool(image)):
+        if degraded.is_open():
+            raise degraded.CircuitOpen("API недоступен, запрос не отправлен")
+        if not VISION_MODEL:
+            image = None
+
+        def call():
+            return _complete_upstream(prompt, system_prompt, timeout, temperature, max_tokens, image)
+
+        if not SINGLE_FLIGHT:
+            return await call()
+        key = request_key(
+            prompt, system_prompt, temperature=temperature, max_tokens=max_tokens,
+            image=hashlib.sha256(image).hexdigest() if image else None
+        )
+        return await _flight.do(key, call)
+
+
+async def _complete_upstream(prompt: str, system_prompt: Optional[str],
+                             timeout: Optional[float], temperature: float, max_tokens: int,
+                             image: Optional[bytes] = None):
+    """Один запрос к API (с повторами)"""
+    messages = build_messages(prompt, system_prompt, image)
+    timeout = timeout or REQUEST_TIMEOUT
+    router = get_router()
+    started = time.perf_counter()
+    outcome = "error"
+
+    def create(endpoint: Endpoint):
+        return endpoint.client.chat.completions.create(
+            model=endpoint.vision_model if image else endpoint.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout
+        )
+
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with _semaphore:
+                    # SLO - про сам API: ожидание семафора и паузы между повторами не в счёт
+                    attempt_started = time.perf_counter()
+                    metrics.llm_in_flight.inc()
+                    try:
+                        response = await router.call("complete", create, vision=bool(image))
+                    finally:
+                        metrics.llm_in_flight.dec()
+                metrics.record_usage(response.usage, prompts.name_for(system_prompt))
+                degraded.record(time.perf_counter() - attempt_started, degraded.COMPLETE_SLO)
+                outcome = "ok"
+                return response
+            except Exception as e:
+                metrics.llm_errors_total.inc("complete", type(e).__name__)
+                if isinstance(e, RETRYABLE_ERRORS):
+                    degraded.record(None)
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt == MAX_RETRIES:
+                    raise
+                metrics.llm_retries_total.inc("complete")
+                delay = backoff_delay(attempt)
+                logger.warning(f"DeepSeek: попытка {attempt + 1} не удалась ({e}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+    finally:
+        metrics.llm_request_seconds.observe(time.perf_counter() - started, "complete", outcome)
+
+
+async def ask_deepseek(prompt: str, system_prompt: str = None, timeout: float = None,
+                       image: bytes = None) -> str:
+    """
+    Отправляет запрос к DeepSeek API
+    """
+    try:
+        response = await complete(prompt, system_prompt, timeout=timeout, image=image)
+        return response.choices[0].message.content
+    except degraded.CircuitOpen:
+        return ERROR_MESSAGE
+    except Exception as e:
+        logger.error(f"Ошибка при обращении к DeepSeek API: {e}")
+        return ERROR_MESSAGE
+
+
+def stream_deepseek(prompt: str, system_prompt: str = None,
+                    timeout: float = None) -> AsyncIterator[str]:
+    """
+    Потоковый запрос к DeepSeek API: отдаёт фрагменты текста по мере генерации.
+    Одинаковые одновременные запросы читают один общий поток.
+    """
+    return tracing.stream("llm.stream", _stream_deepseek(prompt, system_prompt, timeout))
+
+
+async def _stream_deepseek(prompt: str, system_prompt: Optional[str],
+                           timeout: Optional[float]) -> AsyncIterator[str]:
+    if degraded.is_open():
+        yield ERROR_MESSAGE
+        return
+    if not SINGLE_FLIGHT:
+        async for chunk in _stream_upstream(prompt, system_prompt, timeout):
+            yield chunk
+        return
+
+    key = request_key(prompt, system_prompt, temperature=0.9, max_tokens=1500, stream=True)
+    shared = _streams.get(key)
+    if shared is None:
+        shared = SharedStream(_stream_upstream(prompt, system_prompt, timeout))
+        _streams[key] = shared
+        shared.task.add_done_callback(lambda _: _streams.pop(key, None))
+        metrics.cache_result("singleflight", False)
+    else:
+        _flight.shared += 1
+        metrics.cache_result("singleflight", True)
+
+    async for chunk in shared.iterate():
+        yield chunk
+
+
+async def _stream_upstream(prompt: str, system_prompt: Optional[str],
+                           timeout: Optional[float]) -> AsyncIterator[str]:
+    """
+    Один потоковый запрос к API.
+    Повтор возможен только пока не получено ни одного фрагмента.
+    """
+    messages = build_messages(prompt, system_prompt)
+    timeout = timeout or REQUEST_TIMEOUT
+    router = get_router()
+    yielded = False
+    started = time.perf_counter()
+    outcome = "error"
+
+    async def open_stream(endpoint: Endpoint):
+        """Открывает поток и дожидается первого фрагмента (по нему и хеджируем)"""
+        stream = await endpoint.client.chat.completions.create(
+            model=endpoint.model,
+            messages=messages,
+            temperature=0.9,
+            max_tokens=1500,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout
+        )
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.close()
+            raise
+        return endpoint, stream, first
+
+    async def discard(opened):
+        await opened[1].close()
+
+    for attempt in range(MAX_RETRIES + 1):
+        # Начало попытки (после семафора): от него считается SLO первого фрагмента
+        attempt_started = None
+        try:
+            async with _semaphore:
+                attempt_started = time.perf_counter()
+                metrics.llm_in_flight.inc()
+                try:
+                    endpoint, stream, first = await router.call("stream", open_stream, discard)
+                    async with stream:
+                        chunk = first
+                        while chunk is not None:
+                            # Последний фрагмент несёт usage и пустой choices
+                            metrics.record_usage(chunk.usage, prompts.name_for(system_prompt))
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                if not yielded:
+                                    now = time.perf_counter()
+                                    metrics.llm_first_token_seconds.observe(now - started)
+                                    degraded.record(now - attempt_started, degraded.FIRST_TOKEN_SLO)
+                                yielded = True
+                                yield chunk.choices[0].delta.content
+                            try:
+                                chunk = await stream.__anext__()
+                            except StopAsyncIteration:
+                                chunk = None
+                            except Exception:
+                                # Обрыв посреди ответа - тоже признак нездоровья API
+                                endpoint.record_failure()
+                                raise
+                finally:
+                    metrics.llm_in_flight.dec()
+            outcome = "ok"
+            break
+        except RETRYABLE_ERRORS as e:
+            metrics.llm_errors_total.inc("stream", type(e).__name__)
+            if not yielded:
+                degraded.record(None)
+            if yielded or attempt == MAX_RETRIES:
+                logger.error(f"Ошибка при потоковом обращении к DeepSeek API: {e}")
+                break
+            metrics.llm_retries_total.inc("stream")
+            delay = backoff_delay(attempt)
+            logger.warning(f"DeepSeek: попытка {attempt + 1} не удалась ({e}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+        except (asyncio.CancelledError, GeneratorExit):
+            # Получатель перестал ждать (например, ответил запасным текстом): долгое
+            # ожидание первого фрагмента всё равно нарушает SLO
+            if not yielded and attempt_started is not None:
+                elapsed = time.perf_counter() - attempt_started
+                if elapsed > degraded.FIRST_TOKEN_SLO:
+                    degraded.record(elapsed, degraded.FIRST_TOKEN_SLO)
+            raise
+        except Exception as e:
+            metrics.llm_errors_total.inc("stream", type(e).__name__)
+            logger.error(f"Ошибка при потоковом обращении к DeepSeek API: {e}")
+            break
+
+    metrics.llm_request_seconds.observe(time.perf_counter() - started, "stream", outcome)
+    if not yielded:
+        yield ERROR_MESSAGE
+
+
+async def probe(timeout: float) -> float:
+    """
+    Короткий запрос мимо семафора, повторов и объединения: отвечает ли API.
+    Возвращает задержку, ошибки пробрасывает.
+    """
+    started = time.perf_counter()
+
+    def create(endpoint: Endpoint):
+        return endpoint.client.chat.completions.create(
+            model=endpoint.model,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+            timeout=timeout
+        )
+
+    await get_router().call("probe", create)
+    return time.perf_counter() - started
+
+
+async def close():
+    """Закрывает пул соединений (общий для всех API), если он создавался"""
+    if http_client is not None:
+        await http_client.aclose()
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота.
+
+Поднимает локальную заглушку, которая изображает и DeepSeek API
+(OpenAI-совместимый /v1/chat/completions), и Telegram Bot API, направляет
+на неё настоящее Application из bot.py и подаёт синтетические апдейты
+с заданной интенсивностью. В конце печатает пропускную способность и
+p50/p95/p99 задержки по каждому маршруту.
+
+    python loadtest.py run --rate 50 --duration 30 --latency 0.5 --tps 80
+    python loadtest.py stub --port 8900     # только заглушка
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import tornado.web
+
+# Слова для «генерации» заглушки
+WORDS = (
+    "звёзды луна судьба путь карта знак тайна свет тень огонь вода ветер "
+    "перемены встреча надежда сила время сердце дорога выбор удача"
+).split()
+
+
+class StubConfig:
+    """Параметры поведения заглушки"""
+
+    def __init__(self, latency: float = 0.5, tps: float = 80.0, tokens: int = 300,
+                 error_rate: float = 0.0):
+        self.latency = latency
+        self.tps = tps
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.calls: Dict[str, int] = defaultdict(int)
+        # Системные промпты, уже попавшие в «кэш префикса»
+        self.prefixes: set = set()
+        # chat_id -> момент последнего сообщения с клавиатурой (итоговый ответ)
+        self.delivered: Dict[int, float] = {}
+
+
+# ============= ЗАГЛУШКА DEEPSEEK =============
+
+class ChatCompletionsHandler(tornado.web.RequestHandler):
+    """OpenAI-совместимый /v1/chat/completions с настраиваемой задержкой"""
+
+    def initialize(self, config: StubConfig):
+        self.config = config
+
+    def _chunk(self, content: str = None, finish: str = None) -> str:
+        delta = {"content": content} if content is not None else {}
+        return json.dumps({
+            "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": "deepseek-chat",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+        }, ensure_ascii=False)
+
+    async def post(self):
+        config = self.config
+        config.calls["llm"] += 1
+        body = json.loads(self.request.body)
+        prompt_tokens = sum(len(m["content"]) // 4 for m in body["messages"])
+
+        await asyncio.sleep(random.expovariate(1 / config.latency) if config.latency else 0)
+        if random.random() < config.error_rate:
+            config.calls["llm_errors"] += 1
+            self.set_status(random.choice([429, 500, 503]))
+            self.write({"error": {"message": "stub error", "type": "server_error"}})
+            return
+
+        words = [random.choice(WORDS) for _ in range(min(config.tokens, body.get("max_tokens", 1500)))]
+        # Кэш префикса как у DeepSeek: самое длинное общее начало с уже виденными
+        # системными промптами, блоками по 64 токена
+        system = next((m["content"] for m in body["messages"] if m["role"] == "system"), "")
+        common = max((len(os.path.commonprefix([system, seen])) for seen in config.prefixes), default=0)
+        cache_hit = common // 4 // 64 * 64
+        config.prefixes.add(system)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": prompt_tokens + len(words),
+            "prompt_cache_hit_tokens": cache_hit,
+            "prompt_cache_miss_tokens": prompt_tokens - cache_hit,
+        }
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(words) / config.tps)
+            self.write({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()),
+                "model": "deepseek-chat",
+                "choices": [{
+                    "index": 0, "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                }],
+                "usage": usage,
+            })
+            return
+
+        self.set_header("Content-Type", "text/event-stream")
+        for word in words:
+            self.write(f"data: {self._chunk(word + ' ')}\n\n")
+            await self.flush()
+            await asyncio.sleep(1 / config.tps)
+        self.write(f"data: {self._chunk(finish='stop')}\n\n")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.write(f"data: {json.dumps(dict(json.loads(self._chunk()), choices=[], usage=usage))}\n\n")
+        self.write("data: [DONE]\n\n")
+
+
+# ============= ЗАГЛУШКА TELEGRAM BOT API =============
+
+def _jpeg() -> bytes:
+    """Небольшая картинка для «фото ладони»"""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 170, 150)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    """Минимальная реализация методов Bot API, которые вызывает бот"""
+
+    message_ids = itertools.count(1000)
+
+    def initialize(self, config: StubConfig):
+        self.config = config
+
+    def _params(self) -> dict:
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.request.body or b"{}")
+        return {k: v[0].decode() for k, v in self.request.body_arguments.items()}
+
+    def _message(self, params: dict, message_id: int = None) -> dict:
+        chat_id = int(params.get("chat_id", 1))
+        return {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def post(self, token: str, method: str):
+        self.config.calls[f"tg.{method}"] += 1
+        params = self._params()
+        method = method.lower()
+        if method in ("sendmessage", "editmessagetext") and params.get("reply_markup"):
+            self.config.delivered[int(params.get("chat_id", 1))] = time.perf_counter()
+
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method == "sendmessage":
+            result = self._message(params)
+        elif method == "editmessagetext":
+            result = self._message(params, int(params.get("message_id", 1)))
+        elif method == "getfile":
+            result = {"file_id": params.get("file_id"), "file_unique_id": "stub",
+                      "file_size": len(STUB_JPEG), "file_path": "photos/palm.jpg"}
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+
+class FileHandler(tornado.web.RequestHandler):
+    """Скачивание файлов (фото ладони)"""
+
+    def get(self, token: str, path: str):
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(STUB_JPEG)
+
+
+STUB_JPEG = b""
+
+
+def make_stub(config: StubConfig) -> tornado.web.Application:
+    global STUB_JPEG
+    STUB_JPEG = _jpeg()
+    return tornado.web.Application([
+        (r"/v1/chat/completions", ChatCompletionsHandler, {"config": config}),
+        (r"/bot([^/]+)/(\w+)", BotApiHandler, {"config": config}),
+        (r"/file/bot([^/]+)/(.+)", FileHandler),
+    ])
+
+
+# ============= СИНТЕТИЧЕСКИЕ АПДЕЙТЫ =============
+
+CALLBACK_ROUTES = [
+    "tarot", "astrology", "palmistry", "prediction", "help", "back_main",
+    "tarot_day", "tarot_three", "tarot_love", "tarot_yesno",
+    "horoscope_today", "horoscope_week", "natal_chart",
+]
+
+# Вопросы для предсказаний: одни и те же по смыслу, но записанные по-разному
+QUESTIONS = [
+    "Выйду ли я замуж в этом году?", "выйду ли замуж в этом году", "Я выйду замуж в этом году???",
+    "Найду ли я работу?", "найду ли работу", "Стоит ли мне переезжать?", "стоит ли переезжать",
+    "Будут ли у меня деньги?", "будут ли деньги",
+]
+
+# Сценарии: последовательность (маршрут, апдейт) для одного пользователя
+SCENARIOS = {
+    "menu": [("callback", "tarot"), ("callback", "back_main")],
+    "tarot_day": [("callback", "tarot_day")],
+    "tarot_three": [("callback", "tarot_three")],
+    "tarot_love": [("callback", "tarot_love")],
+    "tarot_yesno": [("callback", "tarot_yesno")],
+    "horoscope_week": [("callback", "horoscope_week")],
+    "zodiac": [("callback", "horoscope_today"), ("text", "Лев")],
+    "natal": [("callback", "natal_chart"),
+              ("text", lambda: f"{random.randint(1, 28):02d}.{random.randint(1, 12):02d}.{random.randint(1950, 2005)}")],
+    "prediction": [("callback", "prediction"), ("text", lambda: random.choice(QUESTIONS))],
+    "palm_photo": [("callback", "palmistry"), ("photo", None)],
+    "palm_text": [("callback", "palmistry"), ("text", "Линия жизни длинная, линия сердца прерывистая")],
+}
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def make_update(kind: str, payload, user_id: int) -> dict:
+    """Словарь апдейта в формате Bot API"""
+    chat = {"id": user_id, "type": "private"}
+    message = {"message_id": random.randint(1, 10**6), "date": int(time.time()),
+               "chat": chat, "from": _user(user_id)}
+
+    if kind == "callback":
+        return {
+            "update_id": next(_update_ids),
+            "callback_query": {
+                "id": str(random.getrandbits(48)), "from": _user(user_id),
+                "chat_instance": str(user_id), "data": payload,
+                "message": dict(message, text="🔮 Меню", **{"from": _user(1)}),
+            },
+        }
+    if kind == "photo":
+        message["photo"] = [
+            {"file_id": f"p{size}", "file_unique_id": f"u{user_id}_{size}", "width": size,
+             "height": size * 3 // 4, "file_size": size * size // 10}
+            for size in (90, 320, 800, 1280)
+        ]
+    else:
+        message["text"] = payload
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def route_name(kind: str, payload, scenario: str) -> str:
+    if kind == "callback":
+        return payload
+    return f"{kind}:{scenario}"
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+# ============= ПРОГОН =============
+
+async def run(args):
+    config = StubConfig(args.latency, args.tps, args.tokens, args.error_rate)
+    stub = make_stub(config).listen(args.port, "127.0.0.1")
+    stub_url = f"http://127.0.0.1:{args.port}"
+
+    # Окружение должно быть готово до импорта bot (клиенты читают его при импорте)
+    os.environ.update({
+        "DEEPSEEK_BASE_URL": f"{stub_url}/v1",
+        "DEEPSEEK_API_KEY": "stub",
+        "TELEGRAM_BASE_URL": stub_url,
+        "STATE_BACKEND": "memory",
+        "NATAL_DB_PATH": os.environ.get("NATAL_DB_PATH", ":memory:"),
+        "HOROSCOPE_WARMUP": "1" if args.warm else "0",
+        "TAROT_CORPUS_MODE": os.environ.get("TAROT_CORPUS_MODE", "off"),
+        "ADMISSION_USER_RATE": "1000",
+        "STREAM_EDIT_INTERVAL": str(args.edit_interval),
+        "JOBS_DB_PATH": ":memory:",
+        "SUBSCRIPTIONS_DB_PATH": ":memory:",
+        "HOROSCOPE_DB_PATH": ":memory:",
+    })
+    import logging
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    application = bot.build_application("123:stub")
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    # Время до итогового ответа: генерации идут в фоне, после обработки апдейта
+    answers: Dict[str, List[float]] = defaultdict(list)
+    last_step: Dict[int, Tuple[str, float]] = {}
+    scenarios = [name for name in SCENARIOS if not args.only or name in args.only]
+    tasks = []
+
+    async def play(scenario: str, user_id: int):
+        for kind, payload in SCENARIOS[scenario]:
+            if callable(payload):
+                payload = payload()
+            update = bot.Update.de_json(make_update(kind, payload, user_id), application.bot)
+            route = route_name(kind, payload, scenario)
+            started = time.perf_counter()
+            try:
+                await application.update_processor.process_update(
+                    update, application.process_update(update)
+                )
+            except Exception:
+                errors[route] += 1
+            latencies[route].append(time.perf_counter() - started)
+        last_step[user_id] = (scenario, started)
+
+    print(f"Подача {args.rate} сценариев/с в течение {args.duration} с, сценарии: {', '.join(scenarios)}")
+    started = time.perf_counter()
+    user_ids = itertools.count(10**6)
+    while time.perf_counter() - started < args.duration:
+        tasks.append(asyncio.create_task(play(random.choice(scenarios), next(user_ids))))
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    await bot.generation.pool.drain()
+    elapsed = time.perf_counter() - started
+
+    for user_id, (scenario, step_started) in last_step.items():
+        if user_id in config.delivered:
+            answers[scenario].append(config.delivered[user_id] - step_started)
+
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    stub.stop()
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"\nОбработано апдейтов: {total} за {elapsed:.1f} с ({total / elapsed:.1f} апд/с)\n")
+    print(f"{'маршрут':<22}{'кол-во':>8}{'ошибки':>8}{'p50, с':>9}{'p95, с':>9}{'p99, с':>9}")
+    for route in sorted(latencies):
+        values = latencies[route]
+        print(f"{route:<22}{len(values):>8}{errors[route]:>8}"
+              f"{percentile(values, 50):>9.2f}{percentile(values, 95):>9.2f}{percentile(values, 99):>9.2f}")
+    print(f"\n{'ответ (сценарий)':<22}{'кол-во':>8}{'':>8}{'p50, с':>9}{'p95, с':>9}{'p99, с':>9}")
+    for scenario in sorted(answers):
+        values = answers[scenario]
+        print(f"{scenario:<22}{len(values):>8}{'':>8}"
+              f"{percentile(values, 50):>9.2f}{percentile(values, 95):>9.2f}{percentile(values, 99):>9.2f}")
+    print("\nВызовы заглушки: " + ", ".join(f"{k}={v}" for k, v in sorted(config.calls.items())))
+
+    cache = {}
+    for name in sorted(bot.prompts.TEMPLATES):
+        hit = bot.metrics.llm_prompt_cache_tokens_total.value(name, "hit")
+        miss = bot.metrics.llm_prompt_cache_tokens_total.value(name, "miss")
+        if hit + miss:
+            cache[name] = hit / (hit + miss)
+    if cache:
+        print("Кэш префикса (доля токенов промпта): "
+              + ", ".join(f"{name} {share:.0%}" for name, share in cache.items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "throughput": total / elapsed,
+                "routes": {
+                    route: {
+                        "count": len(values), "errors": errors[route],
+                        "p50": percentile(values, 50), "p95": percentile(values, 95),
+                        "p99": percentile(values, 99),
+                    } for route, values in latencies.items()
+                },
+                "answers": {
+                    scenario: {
+                        "count": len(values), "p50": percentile(values, 50),
+                        "p95": percentile(values, 95), "p99": percentile(values, 99),
+                    } for scenario, values in answers.items()
+                },
+                "stub_calls": dict(config.calls),
+                "prompt_cache": cache,
+            }, f, ensure_ascii=False, indent=2)
+
+
+async def run_stub(args):
+    config = StubConfig(args.latency, args.tps, args.tokens, args.error_rate)
+    make_stub(config).listen(args.port, "0.0.0.0")
+    print(f"Заглушка слушает порт {args.port}: DEEPSEEK_BASE_URL=http://127.0.0.1:{args.port}/v1, "
+          f"TELEGRAM_BASE_URL=http://127.0.0.1:{args.port}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("run", "stub"):
+        p = sub.add_parser(name)
+        p.add_argument("--port", type=int, default=8900)
+        p.add_argument("--latency", type=float, default=0.5, help="средняя задержка до первого токена, с")
+        p.add_argument("--tps", type=float, default=80.0, help="скорость генерации, токенов/с")
+        p.add_argument("--tokens", type=int, default=300, help="длина ответа, токенов")
+        p.add_argument("--error-rate", type=float, default=0.0, help="доля ответов с ошибкой")
+        if name == "run":
+            p.add_argument("--rate", type=float, default=20.0, help="новых сценариев в секунду")
+            p.add_argument("--duration", type=float, default=30.0, help="длительность подачи, с")
+            p.add_argument("--only", nargs="+", choices=list(SCENARIOS), help="только эти сценарии")
+            p.add_argument("--edit-interval", type=float, default=1.0, help="STREAM_EDIT_INTERVAL")
+            p.add_argument("--warm", action="store_true", help="прогревать кэш гороскопов")
+            p.add_argument("--json", help="сохранить отчёт в файл")
+
+    args = parser.parse_args()
+    asyncio.run(run(args) if args.command == "run" else run_stub(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
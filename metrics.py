@@ -0,0 +1,260 @@
+"""
+Метрики в формате Prometheus: счётчики, гистограммы задержек и HTTP-эндпоинт /metrics.
+
+Без внешних зависимостей: запись метрики - пара обращений к словарю,
+поэтому инструментирование можно держать включённым в продакшене.
+"""
+import os
+import time
+import logging
+import functools
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+# Порт отдельного сервера метрик задаётся METRICS_PORT (публичный сервер webhook
+# метрики не отдаёт)
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+# Больше стольких наборов меток у одной метрики не заводим - остальное идёт в "other"
+MAX_LABEL_SETS = 200
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    """Базовый класс: имя, описание и значения по наборам меток"""
+
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, object] = {}
+        REGISTRY.append(self)
+
+    def _key(self, values: LabelValues) -> LabelValues:
+        if values in self._values or len(self._values) < MAX_LABEL_SETS:
+            return values
+        return ("other",) * len(self.labels)
+
+    def _format_labels(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счётчик"""
+
+    kind = "counter"
+
+    def inc(self, *values: str, amount: float = 1.0):
+        key = self._key(values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *values: str) -> float:
+        return self._values.get(values, 0.0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(k)} {v:g}" for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    """Текущее значение; может вычисляться функцией в момент сбора"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 func: Optional[Callable[[], float]] = None):
+        super().__init__(name, description, labels)
+        self.func = func
+
+    def set(self, value: float, *values: str):
+        self._values[self._key(values)] = value
+
+    def inc(self, *values: str, amount: float = 1.0):
+        key = self._key(values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, *values: str, amount: float = 1.0):
+        self.inc(*values, amount=-amount)
+
+    def samples(self) -> List[str]:
+        if self.func is not None:
+            try:
+                return [f"{self.name} {self.func():g}"]
+            except Exception as e:
+                logger.debug(f"Метрика {self.name} недоступна: {e}")
+                return []
+        return [f"{self.name}{self._format_labels(k)} {v:g}" for k, v in self._values.items()]
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными границами корзин"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *values: str):
+        key = self._key(values)
+        state = self._values.get(key)
+        if state is None:
+            # Счётчики по корзинам (+Inf последней), сумма, количество
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = self._format_labels(key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# ============= МЕТРИКИ БОТА =============
+
+update_seconds = Histogram(
+    "bot_update_seconds", "Время обработки апдейта по маршрутам", ["route"]
+)
+updates_total = Counter(
+    "bot_updates_total", "Обработанные апдейты по маршрутам и результату", ["route", "outcome"]
+)
+llm_request_seconds = Histogram(
+    "llm_request_seconds", "Время запроса к LLM (с повторами)", ["kind", "outcome"]
+)
+llm_first_token_seconds = Histogram(
+    "llm_first_token_seconds", "Время до первого фрагмента потокового ответа"
+)
+llm_errors_total = Counter("llm_errors_total", "Ошибки запросов к LLM по типу", ["kind", "error"])
+llm_retries_total = Counter("llm_retries_total", "Повторы запросов к LLM", ["kind"])
+llm_tokens_total = Counter("llm_tokens_total", "Токены по данным response.usage", ["type"])
+llm_endpoint_seconds = Histogram(
+    "llm_endpoint_seconds", "Задержка отдельного API (для потоков - до первого фрагмента)",
+    ["endpoint", "kind"]
+)
+llm_endpoint_errors_total = Counter("llm_endpoint_errors_total", "Ошибки по API", ["endpoint"])
+llm_endpoint_open = Gauge("llm_endpoint_open", "API выведен из ротации выключателем", ["endpoint"])
+llm_hedges_total = Counter(
+    "llm_hedges_total", "Вторые запросы: slow - хедж медленного, failover - после ошибки", ["reason"]
+)
+llm_prompt_cache_tokens_total = Counter(
+    "llm_prompt_cache_tokens_total", "Токены промпта из кэша префикса DeepSeek (hit) и без него (miss)",
+    ["template", "result"]
+)
+outbound_wait_seconds = Histogram(
+    "bot_outbound_wait_seconds", "Ожидание исходящего запроса в планировщике", ["priority"]
+)
+outbound_total = Counter(
+    "bot_outbound_total", "Исходящие запросы: sent, coalesced (заменены свежей правкой), retry_after",
+    ["outcome"]
+)
+update_queue_size = Gauge("bot_update_queue_size", "Апдейты, ожидающие обработки")
+llm_in_flight = Gauge("llm_in_flight", "Запросы к LLM, выполняющиеся прямо сейчас")
+cache_requests_total = Counter(
+    "cache_requests_total", "Обращения к кэшам: hit/miss", ["cache", "result"]
+)
+
+
+def cache_result(cache: str, hit: bool):
+    """Отмечает попадание или промах кэша"""
+    cache_requests_total.inc(cache, "hit" if hit else "miss")
+
+
+def record_usage(usage, template: str = "other"):
+    """Учитывает токены из response.usage (None - ничего не делает)"""
+    if usage is None:
+        return
+    llm_tokens_total.inc("prompt", amount=usage.prompt_tokens or 0)
+    llm_tokens_total.inc("completion", amount=usage.completion_tokens or 0)
+    # Кэш префикса промпта DeepSeek (если API его сообщает); доля попаданий по шаблону -
+    # hit / (hit + miss) в llm_prompt_cache_tokens_total
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+    if hit is not None:
+        llm_tokens_total.inc("prompt_cache_hit", amount=hit)
+        llm_prompt_cache_tokens_total.inc(template, "hit", amount=hit)
+    if miss is not None:
+        llm_tokens_total.inc("prompt_cache_miss", amount=miss)
+        llm_prompt_cache_tokens_total.inc(template, "miss", amount=miss)
+
+
+def timed(route: Union[str, Callable[[object], str]]):
+    """
+    Декоратор обработчика: гистограмма времени и счётчик результатов по маршруту.
+    route - строка или функция, вычисляющая маршрут по апдейту.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context, *args, **kwargs):
+            name = route(update) if callable(route) else route
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await handler(update, context, *args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                update_seconds.observe(time.perf_counter() - started, name)
+                updates_total.inc(name, outcome)
+        return wrapper
+    return decorator
+
+
+# ============= HTTP =============
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """GET /metrics"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
+
+
+def start_server(port: Optional[int] = None):
+    """Отдельный HTTP-сервер метрик (вызывается из работающего event loop)"""
+    # Читаем при вызове, а не при импорте: у супервизора и каждого воркера свой порт
+    port = port or int(os.getenv('METRICS_PORT') or 0)
+    if not port:
+        return None
+    http_server = tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(port, METRICS_HOST)
+    logger.info(f"Метрики доступны на {METRICS_HOST}:{port}/metrics")
+    return http_server
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Натальная карта без LLM-догадок: положения Солнца, Луны и планет
+по приближённым формулам эфемерид (точность ~1°, для знаков достаточно).
+
+Расчёт векторизован по датам, поэтому целые диапазоны можно посчитать заранее:
+    python natal.py precompute 1930-01-01 2015-12-31
+    python natal.py show 15.03.1990
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import date, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import prompts
+from horoscope import ZODIAC_SIGNS
+
+logger = logging.getLogger(__name__)
+
+NATAL_DB_PATH = os.getenv('NATAL_DB_PATH', 'natal.db')
+MIN_YEAR = 1900
+
+BODIES = ["Солнце", "Луна", "Меркурий", "Венера", "Марс", "Юпитер", "Сатурн"]
+# Знаки в предложном падеже: «Солнце в Рыбах»
+SIGNS_PREPOSITIONAL = [
+    "Овне", "Тельце", "Близнецах", "Раке", "Льве", "Деве",
+    "Весах", "Скорпионе", "Стрельце", "Козероге", "Водолее", "Рыбах"
+]
+ELEMENTS = ["Огонь", "Земля", "Воздух", "Вода"]
+
+MONTHS = {
+    "янв": 1, "фев": 2, "мар": 3, "апр": 4, "мая": 5, "май": 5, "июн": 6,
+    "июл": 7, "авг": 8, "сен": 9, "окт": 10, "ноя": 11, "дек": 12,
+}
+
+# ============= РАЗБОР ДАТЫ =============
+
+def parse_date(text: str, today: Optional[date] = None) -> Optional[date]:
+    """
+    Дата рождения из текста пользователя: 15.03.1990, 15/3/90, 1990-03-15,
+    «15 марта 1990». None, если дату разобрать не удалось или она невозможна.
+    """
+    today = today or date.today()
+    text = text.strip().lower()
+
+    match = re.fullmatch(r"(\d{4})[-./](\d{1,2})[-./](\d{1,2})", text)
+    if match:
+        year, month, day = (int(g) for g in match.groups())
+    else:
+        match = (
+            re.fullmatch(r"(\d{1,2})[-./ ](\d{1,2})[-./ ](\d{2}|\d{4})", text)
+            or re.fullmatch(r"(\d{1,2})\s+([а-яё]+)\.?\s+(\d{2}|\d{4})(?:\s*г\.?(?:ода)?)?", text)
+        )
+        if not match:
+            return None
+        day, month, year = match.groups()
+        if month.isdigit():
+            month = int(month)
+        else:
+            month = MONTHS.get(month[:3])
+            if month is None:
+                return None
+        day = int(day)
+        if len(year) == 2:
+            # 90 -> 1990, 05 -> 2005
+            year = 2000 + int(year) if 2000 + int(year) <= today.year else 1900 + int(year)
+        else:
+            year = int(year)
+
+    try:
+        result = date(year, month, day)
+    except ValueError:
+        return None
+    if result.year < MIN_YEAR or result > today:
+        return None
+    return result
+
+
+# ============= ЭФЕМЕРИДЫ =============
+
+# Орбитальные элементы (P. Schlyter, «How to compute planetary positions»):
+# N, i, w, a, e, M как (значение на эпоху, изменение за сутки); углы в градусах
+ORBITS = {
+    "Солнце": ((0.0, 0.0), (0.0, 0.0), (282.9404, 4.70935e-5), (1.0, 0.0),
+               (0.016709, -1.151e-9), (356.0470, 0.9856002585)),
+    "Луна": ((125.1228, -0.0529538083), (5.1454, 0.0), (318.0634, 0.1643573223), (60.2666, 0.0),
+             (0.054900, 0.0), (115.3654, 13.0649929509)),
+    "Меркурий": ((48.3313, 3.24587e-5), (7.0047, 5.00e-8), (29.1241, 1.01444e-5), (0.387098, 0.0),
+                 (0.205635, 5.59e-10), (168.6562, 4.0923344368)),
+    "Венера": ((76.6799, 2.46590e-5), (3.3946, 2.75e-8), (54.8910, 1.38374e-5), (0.723330, 0.0),
+               (0.006773, -1.302e-9), (48.0052, 1.6021302244)),
+    "Марс": ((49.5574, 2.11081e-5), (1.8497, -1.78e-8), (286.5016, 2.92961e-5), (1.523688, 0.0),
+             (0.093405, 2.516e-9), (18.6021, 0.5240207766)),
+    "Юпитер": ((100.4542, 2.76854e-5), (1.3030, -1.557e-7), (273.8777, 1.64505e-5), (5.20256, 0.0),
+               (0.048498, 4.469e-9), (19.8950, 0.0830853001)),
+    "Сатурн": ((113.6634, 2.38980e-5), (2.4886, -1.081e-7), (339.3939, 2.97661e-5), (9.55475, 0.0),
+               (0.055546, -9.499e-9), (316.9670, 0.0334442282)),
+}
+
+# День 0 эпохи формул - 31.12.1999, 0h UT
+EPOCH = date(1999, 12, 31).toordinal()
+
+
+def day_numbers(days: Iterable[date], hour: float = 12.0) -> np.ndarray:
+    """Номера суток от эпохи (по умолчанию - полдень UT: время рождения неизвестно)"""
+    return np.fromiter((d.toordinal() - EPOCH for d in days), dtype=np.float64) + hour / 24.0
+
+
+def _elements(body: str, d: np.ndarray) -> List[np.ndarray]:
+    return [base + rate * d for base, rate in ORBITS[body]]
+
+
+def _orbit(body: str, d: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Гелиоцентрические (для Луны - геоцентрические) эклиптические координаты и M"""
+    N, i, w, a, e, M = _elements(body, d)
+    N, i, w, M_rad = np.radians(N), np.radians(i), np.radians(w), np.radians(M % 360.0)
+
+    # Уравнение Кеплера: несколько итераций Ньютона
+    E = M_rad + e * np.sin(M_rad) * (1.0 + e * np.cos(M_rad))
+    for _ in range(5):
+        E = E - (E - e * np.sin(E) - M_rad) / (1.0 - e * np.cos(E))
+
+    xv = a * (np.cos(E) - e)
+    yv = a * np.sqrt(1.0 - e * e) * np.sin(E)
+    v = np.arctan2(yv, xv)
+    r = np.hypot(xv, yv)
+
+    vw = v + w
+    x = r * (np.cos(N) * np.cos(vw) - np.sin(N) * np.sin(vw) * np.cos(i))
+    y = r * (np.sin(N) * np.cos(vw) + np.cos(N) * np.sin(vw) * np.cos(i))
+    return x, y, r, vw, M_rad
+
+
+def _sind(x):
+    return np.sin(np.radians(x))
+
+
+def _cosd(x):
+    return np.cos(np.radians(x))
+
+
+def _moon_longitude(d: np.ndarray) -> np.ndarray:
+    x, y, _, _, _ = _orbit("Луна", d)
+    lon = np.degrees(np.arctan2(y, x))
+
+    # Главные возмущения долготы Луны
+    Ms = ORBITS["Солнце"][5][0] + ORBITS["Солнце"][5][1] * d
+    ws = ORBITS["Солнце"][2][0] + ORBITS["Солнце"][2][1] * d
+    Nm, _, wm, _, _, Mm = _elements("Луна", d)
+    Ls = Ms + ws
+    Lm = Mm + wm + Nm
+    D = Lm - Ls
+    F = Lm - Nm
+    lon += (
+        -1.274 * _sind(Mm - 2 * D) + 0.658 * _sind(2 * D) - 0.186 * _sind(Ms)
+        - 0.059 * _sind(2 * Mm - 2 * D) - 0.057 * _sind(Mm - 2 * D + Ms)
+        + 0.053 * _sind(Mm + 2 * D) + 0.046 * _sind(2 * D - Ms) + 0.041 * _sind(Mm - Ms)
+        - 0.035 * _sind(D) - 0.031 * _sind(Mm + Ms) - 0.015 * _sind(2 * F - 2 * D)
+        + 0.011 * _sind(Mm - 4 * D)
+    )
+    return lon % 360.0
+
+
+def longitudes(d: np.ndarray) -> np.ndarray:
+    """
+    Геоцентрические эклиптические долготы (градусы, равноденствие даты)
+    для всех BODIES. Форма результата: (len(d), len(BODIES)).
+    """
+    d = np.asarray(d, dtype=np.float64)
+    result = np.empty((d.size, len(BODIES)))
+
+    _, _, rs, lonsun, _ = _orbit("Солнце", d)
+    xs, ys = rs * np.cos(lonsun), rs * np.sin(lonsun)
+    result[:, 0] = np.degrees(lonsun) % 360.0
+    result[:, 1] = _moon_longitude(d)
+
+    Mj = ORBITS["Юпитер"][5][0] + ORBITS["Юпитер"][5][1] * d
+    Msat = ORBITS["Сатурн"][5][0] + ORBITS["Сатурн"][5][1] * d
+
+    for column, body in enumerate(BODIES[2:], start=2):
+        x, y, _, _, _ = _orbit(body, d)
+        lon = np.degrees(np.arctan2(y + ys, x + xs))
+        # Взаимные возмущения Юпитера и Сатурна (до ~1°)
+        if body == "Юпитер":
+            lon += (
+                -0.332 * _sind(2 * Mj - 5 * Msat - 67.6) - 0.056 * _sind(2 * Mj - 2 * Msat + 21)
+                + 0.042 * _sind(3 * Mj - 5 * Msat + 21) - 0.036 * _sind(Mj - 2 * Msat)
+                + 0.022 * _cosd(Mj - Msat) + 0.023 * _sind(2 * Mj - 3 * Msat + 52)
+                - 0.016 * _sind(Mj - 5 * Msat - 69)
+            )
+        elif body == "Сатурн":
+            lon += (
+                0.812 * _sind(2 * Mj - 5 * Msat - 67.6) - 0.229 * _cosd(2 * Mj - 4 * Msat - 2)
+                + 0.119 * _sind(Mj - 2 * Msat - 3) + 0.046 * _sind(2 * Mj - 6 * Msat - 69)
+                + 0.014 * _sind(Mj - 3 * Msat + 32)
+            )
+        result[:, column] = lon % 360.0
+    return result
+
+
+def compute(days: List[date]) -> List[dict]:
+    """Натальные карты для списка дат (один векторный расчёт на все даты)"""
+    d = day_numbers(days)
+    noon = longitudes(d)
+    # Луна проходит знак за ~2.5 суток: без времени рождения знак может быть любым из двух
+    moon_start = _moon_longitude(d - 0.5)
+    moon_end = _moon_longitude(d + 0.5)
+
+    signs = (noon // 30).astype(int)
+    moon_signs = np.stack([moon_start // 30, moon_end // 30], axis=1).astype(int)
+    # Число светил в каждой стихии (Овен - огонь, Телец - земля, Близнецы - воздух, Рак - вода, ...)
+    elements = np.stack([(signs % 4 == i).sum(axis=1) for i in range(4)], axis=1)
+    noon = noon.round(1)
+
+    charts = []
+    for k, day in enumerate(days):
+        first, last = moon_signs[k].tolist()
+        charts.append({
+            "date": day.isoformat(),
+            "positions": {
+                body: [lon, sign] for body, lon, sign in zip(BODIES, noon[k].tolist(), signs[k].tolist())
+            },
+            "moon_signs": [first] if first == last else [first, last],
+            "elements": elements[k].tolist(),
+        })
+    return charts
+
+
+# ============= ОПИСАНИЕ ДЛЯ ПОЛЬЗОВАТЕЛЯ И LLM =============
+
+def _position(body: str, chart: dict) -> str:
+    if body == "Луна" and len(chart["moon_signs"]) > 1:
+        first, second = chart["moon_signs"]
+        return f"Луна в {SIGNS_PREPOSITIONAL[first]} или {SIGNS_PREPOSITIONAL[second]} (зависит от времени рождения)"
+    lon, sign = chart["positions"][body]
+    return f"{body} в {SIGNS_PREPOSITIONAL[sign]} {lon % 30:.0f}°"
+
+
+def summary(chart: dict) -> str:
+    """Краткое описание карты: положения и преобладающая стихия"""
+    lines = [_position(body, chart) for body in BODIES]
+    elements = chart["elements"]
+    top = max(range(4), key=lambda i: elements[i])
+    lines.append(
+        "Стихии: " + ", ".join(f"{ELEMENTS[i]} {elements[i]}" for i in range(4))
+        + f" (преобладает {ELEMENTS[top]})"
+    )
+    return "\n".join(lines)
+
+
+def sun_sign(chart: dict) -> str:
+    return ZODIAC_SIGNS[chart["positions"]["Солнце"][1]]
+
+
+def prompt(chart: dict) -> Tuple[str, str]:
+    """Запрос и системный промпт: LLM получает только готовые положения"""
+    return prompts.NATAL.render(
+        day=date.fromisoformat(chart['date']).strftime('%d.%m.%Y'), summary=summary(chart)
+    )
+
+
+# ============= ПОСТОЯННЫЙ КЭШ =============
+
+class NatalStore:
+    """Карты и готовые толкования по дате рождения (SQLite WAL, общий для процессов)"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute("CREATE TABLE IF NOT EXISTS charts (day TEXT PRIMARY KEY, chart TEXT NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS readings ("
+            "  day TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL"
+            ")"
+        )
+        self._lock = threading.Lock()
+
+    def get_chart(self, day: date) -> Optional[dict]:
+        with self._lock:
+            row = self.db.execute("SELECT chart FROM charts WHERE day = ?", (day.isoformat(),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_charts(self, charts: List[dict]):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO charts (day, chart) VALUES (?, ?)",
+                    [(c["date"], json.dumps(c, ensure_ascii=False)) for c in charts]
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def get_reading(self, day: date) -> Optional[str]:
+        with self._lock:
+            row = self.db.execute("SELECT text FROM readings WHERE day = ?", (day.isoformat(),)).fetchone()
+        return row[0] if row else None
+
+    def put_reading(self, day: date, text: str):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO readings (day, text, created_at) VALUES (?, ?, ?)",
+                (day.isoformat(), text, time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+_store: Optional[NatalStore] = None
+
+
+def get_store() -> Optional[NatalStore]:
+    """Открывает кэш при первом обращении; без него карты просто считаются заново"""
+    global _store
+    if _store is None:
+        try:
+            _store = NatalStore(NATAL_DB_PATH)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось открыть кэш натальных карт: {e}")
+    return _store
+
+
+def chart(day: date) -> dict:
+    """Натальная карта на дату: из кэша или расчётом с сохранением"""
+    store = get_store()
+    if store is not None:
+        cached = store.get_chart(day)
+        if cached is not None:
+            return cached
+    result = compute([day])[0]
+    if store is not None:
+        store.put_charts([result])
+    return result
+
+
+def precompute(start: date, end: date, batch: int = 20000) -> int:
+    """Считает и сохраняет карты для всех дат диапазона"""
+    store = get_store()
+    total = (end - start).days + 1
+    for offset in range(0, total, batch):
+        days = [start + timedelta(days=i) for i in range(offset, min(total, offset + batch))]
+        store.put_charts(compute(days))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Натальные карты")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("precompute", help="посчитать карты для диапазона дат")
+    p.add_argument("start", type=date.fromisoformat)
+    p.add_argument("end", type=date.fromisoformat)
+    p = sub.add_parser("show", help="показать карту для даты")
+    p.add_argument("date")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.command == "precompute":
+        started = time.monotonic()
+        total = precompute(args.start, args.end)
+        logger.info(f"Посчитано карт: {total} за {time.monotonic() - started:.1f} с ({NATAL_DB_PATH})")
+    else:
+        day = parse_date(args.date)
+        if day is None:
+            raise SystemExit(f"Не удалось разобрать дату: {args.date}")
+        result = compute([day])[0]
+        print(f"{day.strftime('%d.%m.%Y')}, знак Солнца: {sun_sign(result)}")
+        print(summary(result))
+
+
+if __name__ == '__main__':
+    main()
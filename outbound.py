@@ -0,0 +1,300 @@
+"""
+Планировщик исходящих запросов к Bot API: общий лимит бота и лимит на чат,
+склейка устаревших правок, автоматический повтор после RetryAfter и приоритеты.
+
+Подключается к Application как rate limiter, поэтому через него проходят
+все отправки и правки сообщений - обработчикам ничего менять не нужно.
+"""
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from typing import Any, Callable, Coroutine, Dict, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+import tracing
+from admission import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит бота (Telegram: около 30 сообщений в секунду)
+GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+GLOBAL_BURST = float(os.getenv('OUTBOUND_GLOBAL_BURST', '30'))
+# Лимит на чат (Telegram: около одного сообщения в секунду, короткие всплески допустимы)
+CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+# Сколько раз повторять запрос после RetryAfter и какое ожидание ещё приемлемо, секунды
+MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+MAX_RETRY_AFTER = float(os.getenv('OUTBOUND_MAX_RETRY_AFTER', '30'))
+MAX_CHATS = 10000
+
+# Приоритеты (меньше - раньше): итоговые ответы несут клавиатуру, заглушки и прогресс - нет.
+# Рассылки уступают всем ответам пользователям.
+PRIORITY_FINAL = 0
+PRIORITY_PROGRESS = 1
+PRIORITY_BROADCAST = 2
+
+_TEXT_EDIT = "editMessageText"
+
+
+def is_write(endpoint: str) -> bool:
+    """Запрос создаёт или меняет сообщение и попадает под флуд-лимиты"""
+    return endpoint.startswith(("send", "edit", "copy", "forward"))
+
+
+class _Request:
+    """Запрос, ждущий своей очереди на отправку"""
+
+    __slots__ = ("priority", "seq", "chat_id", "key", "enqueued", "released", "result", "superseded_by")
+
+    def __init__(self, priority: int, seq: int, chat_id: Any, key: Optional[tuple],
+                 result: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.key = key
+        self.enqueued = time.monotonic()
+        # True - можно отправлять, False - правку заменила более свежая
+        self.released: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Общий для всех попыток одного вызова: его ждут заменённые правки
+        self.result = result
+        self.superseded_by: Optional["_Request"] = None
+
+
+class SendScheduler(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Очередь исходящих запросов. Диспетчер выпускает самый приоритетный запрос,
+    у чата которого есть токен, если есть токен и в общем ведре.
+    Непоказанная правка сообщения заменяется более свежей правкой того же сообщения.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 max_retries: int = MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        # Пауза после RetryAfter: по чату и для всего бота
+        self._paused: Dict[Any, float] = {}
+        self._global_paused = 0.0
+        self._pending: Dict[int, _Request] = {}
+        self._edits: Dict[tuple, _Request] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for request in self._pending.values():
+            if not request.released.done():
+                request.released.set_result(True)
+        self._pending.clear()
+        self._edits.clear()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    # Ведра
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _chat_delay(self, chat_id: Any, now: float) -> float:
+        """Через сколько секунд чат сможет получить сообщение"""
+        paused = self._paused.get(chat_id, 0.0) - now
+        if chat_id is None:
+            return max(0.0, paused)
+        return max(0.0, paused, self._chat_bucket(chat_id).wait_time())
+
+    def pause(self, chat_id: Any, retry_after: float):
+        """Telegram попросил подождать: чат (или весь бот, если чат неизвестен) молчит retry_after секунд"""
+        until = time.monotonic() + retry_after
+        if chat_id is None:
+            self._global_paused = max(self._global_paused, until)
+        else:
+            self._paused[chat_id] = max(self._paused.get(chat_id, 0.0), until)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # Диспетчер
+
+    async def _dispatch(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = max(self._global_paused - now, self.global_bucket.wait_time())
+
+            chosen = None
+            if wait <= 0:
+                wait = float("inf")
+                for request in self._pending.values():
+                    delay = self._chat_delay(request.chat_id, now)
+                    if delay > 0:
+                        wait = min(wait, delay)
+                    elif chosen is None or (request.priority, request.seq) < (chosen.priority, chosen.seq):
+                        chosen = request
+
+            if chosen is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait if wait != float("inf") else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.global_bucket.consume()
+            if chosen.chat_id is not None:
+                self._chat_bucket(chosen.chat_id).consume()
+            self._remove(chosen)
+            metrics.outbound_wait_seconds.observe(now - chosen.enqueued, _priority_name(chosen.priority))
+            chosen.released.set_result(True)
+
+            if len(self._paused) > MAX_CHATS:
+                for key in [k for k, t in self._paused.items() if t < now]:
+                    del self._paused[key]
+
+    def _remove(self, request: _Request):
+        self._pending.pop(request.seq, None)
+        if request.key is not None and self._edits.get(request.key) is request:
+            del self._edits[request.key]
+
+    def _enqueue(self, priority: int, chat_id: Any, key: Optional[tuple],
+                 result: asyncio.Future) -> _Request:
+        request = _Request(priority, next(self._seq), chat_id, key, result)
+        if key is not None:
+            older = self._edits.get(key)
+            if older is not None and priority <= older.priority:
+                # Старая правка ещё не показана - показывать её уже незачем
+                self._remove(older)
+                older.superseded_by = request
+                older.released.set_result(False)
+                metrics.outbound_total.inc("coalesced")
+            self._edits[key] = request
+        self._pending[request.seq] = request
+        self._wakeup.set()
+        return request
+
+    async def _wait_turn(self, request: _Request) -> bool:
+        try:
+            return await request.released
+        except asyncio.CancelledError:
+            self._remove(request)
+            raise
+
+    # BaseRateLimiter
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], list]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], list]:
+        # Спан включает ожидание своей очереди - это тоже время, которое видит пользователь
+        with tracing.span(f"tg.{endpoint}"):
+            return await self._request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+    async def _request(self, callback, args, kwargs, endpoint: str, data: Dict[str, Any],
+                       rate_limit_args: Optional[Dict[str, Any]]):
+        if not is_write(endpoint) or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+
+        chat_id = data.get("chat_id")
+        priority = (rate_limit_args or {}).get(
+            "priority", PRIORITY_FINAL if data.get("reply_markup") else PRIORITY_PROGRESS
+        )
+        key = None
+        if endpoint == _TEXT_EDIT and data.get("message_id") is not None:
+            key = (chat_id, data["message_id"])
+
+        result = asyncio.get_running_loop().create_future()
+        # Результат может никому не понадобиться - не ругаемся на «never retrieved»
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            return await self._process(callback, args, kwargs, endpoint, chat_id, priority, key, result)
+        finally:
+            if not result.done():
+                result.cancel()
+
+    async def _process(self, callback, args, kwargs, endpoint: str, chat_id: Any,
+                       priority: int, key: Optional[tuple], result: asyncio.Future):
+        for attempt in range(self.max_retries + 1):
+            request = self._enqueue(priority, chat_id, key, result)
+            if not await self._wait_turn(request):
+                return await self._follow(request)
+            try:
+                response = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after.total_seconds()
+                                    if hasattr(e.retry_after, "total_seconds") else e.retry_after)
+                self.pause(chat_id, retry_after)
+                metrics.outbound_total.inc("retry_after")
+                # Промежуточную правку не повторяем: её заменит следующая
+                if (key is not None and priority == PRIORITY_PROGRESS) or \
+                        attempt == self.max_retries or retry_after > MAX_RETRY_AFTER:
+                    result.set_exception(e)
+                    raise
+                logger.warning(f"Флуд-лимит в чате {chat_id}: повтор {endpoint} через {retry_after:.0f} с")
+                continue
+            except Exception as e:
+                result.set_exception(e)
+                raise
+            metrics.outbound_total.inc("sent")
+            result.set_result(response)
+            return response
+
+    async def _follow(self, request: _Request):
+        """Результат правки, которая заменила эту"""
+        replacement = request.superseded_by
+        try:
+            result = await asyncio.shield(replacement.result)
+        except Exception as e:
+            request.result.set_exception(e)
+            raise
+        request.result.set_result(result)
+        return result
+
+
+def _priority_name(priority: int) -> str:
+    return {PRIORITY_FINAL: "final", PRIORITY_PROGRESS: "progress"}.get(priority, "broadcast")
+
+
+scheduler: Optional[SendScheduler] = None
+
+metrics.Gauge("outbound_pending", "Запросы к Bot API, ждущие отправки",
+              func=lambda: scheduler.pending if scheduler else 0)
+
+
+def create_scheduler() -> SendScheduler:
+    """Планировщик процесса (диспетчер запускается при инициализации бота)"""
+    global scheduler
+    scheduler = SendScheduler()
+    return scheduler
@@ -0,0 +1,170 @@
+"""
+Обработка фото ладони: выбор размера, уменьшение вне event loop
+и кэш толкований по перцептивному хэшу
+"""
+import io
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Sequence, Tuple
+
+from telegram import PhotoSize
+
+import metrics
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Достаточная для толкования короткая сторона фото и предел длинной стороны
+MIN_SIDE = int(os.getenv('PALM_MIN_SIDE', '480'))
+MAX_SIDE = int(os.getenv('PALM_MAX_SIDE', '768'))
+JPEG_QUALITY = int(os.getenv('PALM_JPEG_QUALITY', '80'))
+CACHE_SIZE = int(os.getenv('PALM_CACHE_SIZE', '2048'))
+# Фото, хэши которых отличаются не больше чем на столько бит, считаем одинаковыми
+HASH_DISTANCE = int(os.getenv('PALM_HASH_DISTANCE', '4'))
+# Декодирование JPEG и ресайз в Pillow отпускают GIL, поэтому хватает потоков
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PALM_WORKERS', '2')), thread_name_prefix="palm"
+)
+
+
+def choose_photo(sizes: Sequence[PhotoSize], min_side: int = MIN_SIDE) -> PhotoSize:
+    """Самый маленький из вариантов фото, у которого короткая сторона не меньше min_side"""
+    adequate = [p for p in sizes if min(p.width, p.height) >= min_side]
+    if adequate:
+        return min(adequate, key=lambda p: p.width * p.height)
+    return max(sizes, key=lambda p: p.width * p.height)
+
+
+def dhash(image: "Image.Image") -> int:
+    """64-битный разностный хэш: устойчив к пересжатию и небольшому ресайзу"""
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            value = (value << 1) | (left > pixels[row * 9 + col + 1])
+    return value
+
+
+def process(data: bytes, max_side: int = MAX_SIDE) -> Tuple[bytes, int]:
+    """
+    Декодирует фото, поворачивает по EXIF, уменьшает и пережимает в JPEG.
+    Возвращает компактный JPEG и перцептивный хэш. Выполняется в пуле потоков.
+    """
+    # Pillow импортируется при первом фото (или при прогреве после запуска), не при старте
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    # Для JPEG декодер сразу уменьшает в 2/4/8 раз - это дешевле полного декодирования
+    image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), dhash(image)
+
+
+async def prepare(data: bytes) -> Tuple[bytes, int]:
+    """process() вне event loop"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, process, data)
+
+
+class ReadingCache:
+    """
+    LRU-кэш толкований по перцептивному хэшу фото.
+    Дополнительно помнит file_unique_id, чтобы повторно присланное фото
+    не приходилось даже скачивать.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE, distance: int = HASH_DISTANCE):
+        self.size = size
+        self.distance = distance
+        self._readings: "OrderedDict[int, str]" = OrderedDict()
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+
+    def find(self, phash: int) -> Optional[int]:
+        """Хэш из кэша, совпадающий с phash с точностью до distance бит"""
+        if phash in self._readings:
+            return phash
+        if self.distance:
+            for known in self._readings:
+                if (known ^ phash).bit_count() <= self.distance:
+                    return known
+        return None
+
+    def get(self, phash: int) -> Optional[str]:
+        key = self.find(phash)
+        if key is None:
+            return None
+        self._readings.move_to_end(key)
+        return self._readings[key]
+
+    def get_file(self, file_unique_id: str) -> Optional[str]:
+        phash = self._files.get(file_unique_id)
+        if phash is None or phash not in self._readings:
+            return None
+        self._files.move_to_end(file_unique_id)
+        self._readings.move_to_end(phash)
+        return self._readings[phash]
+
+    def remember_file(self, file_unique_id: str, phash: int):
+        self._files[file_unique_id] = phash
+        self._files.move_to_end(file_unique_id)
+        if len(self._files) > self.size:
+            self._files.popitem(last=False)
+
+    def put(self, phash: int, reading: str, file_unique_id: str = None):
+        self._readings[phash] = reading
+        self._readings.move_to_end(phash)
+        if len(self._readings) > self.size:
+            self._readings.popitem(last=False)
+        if file_unique_id:
+            self.remember_file(file_unique_id, phash)
+
+
+cache = ReadingCache()
+
+
+class PalmPhoto:
+    """Подготовленное фото: компактный JPEG, хэш и готовое толкование, если оно есть"""
+
+    def __init__(self, file_unique_id: str, jpeg: Optional[bytes] = None,
+                 phash: Optional[int] = None, reading: Optional[str] = None):
+        self.file_unique_id = file_unique_id
+        self.jpeg = jpeg
+        self.phash = phash
+        self.reading = reading
+
+
+async def load(sizes: Sequence[PhotoSize]) -> PalmPhoto:
+    """
+    Находит толкование в кэше или скачивает подходящий размер фото
+    и готовит его для LLM.
+    """
+    photo = choose_photo(sizes)
+
+    reading = cache.get_file(photo.file_unique_id)
+    if reading is not None:
+        metrics.cache_result("palm", True)
+        return PalmPhoto(photo.file_unique_id, reading=reading)
+
+    file = await photo.get_file()
+    data = await file.download_as_bytearray()
+    jpeg, phash = await prepare(bytes(data))
+    logger.debug(
+        f"Фото ладони {photo.width}x{photo.height}: {len(data)} -> {len(jpeg)} байт, хэш {phash:016x}"
+    )
+
+    reading = cache.get(phash)
+    metrics.cache_result("palm", reading is not None)
+    if reading is not None:
+        cache.remember_file(photo.file_unique_id, cache.find(phash))
+    return PalmPhoto(photo.file_unique_id, jpeg, phash, reading)
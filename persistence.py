@@ -0,0 +1,292 @@
+"""
+Хранилище состояний диалогов (ConversationHandler), общее для нескольких процессов
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')
+# Как часто Application сбрасывает изменения состояний в хранилище, секунды
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '1'))
+# Через сколько секунд бездействия диалог завершается и удаляется
+CONVERSATION_TIMEOUT = float(os.getenv('CONVERSATION_TIMEOUT', '900'))
+
+ConversationKey = Tuple
+
+
+class ConversationStore(ABC):
+    """
+    Интерфейс хранилища состояний диалогов.
+
+    Хранилище на Redis реализуется так же: ключ "conv:<name>:<key>",
+    значение - состояние, TTL вместо evict_idle.
+    """
+
+    @abstractmethod
+    def load(self, name: str) -> Dict[ConversationKey, object]:
+        """Все активные состояния диалога name"""
+
+    @abstractmethod
+    def get(self, name: str, key: ConversationKey) -> Optional[object]:
+        """Состояние одного диалога (None - диалога нет)"""
+
+    @abstractmethod
+    def write_many(self, items: Iterable[Tuple[str, ConversationKey, Optional[object]]]):
+        """Атомарно записывает пачку изменений; None означает удаление"""
+
+    @abstractmethod
+    def evict_idle(self, max_idle: float) -> int:
+        """Удаляет диалоги, не менявшиеся дольше max_idle секунд"""
+
+    def close(self):
+        """Освобождает ресурсы"""
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Хранилище в SQLite (WAL): читать и писать могут несколько процессов"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "  name TEXT NOT NULL,"
+            "  key TEXT NOT NULL,"
+            "  state TEXT NOT NULL,"
+            "  updated_at REAL NOT NULL,"
+            "  PRIMARY KEY (name, key)"
+            ")"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at)"
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(key: ConversationKey) -> str:
+        return json.dumps(list(key))
+
+    @staticmethod
+    def _decode(key: str) -> ConversationKey:
+        return tuple(json.loads(key))
+
+    def load(self, name: str) -> Dict[ConversationKey, object]:
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT key, state FROM conversations WHERE name = ?", (name,)
+            ).fetchall()
+        return {self._decode(key): json.loads(state) for key, state in rows}
+
+    def get(self, name: str, key: ConversationKey) -> Optional[object]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT state FROM conversations WHERE name = ? AND key = ?",
+                (name, self._encode(key))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_many(self, items: Iterable[Tuple[str, ConversationKey, Optional[object]]]):
+        now = time.time()
+        upserts, deletes = [], []
+        for name, key, state in items:
+            if state is None:
+                deletes.append((name, self._encode(key)))
+            else:
+                upserts.append((name, self._encode(key), json.dumps(state), now))
+
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(
+                    "INSERT INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (name, key) DO UPDATE SET "
+                    "state = excluded.state, updated_at = excluded.updated_at",
+                    upserts
+                )
+                self.db.executemany("DELETE FROM conversations WHERE name = ? AND key = ?", deletes)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def evict_idle(self, max_idle: float) -> int:
+        with self._lock:
+            cursor = self.db.execute(
+                "DELETE FROM conversations WHERE updated_at < ?", (time.time() - max_idle,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class StorePersistence(BasePersistence):
+    """
+    Persistence для python-telegram-bot, хранящая только состояния диалогов.
+    Изменения копятся и записываются в хранилище одной транзакцией.
+    """
+
+    def __init__(self, store: ConversationStore, update_interval: float = STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=False, callback_data=False
+            ),
+            update_interval=update_interval
+        )
+        self.store = store
+        self._pending: Dict[Tuple[str, ConversationKey], Optional[object]] = {}
+        self._write_scheduled = False
+
+    async def get_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        return self.store.load(name)
+
+    async def update_conversation(self, name: str, key: ConversationKey,
+                                  new_state: Optional[object]) -> None:
+        self._pending[(name, key)] = new_state
+        if not self._write_scheduled:
+            # Все изменения одного прохода update_persistence уйдут одной транзакцией
+            self._write_scheduled = True
+            asyncio.get_running_loop().call_soon(self._write_pending)
+
+    def _write_pending(self):
+        self._write_scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            self.store.write_many((name, key, state) for (name, key), state in pending.items())
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сохранить состояния диалогов: {e}")
+            # Вернём изменения в очередь, более новые имеют приоритет
+            pending.update(self._pending)
+            self._pending = pending
+
+    async def flush(self) -> None:
+        self._write_pending()
+        self.store.close()
+
+    # Остальные данные бот не хранит
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id) -> None:
+        pass
+
+    async def drop_user_data(self, user_id) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+
+class SharedConversationHandler(ConversationHandler):
+    """
+    ConversationHandler, который перед обработкой апдейта перечитывает состояние
+    из общего хранилища - на случай, если диалог начался в другом процессе.
+    """
+
+    def __init__(self, *args, store: Optional[ConversationStore] = None,
+                 entry_callbacks: Optional[Callable[[str], bool]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.store = store
+        # Кнопки, которыми начинается диалог (других кнопок в диалоге нет)
+        self.entry_callbacks = entry_callbacks
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update):
+            return super().check_update(update)
+        # Чужая кнопка: не читаем состояние из хранилища и не перебираем обработчики
+        if self.entry_callbacks is not None and update.callback_query is not None \
+                and not self.entry_callbacks(update.callback_query.data):
+            return None
+        if self.store is not None:
+            self._refresh(update)
+        return super().check_update(update)
+
+    def _refresh(self, update: Update):
+        try:
+            key = self._get_key(update)
+        except RuntimeError:
+            return
+        conversations = self._conversations
+        # Несохранённые локальные изменения новее, чем в хранилище
+        if key in getattr(conversations, '_write_access_keys', ()):
+            return
+        if not isinstance(conversations.get(key, 0), (int, str)):
+            return
+
+        state = self.store.get(self.name, key)
+        data = getattr(conversations, 'data', conversations)
+        if state is None:
+            data.pop(key, None)
+        else:
+            data[key] = state
+
+
+def create_store() -> Optional[ConversationStore]:
+    """Хранилище по настройке STATE_BACKEND (memory - без сохранения)"""
+    if STATE_BACKEND == 'sqlite':
+        return SQLiteConversationStore(STATE_DB_PATH)
+    if STATE_BACKEND != 'memory':
+        logger.warning(f"Неизвестный STATE_BACKEND={STATE_BACKEND}, состояния хранятся в памяти")
+    return None
+
+
+async def evict_job(context):
+    """Задача JobQueue: удаление брошенных диалогов"""
+    store = context.job.data
+    removed = store.evict_idle(CONVERSATION_TIMEOUT)
+    if removed:
+        logger.info(f"Удалено неактивных диалогов: {removed}")
+
+
+def schedule(application, store: ConversationStore):
+    """Регистрирует периодическую очистку неактивных диалогов"""
+    if application.job_queue is None:
+        return
+    application.job_queue.run_repeating(
+        evict_job, interval=max(60.0, CONVERSATION_TIMEOUT / 4), data=store, name="conversation_evict"
+    )
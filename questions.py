@@ -0,0 +1,249 @@
+"""
+Кэш ответов на похожие вопросы для предсказаний.
+
+Вопрос нормализуется (регистр, пунктуация, стемминг русских слов, служебные слова),
+похожие вопросы находятся через MinHash с LSH-корзинами и проверяются точным
+коэффициентом Жаккара. Пул ответов ограничен по размеру и времени жизни;
+для одного вопроса копится несколько вариантов ответа, чтобы выдача не повторялась.
+"""
+import os
+import re
+import time
+import random
+import zlib
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Optional, Set, Tuple
+
+import metrics
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Минимальное сходство (Жаккар по основам слов), при котором вопрос считается тем же
+THRESHOLD = float(os.getenv('QUESTION_CACHE_THRESHOLD', '0.8'))
+CACHE_SIZE = int(os.getenv('QUESTION_CACHE_SIZE', '5000'))
+TTL = float(os.getenv('QUESTION_CACHE_TTL', str(24 * 3600)))
+# Сколько разных ответов копить на вопрос и как часто генерировать новый вместо готового
+VARIANTS = int(os.getenv('QUESTION_CACHE_VARIANTS', '3'))
+REFRESH_PROBABILITY = float(os.getenv('QUESTION_CACHE_REFRESH', '0.1'))
+
+# MinHash: BANDS корзин по ROWS значений
+NUM_HASHES = 32
+ROWS = 2
+BANDS = NUM_HASHES // ROWS
+MIN_BAND_HITS = 2
+_PRIME = (1 << 61) - 1
+
+lookup_seconds = metrics.Histogram(
+    "question_cache_lookup_seconds", "Поиск похожего вопроса в кэше предсказаний",
+    buckets=(0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+)
+
+
+# ============= НОРМАЛИЗАЦИЯ =============
+
+# Служебные слова, не меняющие смысл вопроса (отрицания сохраняем)
+STOP_WORDS = frozenset(
+    "а в во вот все всё да же и из к как ко ли мне меня мой моя мое моё мои на ну о об "
+    "от по про с со так то ты у уже это этом этот эта эти этой этому я бы ль скажи "
+    "подскажи пожалуйста интересно".split()
+)
+
+_WORD = re.compile(r"[а-яa-z0-9]+")
+
+# Стеммер Портера для русского языка (Snowball)
+_RV = re.compile(r"^(.*?[аеиоуыэюя])(.*)$")
+_PERFECTIVE_GERUND = re.compile(r"((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$")
+_REFLEXIVE = re.compile(r"(с[яь])$")
+_ADJECTIVE = re.compile(r"(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$")
+_PARTICIPLE = re.compile(r"((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$")
+_VERB = re.compile(
+    r"((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)"
+    r"|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$"
+)
+_NOUN = re.compile(
+    r"(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$"
+)
+_DERIVATIONAL = re.compile(r".*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$")
+_SUPERLATIVE = re.compile(r"(ейше|ейш)$")
+
+
+def stem(word: str) -> str:
+    """Основа русского слова: «выйду», «выйдешь» -> «выйд»"""
+    match = _RV.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+
+    temp = _PERFECTIVE_GERUND.sub('', rv, 1)
+    if temp == rv:
+        rv = _REFLEXIVE.sub('', rv, 1)
+        temp = _ADJECTIVE.sub('', rv, 1)
+        if temp != rv:
+            rv = _PARTICIPLE.sub('', temp, 1)
+        else:
+            temp = _VERB.sub('', rv, 1)
+            rv = _NOUN.sub('', rv, 1) if temp == rv else temp
+    else:
+        rv = temp
+
+    rv = re.sub(r"и$", '', rv, 1)
+    if _DERIVATIONAL.match(rv):
+        rv = re.sub(r"ость?$", '', rv, 1)
+    temp = re.sub(r"ь$", '', rv, 1)
+    if temp == rv:
+        rv = re.sub(r"нн$", 'н', _SUPERLATIVE.sub('', rv, 1), 1)
+    else:
+        rv = temp
+    return prefix + rv
+
+
+def normalize(question: str) -> FrozenSet[str]:
+    """Множество основ значимых слов вопроса"""
+    words = _WORD.findall(question.lower().replace('ё', 'е'))
+    return frozenset(stem(w) for w in words if w not in STOP_WORDS)
+
+
+def stale_key(question: str) -> Optional[str]:
+    """Ключ последнего ответа на вопрос для деградированного режима (порядок слов не важен)"""
+    terms = normalize(question)
+    return "prediction:" + " ".join(sorted(terms)) if terms else None
+
+
+# ============= MINHASH =============
+
+@lru_cache(maxsize=None)
+def _coefficients() -> Tuple["np.ndarray", "np.ndarray"]:
+    """Коэффициенты хэшей (numpy импортируется при первом вопросе, а не при запуске)"""
+    import numpy as np
+
+    rng = np.random.default_rng(20240501)
+    return (rng.integers(1, 1 << 31, NUM_HASHES, dtype=np.uint64),
+            rng.integers(0, 1 << 31, NUM_HASHES, dtype=np.uint64))
+
+
+def minhash(terms: FrozenSet[str]) -> "np.ndarray":
+    """NUM_HASHES минимумов универсальных хэшей по основам"""
+    import numpy as np
+
+    a, b = _coefficients()
+    if not terms:
+        return np.zeros(NUM_HASHES, dtype=np.uint64)
+    x = np.fromiter((zlib.crc32(t.encode()) for t in terms), dtype=np.uint64, count=len(terms))
+    return ((a[:, None] * x[None, :] + b[:, None]) % _PRIME).min(axis=1)
+
+
+def bands(signature: "np.ndarray") -> List[int]:
+    """Ключи LSH-корзин: у похожих множеств хотя бы один совпадает с высокой вероятностью"""
+    return [hash((i, signature[i * ROWS:(i + 1) * ROWS].tobytes())) for i in range(BANDS)]
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+# ============= КЭШ =============
+
+class _Entry:
+    __slots__ = ("terms", "keys", "answers", "expires_at")
+
+    def __init__(self, terms: FrozenSet[str], keys: List[int], expires_at: float):
+        self.terms = terms
+        self.keys = keys
+        self.answers: List[str] = []
+        self.expires_at = expires_at
+
+
+class QuestionCache:
+    """Ограниченный по размеру и времени жизни пул ответов на похожие вопросы"""
+
+    def __init__(self, size: int = CACHE_SIZE, ttl: float = TTL, threshold: float = THRESHOLD,
+                 variants: int = VARIANTS, refresh_probability: float = REFRESH_PROBABILITY):
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.variants = variants
+        self.refresh_probability = refresh_probability
+        self._entries: "OrderedDict[FrozenSet[str], _Entry]" = OrderedDict()
+        self._buckets: Dict[int, Set[FrozenSet[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _find(self, terms: FrozenSet[str], keys: List[int]) -> Optional[_Entry]:
+        entry = self._entries.get(terms)
+        if entry is not None:
+            return entry
+        hits: Dict[FrozenSet[str], int] = {}
+        for key in keys:
+            for candidate in self._buckets.get(key, ()):
+                hits[candidate] = hits.get(candidate, 0) + 1
+        best, best_score = None, self.threshold
+        for candidate, count in hits.items():
+            # При сходстве выше порога совпадает больше одной корзины почти наверняка
+            if count < MIN_BAND_HITS:
+                continue
+            score = jaccard(terms, candidate)
+            if score >= best_score:
+                best, best_score = self._entries[candidate], score
+        return best
+
+    def _remove(self, entry: _Entry):
+        del self._entries[entry.terms]
+        for key in entry.keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry.terms)
+                if not bucket:
+                    del self._buckets[key]
+
+    def _expire(self, now: float):
+        # Записи упорядочены по времени создания - истёкшие в начале
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires_at > now:
+                break
+            self._remove(entry)
+
+    def get(self, question: str) -> Optional[str]:
+        """Готовый ответ на похожий вопрос или None (тогда нужно генерировать)"""
+        started = time.perf_counter()
+        terms = normalize(question)
+        self._expire(time.monotonic())
+        entry = self._find(terms, bands(minhash(terms))) if terms else None
+        lookup_seconds.observe(time.perf_counter() - started)
+
+        answer = None
+        if entry is not None and entry.answers:
+            # Пока вариантов мало, иногда генерируем новый
+            if len(entry.answers) >= self.variants or random.random() >= self.refresh_probability:
+                answer = random.choice(entry.answers)
+        metrics.cache_result("prediction", answer is not None)
+        return answer
+
+    def put(self, question: str, answer: str):
+        terms = normalize(question)
+        if not terms:
+            return
+        keys = bands(minhash(terms))
+        entry = self._find(terms, keys)
+        if entry is None:
+            entry = _Entry(terms, keys, time.monotonic() + self.ttl)
+            self._entries[terms] = entry
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(terms)
+            if len(self._entries) > self.size:
+                self._remove(next(iter(self._entries.values())))
+        if len(entry.answers) < self.variants:
+            entry.answers.append(answer)
+        else:
+            entry.answers[random.randrange(self.variants)] = answer
+
+
+cache = QuestionCache()
@@ -0,0 +1,309 @@
+"""
+Маршрутизация запросов к нескольким OpenAI-совместимым API:
+выбор по здоровью, автоматические выключатели и «хеджирование» медленных запросов.
+
+Если первый запрос не уложился в адаптивный порог (перцентиль задержек этого API),
+параллельно отправляется второй - в другой API. Побеждает первый ответ,
+проигравший отменяется. Доля хеджированных запросов ограничена бюджетом,
+поэтому средняя стоимость почти не растёт.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Sequence
+
+import metrics
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Дополнительные API: JSON-список объектов
+# {"name", "base_url", "model", "api_key_env", "vision_model", "cost"}
+LLM_ENDPOINTS = os.getenv('LLM_ENDPOINTS', '')
+# Хеджировать запрос, который дольше этого перцентиля задержек его API
+HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '95'))
+# Порог, пока статистики ещё нет, и нижняя граница порога, секунды
+HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '4'))
+HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '0.5'))
+# Какая доля запросов может получить второй (хеджирующий) запрос
+HEDGE_BUDGET = float(os.getenv('LLM_HEDGE_BUDGET', '0.1'))
+# Выключатель: после стольких ошибок подряд API выводится из ротации на BREAKER_RESET секунд
+BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.getenv('LLM_BREAKER_RESET', '30'))
+
+LATENCY_WINDOW = 256
+MIN_SAMPLES = 20
+EWMA_ALPHA = 0.2
+
+
+class NoEndpointAvailable(Exception):
+    """Все API выведены из ротации выключателями"""
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """
+    Ошибка говорит о нездоровье API (таймаут, соединение, 429, 5xx), а не о плохом
+    запросе: 400/401/422 повторятся в любом API, и выключатель от них не срабатывает
+    """
+    from openai import APIConnectionError, APIStatusError  # клиенты уже созданы - модуль загружен
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (APIConnectionError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """Автоматический выключатель: closed -> open -> half_open -> closed"""
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def available(self) -> bool:
+        """Можно ли сейчас отправить запрос (без изменения состояния)"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.opened_at + self.reset_timeout
+        return not self.probing
+
+    def acquire(self) -> bool:
+        """Резервирует попытку; в half_open пропускается ровно один пробный запрос"""
+        if self.state == self.OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def release(self):
+        """Попытка отменена, не дав результата"""
+        self.probing = False
+
+    def success(self):
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.probing = False
+
+    def failure(self):
+        self.consecutive += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.consecutive >= self.failures:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class Endpoint:
+    """Один OpenAI-совместимый API со статистикой задержек и выключателем"""
+
+    def __init__(self, name: str, client: "AsyncOpenAI", model: str,
+                 vision_model: Optional[str] = None, cost: float = 1.0):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.vision_model = vision_model
+        self.cost = cost
+        self.breaker = CircuitBreaker()
+        self.latencies: Dict[str, deque] = {}
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+
+    def percentile(self, kind: str, q: float) -> Optional[float]:
+        samples = self.latencies.get(kind)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def hedge_delay(self, kind: str) -> float:
+        """Через сколько секунд без ответа отправлять второй запрос"""
+        value = self.percentile(kind, HEDGE_PERCENTILE)
+        return HEDGE_DEFAULT_DELAY if value is None else max(HEDGE_MIN_DELAY, value)
+
+    def score(self) -> float:
+        """Оценка здоровья: меньше - лучше"""
+        latency = self.latency_ewma if self.latency_ewma is not None else 1.0
+        return latency * (1.0 + 4.0 * self.error_ewma) * self.cost
+
+    def record_success(self, kind: str, latency: float):
+        self.latencies.setdefault(kind, deque(maxlen=LATENCY_WINDOW)).append(latency)
+        self.latency_ewma = latency if self.latency_ewma is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency_ewma
+        )
+        self.error_ewma *= 1 - EWMA_ALPHA
+        self.breaker.success()
+        metrics.llm_endpoint_seconds.observe(latency, self.name, kind)
+        metrics.llm_endpoint_open.set(0, self.name)
+
+    def record_failure(self):
+        self.error_ewma = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_ewma
+        was_open = self.breaker.state == CircuitBreaker.OPEN
+        self.breaker.failure()
+        metrics.llm_endpoint_errors_total.inc(self.name)
+        metrics.llm_endpoint_open.set(1 if self.breaker.state == CircuitBreaker.OPEN else 0, self.name)
+        if self.breaker.state == CircuitBreaker.OPEN and not was_open:
+            logger.warning(f"API {self.name} выведен из ротации на {self.breaker.reset_timeout:.0f} с")
+
+
+class HedgeBudget:
+    """Бюджет хеджирования: каждый запрос добавляет ratio токена, хедж тратит один"""
+
+    def __init__(self, ratio: float = HEDGE_BUDGET, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def take(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class Router:
+    """Выбирает API, хеджирует медленные запросы и переключается при ошибках"""
+
+    def __init__(self, endpoints: Sequence[Endpoint]):
+        self.endpoints = list(endpoints)
+        self.budget = HedgeBudget()
+
+    def ranked(self, vision: bool = False) -> List[Endpoint]:
+        """Доступные API от лучшего к худшему"""
+        candidates = [
+            e for e in self.endpoints
+            if e.breaker.available() and (not vision or e.vision_model)
+        ]
+        return sorted(candidates, key=Endpoint.score)
+
+    async def _attempt(self, endpoint: Endpoint, kind: str, make_call: Callable[[Endpoint], Awaitable]):
+        started = time.perf_counter()
+        try:
+            result = await make_call(endpoint)
+        except asyncio.CancelledError:
+            endpoint.breaker.release()
+            raise
+        except Exception as e:
+            if is_endpoint_failure(e):
+                endpoint.record_failure()
+            else:
+                endpoint.breaker.release()
+            raise
+        endpoint.record_success(kind, time.perf_counter() - started)
+        return result
+
+    async def call(self, kind: str, make_call: Callable[[Endpoint], Awaitable],
+                   discard: Optional[Callable[[object], Awaitable]] = None, vision: bool = False):
+        """
+        Выполняет make_call(endpoint) в лучшем API; если он медлит дольше порога
+        или падает - параллельно во втором. discard освобождает результат проигравшего.
+        """
+        self.budget.deposit()
+        candidates = [e for e in self.ranked(vision) if e.breaker.acquire()]
+        if not candidates:
+            raise NoEndpointAvailable("все API недоступны")
+
+        primary, backups = candidates[0], candidates[1:]
+        for endpoint in backups[1:]:
+            endpoint.breaker.release()
+        backup = backups[0] if backups else None
+
+        tasks: Dict[asyncio.Task, Endpoint] = {
+            asyncio.ensure_future(self._attempt(primary, kind, make_call)): primary
+        }
+        delay = primary.hedge_delay(kind)
+        last_error: Optional[BaseException] = None
+
+        def launch(reason: str):
+            nonlocal backup
+            tasks[asyncio.ensure_future(self._attempt(backup, kind, make_call))] = backup
+            metrics.llm_hedges_total.inc(reason)
+            backup = None
+
+        try:
+            while tasks:
+                timeout = delay if backup is not None else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Первый запрос медлит: хеджируем, если позволяет бюджет
+                    if self.budget.take():
+                        launch("slow")
+                    else:
+                        backup.breaker.release()
+                        backup = None
+                    continue
+
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    if task.exception() is None:
+                        winner = task.result()
+                        if endpoint is not primary:
+                            logger.info(f"Ответ получен от резервного API {endpoint.name}")
+                        # Одновременно завершившиеся проигравшие
+                        for other in done:
+                            if other is not task and other in tasks and other.exception() is None:
+                                tasks.pop(other)
+                                if discard is not None:
+                                    await discard(other.result())
+                        return winner
+                    last_error = task.exception()
+                    logger.warning(f"API {endpoint.name} не ответил: {last_error}")
+
+                if backup is not None and is_endpoint_failure(last_error):
+                    # Сбой основного API - сразу переключаемся, без бюджета;
+                    # плохой запрос резервный API отклонит так же
+                    launch("failover")
+            raise last_error
+        finally:
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    if discard is not None:
+                        await discard(task.result())
+                else:
+                    task.cancel()
+            if backup is not None:
+                backup.breaker.release()
+
+
+def load_endpoints(http_client: "httpx.AsyncClient") -> List[Endpoint]:
+    """Дополнительные API из LLM_ENDPOINTS (клиенты делят общий пул соединений)"""
+    if not LLM_ENDPOINTS.strip():
+        return []
+    from openai import AsyncOpenAI  # тяжёлый импорт - только когда клиенты действительно нужны
+    try:
+        configs = json.loads(LLM_ENDPOINTS)
+    except ValueError as e:
+        logger.error(f"Некорректный LLM_ENDPOINTS: {e}")
+        return []
+
+    endpoints = []
+    for i, config in enumerate(configs):
+        name = config.get("name") or f"endpoint{i + 1}"
+        client = AsyncOpenAI(
+            api_key=os.getenv(config.get("api_key_env", ""), "") or config.get("api_key"),
+            base_url=config["base_url"],
+            http_client=http_client,
+            max_retries=0
+        )
+        endpoints.append(Endpoint(
+            name, client, config.get("model", "deepseek-chat"),
+            vision_model=config.get("vision_model"), cost=float(config.get("cost", 1.0))
+        ))
+    return endpoints
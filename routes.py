@@ -0,0 +1,143 @@
+"""
+Маршрутизация нажатий на кнопки: callback_data -> обработчик через словарь.
+
+Таблица маршрутов собирается один раз при запуске. Точные маршруты ищутся по
+callback_data целиком, параметризованные ("sub:Овен") - по префиксу до двоеточия;
+остаток передаётся обработчику аргументом. Статичные экраны (меню, подсказки
+перед диалогом) описываются текстом и готовой клавиатурой.
+
+Перед обработчиком выполняются pre-хуки (например, проверка лимитов): хук может
+вернуть текст отказа - он покажется всплывающим уведомлением, а обработчик не
+вызовется. После обработчика выполняются post-хуки (например, метрики времени).
+"""
+import time
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from telegram import CallbackQuery, InlineKeyboardMarkup, Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = ":"
+
+Handler = Callable[..., Awaitable[Optional[object]]]
+# (query, route) -> None или текст отказа
+PreHook = Callable[[CallbackQuery, "Route"], Awaitable[Optional[str]]]
+# (query, route, outcome, seconds)
+PostHook = Callable[[CallbackQuery, "Route", str, float], None]
+
+
+class Route(NamedTuple):
+    """Маршрут: имя для метрик, обработчик или статичный экран и признаки"""
+
+    name: str
+    handler: Optional[Handler] = None
+    text: Optional[str] = None
+    markup: Optional[InlineKeyboardMarkup] = None
+    # Состояние ConversationHandler, которое возвращает маршрут
+    state: Optional[object] = None
+    # Маршрут ставит генерацию в очередь (для проверки лимитов до заглушки)
+    generates: bool = False
+
+
+class CallbackRouter:
+    """Таблица маршрутов кнопок с pre/post-хуками"""
+
+    def __init__(self):
+        self._exact: Dict[str, Route] = {}
+        self._prefixed: Dict[str, Route] = {}
+        self._pre: List[PreHook] = []
+        self._post: List[PostHook] = []
+
+    # Регистрация
+
+    def add(self, data: str, handler: Handler, state: Optional[object] = None,
+            generates: bool = False) -> Route:
+        """Точный маршрут: handler(query, context)"""
+        return self._register(self._exact, data, Route(data, handler, state=state, generates=generates))
+
+    def add_prefix(self, prefix: str, handler: Handler, generates: bool = False) -> Route:
+        """Маршрут с параметром "prefix:значение": handler(query, context, значение)"""
+        return self._register(self._prefixed, prefix, Route(prefix, handler, generates=generates))
+
+    def screen(self, data: str, text: str, markup: Optional[InlineKeyboardMarkup] = None,
+               state: Optional[object] = None) -> Route:
+        """Статичный экран: заменяет сообщение текстом с готовой клавиатурой"""
+        return self._register(self._exact, data, Route(data, text=text, markup=markup, state=state))
+
+    def _register(self, table: Dict[str, Route], key: str, route: Route) -> Route:
+        if key in table:
+            raise ValueError(f"маршрут {key} уже зарегистрирован")
+        table[key] = route
+        return route
+
+    def pre(self, hook: PreHook) -> PreHook:
+        self._pre.append(hook)
+        return hook
+
+    def post(self, hook: PostHook) -> PostHook:
+        self._post.append(hook)
+        return hook
+
+    # Разбор
+
+    def resolve(self, data: Optional[str]) -> Optional[Tuple[Route, Optional[str]]]:
+        """(маршрут, параметр) по callback_data или None"""
+        if not data:
+            return None
+        route = self._exact.get(data)
+        if route is not None:
+            return route, None
+        prefix, separator, value = data.partition(SEPARATOR)
+        route = self._prefixed.get(prefix) if separator else None
+        return (route, value) if route is not None else None
+
+    def matcher(self, *data: str) -> Callable[[object], bool]:
+        """Проверка callback_data для pattern у CallbackQueryHandler (без регулярных выражений)"""
+        for item in data:
+            if item not in self._exact:
+                raise KeyError(f"маршрут {item} не зарегистрирован")
+        return frozenset(data).__contains__
+
+    # Обработка
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик CallbackQueryHandler: возвращает состояние диалога маршрута"""
+        query = update.callback_query
+        resolved = self.resolve(query.data)
+        if resolved is None:
+            logger.warning(f"Неизвестная кнопка: {query.data!r}")
+            await query.answer()
+            return None
+        route, value = resolved
+
+        for hook in self._pre:
+            refusal = await hook(query, route)
+            if refusal:
+                await query.answer(refusal, show_alert=True)
+                self._finish(query, route, "rejected", 0.0)
+                return None
+        await query.answer()
+
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            if route.handler is None:
+                await query.edit_message_text(route.text, reply_markup=route.markup)
+                result = route.state
+            elif value is None:
+                result = await route.handler(query, context)
+            else:
+                result = await route.handler(query, context, value)
+            outcome = "ok"
+        finally:
+            self._finish(query, route, outcome, time.perf_counter() - started)
+        return route.state if route.state is not None else result
+
+    def _finish(self, query: CallbackQuery, route: Route, outcome: str, seconds: float):
+        for hook in self._post:
+            try:
+                hook(query, route, outcome, seconds)
+            except Exception as e:
+                logger.error(f"Ошибка post-хука маршрута {route.name}: {e}")
@@ -0,0 +1,147 @@
+"""
+Режим webhook: встроенный HTTP-сервер для приёма апдейтов и health-check
+"""
+import os
+import json
+import signal
+import asyncio
+import logging
+import secrets
+from typing import Callable
+
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Секрет, который Telegram присылает в заголовке каждого запроса
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+
+def webhook_url() -> str:
+    """Публичный адрес webhook: WEBHOOK_URL или домен Railway"""
+    url = os.getenv('WEBHOOK_URL')
+    if not url and os.getenv('RAILWAY_PUBLIC_DOMAIN'):
+        url = f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}"
+    if not url:
+        raise ValueError("Для режима webhook нужен WEBHOOK_URL (или RAILWAY_PUBLIC_DOMAIN)!")
+    return url.rstrip('/') + WEBHOOK_PATH
+
+
+class TelegramHandler(tornado.web.RequestHandler):
+    """Принимает апдейты от Telegram и передаёт их на обработку"""
+
+    def initialize(self, dispatch: Callable[[dict], None]):
+        self.dispatch = dispatch
+
+    def post(self):
+        if self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        # Отвечаем сразу: обработка идёт параллельно
+        self.dispatch(data)
+        self.set_status(200)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """Liveness: процесс жив и принимает соединения"""
+
+    def get(self):
+        self.write({"status": "ok"})
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """Readiness: приложение запущено и webhook зарегистрирован"""
+
+    def initialize(self, readiness: Callable[[], dict]):
+        self.readiness = readiness
+
+    def get(self):
+        info = self.readiness()
+        self.set_status(200 if info["ready"] else 503)
+        self.write(info)
+
+
+def make_app(dispatch: Callable[[dict], None], readiness: Callable[[], dict]) -> tornado.web.Application:
+    """
+    Маршруты встроенного сервера. Он открыт в интернет, поэтому метрик здесь нет:
+    их отдаёт отдельный сервер на METRICS_PORT.
+    """
+    return tornado.web.Application([
+        (WEBHOOK_PATH, TelegramHandler, {"dispatch": dispatch}),
+        (r"/health", HealthHandler),
+        (r"/ready", ReadyHandler, {"readiness": readiness}),
+    ])
+
+
+async def set_webhook(bot):
+    """Регистрирует webhook в Telegram"""
+    url = webhook_url()
+    await bot.set_webhook(
+        url=url,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=100
+    )
+    logger.info(f"Webhook установлен: {url}")
+
+
+def stop_event() -> asyncio.Event:
+    """Событие, которое срабатывает по SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def serve(application: Application):
+    """Запускает приложение в режиме webhook до получения сигнала остановки"""
+    stop = stop_event()
+    state = {"webhook_set": False}
+
+    def dispatch(data: dict):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    def readiness() -> dict:
+        return {
+            "ready": application.running and state["webhook_set"],
+            "update_queue": application.update_queue.qsize(),
+        }
+
+    # Сервер поднимаем первым, чтобы health-check отвечал во время инициализации
+    server = make_app(dispatch, readiness).listen(WEBHOOK_PORT, WEBHOOK_HOST)
+    logger.info(f"HTTP-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        await set_webhook(application.bot)
+        state["webhook_set"] = True
+
+        await stop.wait()
+    finally:
+        server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application: Application):
+    """Синхронная точка входа для main()"""
+    asyncio.run(serve(application))
@@ -0,0 +1,138 @@
+"""
+Холодный старт: от запуска процесса до первого обслуженного апдейта.
+
+Тяжёлые зависимости (openai, numpy, Pillow) и модули, которым они нужны целиком
+(natal), не импортируются при запуске: бот сразу начинает принимать апдейты,
+а после запуска они догружаются в фоне (warm_up). Если апдейт придёт раньше,
+чем закончится прогрев, нужный модуль просто импортируется при первом обращении.
+
+Разбор времени запуска по модулям и этапам:
+    python bot.py --profile-startup
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import importlib
+import subprocess
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Отсчёт времени запуска: bot.py импортирует этот модуль раньше остальных
+STARTED = time.perf_counter()
+
+# Что догружается в фоне после запуска, в порядке важности
+DEFERRED = ("openai", "numpy", "PIL.Image", "PIL.ImageOps", "natal")
+
+_stages: List[Tuple[str, float]] = []
+_warmed: Dict[str, float] = {}
+_warm_task: Optional[asyncio.Task] = None
+_served = False
+
+
+def mark(stage: str):
+    """Отметка этапа запуска: секунды от импорта этого модуля"""
+    _stages.append((stage, time.perf_counter() - STARTED))
+
+
+def summary() -> str:
+    return ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in _stages)
+
+
+# ============= ПРОГРЕВ =============
+
+async def warm_up():
+    """Импортирует отложенные модули в потоке и создаёт клиентов API"""
+    started = time.perf_counter()
+    for name in DEFERRED:
+        module_started = time.perf_counter()
+        try:
+            await asyncio.to_thread(importlib.import_module, name)
+        except ImportError as e:
+            logger.warning(f"Прогрев: не удалось импортировать {name}: {e}")
+            continue
+        _warmed[name] = time.perf_counter() - module_started
+
+    import llm  # лёгкий модуль, тяжёлый openai уже импортирован выше
+    module_started = time.perf_counter()
+    try:
+        llm.get_router()
+        _warmed["клиенты API"] = time.perf_counter() - module_started
+    except Exception as e:
+        # Например, не задан DEEPSEEK_API_KEY: прогрев и профиль запуска от ключей не зависят,
+        # а ошибка конфигурации всё равно всплывёт при первом запросе к API
+        logger.warning(f"Прогрев: клиенты API не созданы: {e}")
+
+    mark("прогрев")
+    logger.info(f"Прогрев завершён за {time.perf_counter() - started:.2f} с")
+
+
+def start_warm_up():
+    """Запускает прогрев фоновой задачей (вызывается из post_init)"""
+    global _warm_task
+    if _warm_task is None or _warm_task.done():
+        _warm_task = asyncio.get_running_loop().create_task(warm_up())
+
+
+async def first_update(update: object, context: object):
+    """Обработчик последней группы: отмечает первый обслуженный апдейт"""
+    global _served
+    if _served:
+        return
+    _served = True
+    mark("первый апдейт")
+    logger.info(f"Время запуска: {summary()}")
+
+
+# ============= ПРОФИЛЬ ЗАПУСКА =============
+
+def profile_imports(module: str = "bot") -> Tuple[List[Tuple[str, float]], float]:
+    """
+    Импорт module в отдельном процессе с python -X importtime: модули, которые
+    он импортирует напрямую (со всеми вложенными), и общее время, секунды.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    # Строки "import time: self [us] | cumulative | имя", вложенность - отступом по 2 пробела;
+    # вложенные модули печатаются раньше того, кто их импортировал
+    direct: List[Tuple[str, float]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        name = name.strip()
+        if depth == 0:
+            if name == module:
+                return sorted(direct, key=lambda item: -item[1]), int(cumulative) / 1e6
+            direct = []
+        elif depth == 1:
+            direct.append((name, int(cumulative) / 1e6))
+    raise RuntimeError(f"{module} не найден в выводе -X importtime")
+
+
+def profile(build: Callable[[], object], limit: int = 15):
+    """Печатает разбор запуска: импорт модулей, сборка приложения, прогрев"""
+    pending = [name for name in DEFERRED if name not in sys.modules]
+    build()
+    asyncio.run(warm_up())
+
+    imports, total = profile_imports("bot")
+    print(f"Импорт bot: {total * 1000:.0f} мс, дольше всего (вместе с вложенными):")
+    for name, seconds in imports[:limit]:
+        print(f"  {name:<24}{seconds * 1000:>8.1f} мс")
+
+    print(f"\nОтложено до прогрева: {', '.join(pending) or 'ничего'}")
+    for name, seconds in _warmed.items():
+        print(f"  {name:<24}{seconds * 1000:>8.1f} мс")
+
+    print("\nЭтапы (от начала импорта bot, подключение к Telegram не входит):")
+    previous = 0.0
+    for stage, seconds in _stages:
+        print(f"  {stage:<24}{seconds:>7.2f} с  (+{seconds - previous:.2f})")
+        previous = seconds
@@ -0,0 +1,175 @@
+"""
+Потоковый вывод ответа в Telegram через редактирование сообщения
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+from telegram import Message, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+import llm
+
+logger = logging.getLogger(__name__)
+
+# Как часто обновлять сообщение по мере генерации, секунды
+# (флуд-лимиты Telegram соблюдает планировщик outbound)
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+TEXT_LIMIT = MessageLimit.MAX_TEXT_LENGTH
+CURSOR = " ▌"
+
+
+def close_markdown(text: str) -> str:
+    """
+    Закрывает незавершённые сущности Markdown (legacy) в конце текста,
+    чтобы частично полученный ответ можно было отправить.
+    """
+    open_marker = None
+    i = 0
+    while i < len(text):
+        if text[i] == '\\' and open_marker is None:
+            i += 2
+            continue
+        marker = '```' if text.startswith('```', i) else text[i]
+        if open_marker is None:
+            if marker in ('```', '`', '*', '_'):
+                open_marker = marker
+        elif marker == open_marker:
+            open_marker = None
+        i += len(marker)
+
+    if open_marker is None:
+        return text
+    if open_marker == '```':
+        return text + '\n```'
+    return text.rstrip() + open_marker
+
+
+def split_point(text: str, limit: int) -> int:
+    """Позиция, по которой удобно разрезать текст длиннее лимита"""
+    for sep in ('\n\n', '\n', ' '):
+        pos = text.rfind(sep, 0, limit)
+        if pos > limit // 2:
+            return pos
+    return limit
+
+
+class StreamRenderer:
+    """Постепенно показывает генерируемый текст, редактируя сообщение-заглушку"""
+
+    def __init__(self, message: Message, header: str = "",
+                 reply_markup: Optional[InlineKeyboardMarkup] = None,
+                 parse_mode: Optional[str] = None):
+        self.message = message
+        self.header = header
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.text = header
+        self.offset = 0
+        self.shown = None
+
+    async def _edit(self, text: str, markup: Optional[InlineKeyboardMarkup] = None,
+                    required: bool = False) -> bool:
+        """
+        Редактирует текущее сообщение, при ошибке разметки - без неё.
+        Промежуточные правки при флуд-лимите пропускаются, обязательные - повторяются.
+        """
+        parse_mode = self.parse_mode
+        if parse_mode == 'Markdown':
+            text = close_markdown(text)
+
+        for attempt in range(3):
+            try:
+                await self.message.edit_text(text, reply_markup=markup, parse_mode=parse_mode)
+                return True
+            except RetryAfter as e:
+                if not required:
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    return True
+                if parse_mode is None:
+                    raise
+                logger.warning(f"Не удалось применить разметку: {e}")
+                parse_mode = None
+        return False
+
+    async def _roll_over(self):
+        """Переносит продолжение в новое сообщение, если текст не влезает в лимит"""
+        while len(self.text) - self.offset > TEXT_LIMIT:
+            segment = self.text[self.offset:]
+            cut = split_point(segment, TEXT_LIMIT - len(CURSOR))
+            await self._edit(segment[:cut], required=True)
+            self.offset += cut
+            while self.offset < len(self.text) and self.text[self.offset].isspace():
+                self.offset += 1
+            self.message = await self.message.get_bot().send_message(
+                self.message.chat_id, "…"
+            )
+            self.shown = None
+
+    async def flush(self, final: bool = False):
+        """Отправляет накопленный текст, если он изменился"""
+        await self._roll_over()
+        segment = self.text[self.offset:]
+        if not final:
+            segment += CURSOR
+        if segment == self.shown:
+            return
+        markup = self.reply_markup if final else None
+        if await self._edit(segment, markup=markup, required=final):
+            self.shown = segment
+
+    async def render(self, chunks: AsyncIterator[str]) -> str:
+        """Потребляет поток фрагментов и возвращает итоговый текст ответа"""
+        started = time.monotonic()
+        deadline = 0.0
+        async for chunk in chunks:
+            self.text += chunk
+            now = time.monotonic()
+            if now >= deadline:
+                await self.flush()
+                deadline = time.monotonic() + EDIT_INTERVAL
+
+        await self.flush(final=True)
+        logger.debug(f"Потоковый ответ показан за {time.monotonic() - started:.1f} с")
+        return self.text[len(self.header):]
+
+
+async def with_fallback(chunks: AsyncIterator[str], fallback: Optional[str],
+                        timeout: float) -> AsyncIterator[str]:
+    """
+    Отдаёт поток как есть, но если первый фрагмент не пришёл за timeout
+    или API вернул ошибку - подставляет запасной текст.
+    """
+    if fallback is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    try:
+        first = await asyncio.wait_for(chunks.__anext__(), timeout)
+    except (asyncio.TimeoutError, StopAsyncIteration):
+        logger.warning(f"Нет ответа от API за {timeout:.0f} с, используем запасной текст")
+        yield fallback
+        return
+
+    if first == llm.ERROR_MESSAGE:
+        yield fallback
+        return
+
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+async def stream_reply(message: Message, chunks: AsyncIterator[str], header: str = "",
+                       reply_markup: Optional[InlineKeyboardMarkup] = None,
+                       parse_mode: Optional[str] = None) -> str:
+    """Показывает ответ LLM по мере генерации в сообщении-заглушке"""
+    renderer = StreamRenderer(message, header, reply_markup, parse_mode)
+    return await renderer.render(chunks)
@@ -0,0 +1,337 @@
+"""
+Подписка на ежедневный гороскоп: знак выбирается один раз, бот сам присылает прогноз.
+
+Текст для каждого из 12 знаков генерируется один раз и рассылается всем подписчикам
+пачками через планировщик outbound. Рассылка возобновляемая: подписчик сначала
+«захватывается» на день (с номером воркера-владельца), после отправки помечается
+доставленным. При старте воркер освобождает захваты, оставшиеся от его прерванной
+рассылки, а чужие захваты берутся заново только после истечения аренды LEASE.
+Неудачные отправки и знаки, для которых не получен гороскоп, повторяются через
+RETRY_DELAY секунд (до RETRIES раз за день). Цена этого: получатели пачки, которая
+отправлялась в момент падения, могут получить гороскоп дважды.
+
+Рассылку ведёт один процесс (в многопроцессном режиме - воркер 0), иначе каждый
+воркер сгенерировал бы и разослал её сам.
+"""
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from datetime import date, datetime, time as dtime
+from typing import List, Optional
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+import metrics
+import outbound
+import horoscope
+from horoscope import ZODIAC_SIGNS
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTIONS_DB_PATH = os.getenv('SUBSCRIPTIONS_DB_PATH', 'subscriptions.db')
+# Во сколько рассылать (часовой пояс BOT_TIMEZONE), формат ЧЧ:ММ
+_hour, _minute = os.getenv('SUBSCRIPTIONS_TIME', '09:00').split(':')
+SEND_TIME = dtime(int(_hour), int(_minute), tzinfo=horoscope.TIMEZONE)
+# Сколько подписчиков захватывать за раз
+BATCH_SIZE = int(os.getenv('SUBSCRIPTIONS_BATCH', '50'))
+# Повторы неудачных отправок в тот же день
+RETRIES = int(os.getenv('SUBSCRIPTIONS_RETRIES', '3'))
+RETRY_DELAY = float(os.getenv('SUBSCRIPTIONS_RETRY_DELAY', '600'))
+# Через сколько секунд чужой захват считается брошенным
+LEASE = float(os.getenv('SUBSCRIPTIONS_LEASE', '600'))
+# Ведёт ли этот процесс рассылку (супервизор оставляет её одному воркеру)
+BROADCAST = os.getenv('SUBSCRIPTIONS_BROADCAST', '1') == '1'
+# Владелец захватов: номер воркера (задаёт супервизор), одинаковый после перезапуска
+OWNER = os.getenv('BOT_WORKER', '0')
+
+# Подписчик ещё не получил гороскоп на день и не захвачен живой рассылкой
+_PENDING = "delivered_day < ? AND (claimed_day <> ? OR claimed_at < ?)"
+
+delivered_total = metrics.Counter(
+    "subscriptions_delivered_total", "Рассылка гороскопов: sent, gone (бот заблокирован), failed",
+    ["outcome"]
+)
+
+
+class SubscriptionStore:
+    """Подписчики по знакам (SQLite WAL, общий для процессов)"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        # delivered_day - день последней доставки, claimed_day - день, на который
+        # подписчик захвачен рассылкой (пустая строка - никогда), claimed_by - чьей
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            "  chat_id INTEGER PRIMARY KEY, sign TEXT NOT NULL, created_at REAL NOT NULL,"
+            "  delivered_day TEXT NOT NULL DEFAULT '', claimed_day TEXT NOT NULL DEFAULT '',"
+            "  claimed_at REAL NOT NULL DEFAULT 0, claimed_by TEXT NOT NULL DEFAULT ''"
+            ")"
+        )
+        # Базы, созданные до появления владельца захвата
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(subscriptions)")}
+        if "claimed_by" not in columns:
+            self.db.execute("ALTER TABLE subscriptions ADD COLUMN claimed_by TEXT NOT NULL DEFAULT ''")
+        self.db.execute("CREATE INDEX IF NOT EXISTS subscriptions_sign ON subscriptions (sign, chat_id)")
+        self._lock = threading.Lock()
+
+    def subscribe(self, chat_id: int, sign: str, delivered_day: str = ""):
+        """Подписывает чат; при смене знака день последней доставки сохраняется"""
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO subscriptions (chat_id, sign, created_at, delivered_day) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET sign = excluded.sign",
+                (chat_id, sign, time.time(), delivered_day)
+            )
+
+    def unsubscribe(self, chat_id: int) -> bool:
+        with self._lock:
+            cursor = self.db.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+        return cursor.rowcount > 0
+
+    def get_sign(self, chat_id: int) -> Optional[str]:
+        with self._lock:
+            row = self.db.execute("SELECT sign FROM subscriptions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def count(self) -> int:
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+
+    def has_pending(self, sign: str, day: str) -> bool:
+        with self._lock:
+            row = self.db.execute(
+                f"SELECT 1 FROM subscriptions WHERE sign = ? AND {_PENDING} LIMIT 1",
+                (sign, day, day, time.time() - LEASE)
+            ).fetchone()
+        return row is not None
+
+    def claim(self, sign: str, day: str, after: int, limit: int = BATCH_SIZE,
+              owner: str = OWNER) -> List[int]:
+        """
+        Захватывает следующую пачку неполучивших подписчиков знака (chat_id > after),
+        включая захваты с истёкшей арендой
+        """
+        now = time.time()
+        with self._lock:
+            rows = self.db.execute(
+                "UPDATE subscriptions SET claimed_day = ?, claimed_at = ?, claimed_by = ? WHERE chat_id IN ("
+                "  SELECT chat_id FROM subscriptions"
+                f"  WHERE sign = ? AND chat_id > ? AND {_PENDING}"
+                "  ORDER BY chat_id LIMIT ?"
+                ") RETURNING chat_id",
+                (day, now, owner, sign, after, day, day, now - LEASE, limit)
+            ).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def mark_delivered(self, chat_ids: List[int], day: str):
+        with self._lock:
+            self.db.executemany(
+                "UPDATE subscriptions SET delivered_day = ? WHERE chat_id = ?",
+                [(day, chat_id) for chat_id in chat_ids]
+            )
+
+    def release(self, chat_ids: List[int]):
+        """Возвращает неотправленных: их подхватит повтор рассылки"""
+        with self._lock:
+            self.db.executemany(
+                "UPDATE subscriptions SET claimed_day = '' WHERE chat_id = ?",
+                [(chat_id,) for chat_id in chat_ids]
+            )
+
+    def release_owned(self, owner: str = OWNER) -> int:
+        """
+        Освобождает захваты владельца: вызывается при старте, когда прежний процесс
+        этого воркера уже завершён и его захваты никто не отправит
+        """
+        with self._lock:
+            cursor = self.db.execute(
+                "UPDATE subscriptions SET claimed_day = '' WHERE claimed_by = ? AND delivered_day < claimed_day",
+                (owner,)
+            )
+        return cursor.rowcount
+
+    def remove(self, chat_ids: List[int]):
+        with self._lock:
+            self.db.executemany("DELETE FROM subscriptions WHERE chat_id = ?", [(c,) for c in chat_ids])
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+_store: Optional[SubscriptionStore] = None
+
+
+def get_store() -> SubscriptionStore:
+    global _store
+    if _store is None:
+        _store = SubscriptionStore(SUBSCRIPTIONS_DB_PATH)
+    return _store
+
+
+def sent_today() -> bool:
+    """Сегодняшняя рассылка уже должна была пройти"""
+    return datetime.now(horoscope.TIMEZONE).timetz() >= SEND_TIME
+
+
+def subscribe(chat_id: int, sign: str):
+    # Подписавшийся после рассылки получит прогноз уже завтра
+    get_store().subscribe(chat_id, sign, horoscope.today().isoformat() if sent_today() else "")
+
+
+# ============= КЛАВИАТУРЫ =============
+
+def _signs_keyboard(current: Optional[str]) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(f"✅ {sign}" if sign == current else sign, callback_data=f"sub:{sign}")
+        for sign in ZODIAC_SIGNS
+    ]
+    keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    if current:
+        keyboard.append([InlineKeyboardButton("🔕 Отписаться", callback_data="unsubscribe")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="astrology")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Вариантов всего 13 (без подписки и по знаку) - собираем заранее
+_SIGNS_KEYBOARDS = {current: _signs_keyboard(current) for current in [None] + ZODIAC_SIGNS}
+
+
+def signs_keyboard(current: Optional[str] = None) -> InlineKeyboardMarkup:
+    """Выбор знака для подписки"""
+    return _SIGNS_KEYBOARDS.get(current) or _signs_keyboard(current)
+
+
+DELIVERY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔕 Отписаться", callback_data="unsubscribe"),
+     InlineKeyboardButton("🔮 Меню", callback_data="back_main")]
+])
+
+
+# ============= РАССЫЛКА =============
+
+async def _send(bot: Bot, chat_id: int, text: str) -> str:
+    try:
+        await bot.send_message(
+            chat_id, text, reply_markup=DELIVERY_KEYBOARD,
+            rate_limit_args={"priority": outbound.PRIORITY_BROADCAST}
+        )
+        return "sent"
+    except Forbidden:
+        return "gone"
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            return "gone"
+        logger.warning(f"Не удалось отправить гороскоп в чат {chat_id}: {e}")
+        return "failed"
+    except TelegramError as e:
+        logger.warning(f"Не удалось отправить гороскоп в чат {chat_id}: {e}")
+        return "failed"
+
+
+async def _broadcast_sign(bot: Bot, store: SubscriptionStore, sign: str, day: date) -> dict:
+    key = day.isoformat()
+    counts = {"sent": 0, "gone": 0, "failed": 0, "deferred": 0}
+    if not store.has_pending(sign, key):
+        return counts
+
+    text = await horoscope.daily(sign, day)
+    if not horoscope.is_cacheable(text):
+        logger.error(f"Гороскоп для {sign} не получен, рассылка знака отложена до повтора")
+        counts["deferred"] = 1
+        return counts
+    message = f"⭐ Гороскоп для {sign} на {day.strftime('%d.%m.%Y')}\n\n{text}"
+
+    after = 0
+    while True:
+        batch = store.claim(sign, key, after)
+        if not batch:
+            return counts
+        after = batch[-1]
+        outcomes = await asyncio.gather(*(_send(bot, chat_id, message) for chat_id in batch))
+
+        by_outcome = {"sent": [], "gone": [], "failed": []}
+        for chat_id, outcome in zip(batch, outcomes):
+            by_outcome[outcome].append(chat_id)
+        store.mark_delivered(by_outcome["sent"], key)
+        store.remove(by_outcome["gone"])
+        store.release(by_outcome["failed"])
+        for outcome, chat_ids in by_outcome.items():
+            counts[outcome] += len(chat_ids)
+            if chat_ids:
+                delivered_total.inc(outcome, amount=len(chat_ids))
+
+
+async def broadcast(bot: Bot, day: date = None) -> dict:
+    """
+    Рассылает гороскоп на день всем, кто его ещё не получил.
+    Возвращает число отправленных, отписавшихся, ошибок и отложенных знаков.
+    """
+    day = day or horoscope.today()
+    store = get_store()
+
+    started = time.monotonic()
+    total = {"sent": 0, "gone": 0, "failed": 0, "deferred": 0}
+    for sign in ZODIAC_SIGNS:
+        counts = await _broadcast_sign(bot, store, sign, day)
+        for outcome, value in counts.items():
+            total[outcome] += value
+    if any(total.values()):
+        logger.info(
+            f"Рассылка гороскопов на {day.strftime('%d.%m.%Y')}: отправлено {total['sent']}, "
+            f"отписались {total['gone']}, ошибок {total['failed']}, отложено знаков {total['deferred']} "
+            f"за {time.monotonic() - started:.1f} с"
+        )
+    return total
+
+
+async def _broadcast_with_retry(context, day: date, attempt: int):
+    total = await broadcast(context.bot, day)
+    if not (total["failed"] or total["deferred"]):
+        return
+    if attempt >= RETRIES:
+        logger.error(f"Рассылка на {day.strftime('%d.%m.%Y')}: повторы исчерпаны, "
+                     f"не доставлено {total['failed']}, знаков без гороскопа {total['deferred']}")
+        return
+    context.job_queue.run_once(retry_job, when=RETRY_DELAY, data=(day, attempt + 1),
+                               name="subscriptions_retry")
+
+
+async def broadcast_job(context):
+    """Задача JobQueue для рассылки"""
+    await _broadcast_with_retry(context, horoscope.today(), 0)
+
+
+async def retry_job(context):
+    """Повтор для неудачных отправок (только пока не наступил следующий день)"""
+    day, attempt = context.job.data
+    if day == horoscope.today():
+        await _broadcast_with_retry(context, day, attempt)
+
+
+async def resume_job(context):
+    """При старте доделывает сегодняшнюю рассылку, если её время уже прошло"""
+    if sent_today():
+        await _broadcast_with_retry(context, horoscope.today(), 0)
+
+
+def schedule(application):
+    """Регистрирует ежедневную рассылку и её возобновление при старте"""
+    if not BROADCAST:
+        return
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна, рассылка гороскопов отключена")
+        return
+    # Рассылка этого процесса ещё не началась: все захваты владельца остались от прежнего
+    released = get_store().release_owned()
+    if released:
+        logger.info(f"Рассылка: освобождено захватов прерванной рассылки: {released}")
+    application.job_queue.run_daily(broadcast_job, time=SEND_TIME, name="subscriptions_broadcast")
+    application.job_queue.run_once(resume_job, when=5, name="subscriptions_resume")
@@ -0,0 +1,238 @@
+"""
+Многопроцессный режим: один процесс принимает апдейты, N воркеров их обрабатывают.
+
+Апдейты одного чата всегда попадают в один и тот же воркер (по хэшу chat id),
+поэтому порядок сообщений пользователя сохраняется. Каждый воркер - обычное
+Application со всеми обработчиками и собственным пулом соединений к DeepSeek.
+"""
+import os
+import zlib
+import signal
+import asyncio
+import logging
+import multiprocessing
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, TelegramError
+
+import server
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять, живы ли воркеры, секунды
+MONITOR_INTERVAL = 5.0
+
+
+def route_key(data: dict) -> int:
+    """Ключ маршрутизации апдейта: id чата, иначе id пользователя"""
+    for payload in data.values():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return user['id']
+    return data.get('update_id', 0)
+
+
+def shard(key: int, workers: int) -> int:
+    """Номер воркера для ключа (стабилен между процессами и перезапусками)"""
+    return zlib.crc32(str(key).encode()) % workers
+
+
+# ============= ВОРКЕР =============
+
+def worker_env(index: int, workers: int) -> Dict[str, str]:
+    """
+    Переменные окружения воркера. Задаются до запуска процесса: при spawn воркер
+    заново импортирует bot.py (как __mp_main__), и модули читают настройки
+    из окружения ещё до вызова worker_main.
+    """
+    # Номер воркера: владелец взятых заданий и захватов рассылки, одинаковый после перезапуска
+    env = {'BOT_WORKER': str(index)}
+    # У каждого воркера свои метрики - и свой порт для них
+    if os.getenv('METRICS_PORT'):
+        env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + 1 + index)
+    # ...и своя очередь генераций: после рестарта воркер доделывает свои задачи
+    jobs_path = os.getenv('JOBS_DB_PATH', 'jobs.db')
+    if jobs_path != ':memory:':
+        base, ext = os.path.splitext(jobs_path)
+        env['JOBS_DB_PATH'] = f"{base}-{index}{ext}"
+    # ...и свой файл трасс (ротация одного файла из нескольких процессов небезопасна)
+    trace_path = os.getenv('TRACE_PATH', 'traces.jsonl')
+    if trace_path:
+        base, ext = os.path.splitext(trace_path)
+        env['TRACE_PATH'] = f"{base}-{index}{ext}"
+    # Ежедневную рассылку и прогрев гороскопов ведёт один воркер, иначе каждый сделал бы их сам
+    if index:
+        env['SUBSCRIPTIONS_BROADCAST'] = '0'
+        env['HOROSCOPE_WARMUP'] = '0'
+    # Лимит чата соблюдает один воркер (чаты закреплены), общий лимит бота делится на всех
+    for name, default in (('OUTBOUND_GLOBAL_RATE', '30'), ('OUTBOUND_GLOBAL_BURST', '30')):
+        env[name] = str(float(os.getenv(name, default)) / workers)
+    return env
+
+
+@contextmanager
+def _environ(overrides: Dict[str, str]) -> Iterator[None]:
+    """Временно меняет окружение процесса (его наследует запускаемый воркер)"""
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def worker_main(index: int, workers: int, updates: multiprocessing.Queue, token: str):
+    """Точка входа процесса-воркера (окружение уже задано worker_env)"""
+    # Остановкой управляет супервизор через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import bot
+    application = bot.build_application(token)
+    logger.info(f"Воркер {index} запущен (pid {os.getpid()})")
+    asyncio.run(_run_worker(application, updates))
+
+
+async def _run_worker(application, updates: multiprocessing.Queue):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    try:
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# ============= СУПЕРВИЗОР =============
+
+class Supervisor:
+    """Принимает апдейты и распределяет их по процессам-воркерам"""
+
+    def __init__(self, token: str, workers: int, mode: str):
+        self.token = token
+        self.workers = workers
+        self.mode = mode
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.webhook_set = False
+
+    def start_worker(self, index: int):
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.workers, self.queues[index], self.token),
+            name=f"bot-worker-{index}",
+            daemon=True
+        )
+        with _environ(worker_env(index, self.workers)):
+            process.start()
+        self.processes[index] = process
+
+    def dispatch(self, data: dict):
+        """Отправляет апдейт в воркер, отвечающий за этот чат"""
+        self.queues[shard(route_key(data), self.workers)].put(data)
+
+    def readiness(self) -> dict:
+        alive = sum(1 for p in self.processes if p is not None and p.is_alive())
+        return {
+            "ready": alive == self.workers and (self.mode != "webhook" or self.webhook_set),
+            "workers_alive": alive,
+            "workers": self.workers,
+        }
+
+    async def monitor(self):
+        """Перезапускает упавшие воркеры (их очереди сохраняются)"""
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапуск")
+                    self.start_worker(index)
+
+    async def poll(self, bot: Bot):
+        """Получение апдейтов через long polling"""
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES
+                )
+            except NetworkError as e:
+                logger.warning(f"Ошибка сети при получении апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+            except TelegramError as e:
+                logger.error(f"Ошибка Telegram при получении апдейтов: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                self.dispatch(update.to_dict())
+                offset = update.update_id + 1
+
+    async def run(self):
+        stop = server.stop_event()
+        for index in range(self.workers):
+            self.start_worker(index)
+
+        bot = Bot(self.token)
+        await bot.initialize()
+        tasks = [asyncio.create_task(self.monitor())]
+        http_server = None
+        # Метрики самого супервизора - на METRICS_PORT, у воркеров свои порты
+        metrics_server = metrics.start_server()
+
+        try:
+            if self.mode == "webhook":
+                http_server = server.make_app(self.dispatch, self.readiness).listen(
+                    server.WEBHOOK_PORT, server.WEBHOOK_HOST
+                )
+                await server.set_webhook(bot)
+                self.webhook_set = True
+            else:
+                tasks.append(asyncio.create_task(self.poll(bot)))
+
+            logger.info(f"Супервизор запущен: режим {self.mode}, воркеров {self.workers}")
+            await stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if http_server is not None:
+                http_server.stop()
+            if metrics_server is not None:
+                metrics_server.stop()
+            for updates in self.queues:
+                updates.put(None)
+            for process in self.processes:
+                if process is not None:
+                    await asyncio.to_thread(process.join, 30)
+                    if process.is_alive():
+                        process.terminate()
+            await bot.shutdown()
+
+
+def run(token: str, workers: int, mode: str):
+    """Синхронная точка входа для main()"""
+    asyncio.run(Supervisor(token, workers, mode).run())
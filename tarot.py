@@ -1,36 +1,196 @@
+#!/usr/bin/env python3
 """
-Модуль гадания на картах Таро
+Модуль гадания на картах Таро.
+
+Колода собирается один раз при импорте; карта - это номер в колоде и положение
+(прямая или перевёрнутая). Без seed карты тянет random, с seed (карта дня) -
+лёгкий воспроизводимый генератор.
+
+Замер скорости против прежней реализации:
+    python tarot.py bench
 """
+import os
+import time
 import random
-from typing import List
+import hashlib
+import argparse
+from datetime import date
+from typing import List, NamedTuple, Optional, Sequence, Tuple
 
 # Колода Таро (Старшие и Младшие арканы)
-MAJOR_ARCANA = [
+MAJOR_ARCANA = (
     "Дурак", "Маг", "Верховная Жрица", "Императрица", "Император",
     "Иерофант", "Влюбленные", "Колесница", "Сила", "Отшельник",
     "Колесо Фортуны", "Справедливость", "Повешенный", "Смерть", "Умеренность",
     "Дьявол", "Башня", "Звезда", "Луна", "Солнце", "Суд", "Мир"
-]
+)
 
-SUITS = ["Жезлов", "Кубков", "Мечей", "Пентаклей"]
-RANKS = ["Туз", "Двойка", "Тройка", "Четверка", "Пятерка", "Шестерка",
-         "Седьмая", "Восьмая", "Девятка", "Десятка", "Паж", "Рыцарь", "Королева", "Король"]
+SUITS = ("Жезлов", "Кубков", "Мечей", "Пентаклей")
+RANKS = ("Туз", "Двойка", "Тройка", "Четверка", "Пятерка", "Шестерка",
+         "Седьмая", "Восьмая", "Девятка", "Десятка", "Паж", "Рыцарь", "Королева", "Король")
 
-def get_full_deck() -> List[str]:
-    """Возвращает полную колоду Таро"""
-    deck = MAJOR_ARCANA.copy()
-    for suit in SUITS:
-        for rank in RANKS:
-            deck.append(f"{rank} {suit}")
-    return deck
+DECK: Tuple[str, ...] = MAJOR_ARCANA + tuple(f"{rank} {suit}" for suit in SUITS for rank in RANKS)
+DECK_SIZE = len(DECK)
+CARD_INDEX = {name: i for i, name in enumerate(DECK)}
 
+# Краткие значения для толкований без API (деградированный режим)
+MAJOR_MEANINGS = (
+    "новое начало, спонтанность и доверие к пути", "воля, мастерство и умение воплощать задуманное",
+    "интуиция, тайное знание и внутренний голос", "изобилие, забота и творческая сила",
+    "порядок, власть и ответственность", "традиции, наставничество и духовный поиск",
+    "выбор сердца, союз и гармония ценностей", "движение вперёд, победа и сила воли",
+    "мягкая сила, терпение и смелость", "уединение, поиск истины и мудрость",
+    "поворот судьбы, перемены и удача", "равновесие, честность и последствия поступков",
+    "пауза, новый взгляд и добровольная жертва", "завершение, трансформация и место для нового",
+    "мера, исцеление и соединение противоположностей", "соблазны, привязанности и скрытые цепи",
+    "внезапные перемены, крушение иллюзий и прозрение", "надежда, вдохновение и исцеление",
+    "неясность, иллюзии, сны и страхи", "радость, успех и ясность",
+    "пробуждение, призыв и подведение итогов", "завершённость, целостность и исполнение желаний",
+)
+SUIT_MEANINGS = ("в делах, замыслах и страсти", "в чувствах и отношениях",
+                 "в мыслях, решениях и конфликтах", "в деньгах, работе и здоровье")
+RANK_MEANINGS = ("зарождение новой силы", "выбор и равновесие", "первые плоды и сотрудничество",
+                 "устойчивость и передышка", "испытание и потеря опоры", "восстановление и обмен",
+                 "проверка решимости", "движение и усердие", "почти достигнутая цель",
+                 "завершение цикла", "весть и ученичество", "стремительное действие",
+                 "зрелая забота и понимание", "власть и мастерство")
+MEANINGS: Tuple[str, ...] = MAJOR_MEANINGS + tuple(
+    f"{rank} {suit}" for suit in SUIT_MEANINGS for rank in RANK_MEANINGS
+)
 
-def draw_cards(count: int) -> List[str]:
-    """Вытягивает заданное количество карт"""
-    deck = get_full_deck()
-    return random.sample(deck, count)
+# Вероятность выпадения перевёрнутой карты (0 - только прямые)
+REVERSALS = float(os.getenv('TAROT_REVERSALS', '0.25'))
+
+
+class Card(NamedTuple):
+    """Карта расклада: номер в DECK и положение"""
+
+    index: int
+    reversed: bool = False
+
+    @property
+    def name(self) -> str:
+        return DECK[self.index]
+
+    @property
+    def title(self) -> str:
+        return f"{self.name} (перевёрнутая)" if self.reversed else self.name
+
+    @property
+    def meaning(self) -> str:
+        if self.reversed:
+            return f"{MEANINGS[self.index]} - но эта сила сейчас скрыта или обращена против тебя"
+        return MEANINGS[self.index]
+
+    def __str__(self) -> str:
+        return self.title
+
+
+def seed_for(user_id: int, day: date, spread: str = "tarot_day") -> int:
+    """Детерминированное зерно: один и тот же расклад для пользователя в течение дня"""
+    digest = hashlib.blake2b(f"{user_id}:{day.isoformat()}:{spread}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+# Все 156 карт заранее: вытягивание только выбирает готовые объекты
+_CARDS = (tuple(Card(i) for i in range(DECK_SIZE)), tuple(Card(i, True) for i in range(DECK_SIZE)))
+
+
+_MASK = (1 << 64) - 1
+
+
+class SeededRandom:
+    """
+    Воспроизводимый генератор splitmix64 для раскладов с seed: random.Random(seed)
+    тратит на инициализацию больше, чем занимает весь расклад
+    """
+
+    __slots__ = ("state",)
+
+    def __init__(self, seed: int):
+        self.state = seed & _MASK
+
+    def random(self) -> float:
+        self.state = (self.state + 0x9E3779B97F4A7C15) & _MASK
+        z = self.state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+        return ((z ^ (z >> 31)) >> 11) / (1 << 53)
+
+    def sample(self, population: Sequence[int], k: int) -> List[int]:
+        """k разных элементов: начало перемешивания Фишера-Йетса"""
+        pool = list(population)
+        for i in range(k):
+            j = i + int(self.random() * (len(pool) - i))
+            pool[i], pool[j] = pool[j], pool[i]
+        return pool[:k]
+
+
+def draw(count: int, seed: Optional[int] = None, reversals: float = REVERSALS) -> List[Card]:
+    """Вытягивает count разных карт; с seed результат воспроизводим"""
+    rng = random if seed is None else SeededRandom(seed)
+    if count > 8:
+        indices = rng.sample(range(DECK_SIZE), count)
+    else:
+        # Для пары карт повтор почти не случается - дешевле перевыбрать, чем перемешивать колоду
+        indices = []
+        while len(indices) < count:
+            i = int(rng.random() * DECK_SIZE)
+            if i not in indices:
+                indices.append(i)
+    if not reversals:
+        return [_CARDS[0][i] for i in indices]
+    return [_CARDS[rng.random() < reversals][i] for i in indices]
+
+
+def daily_card(user_id: int, day: date, reversals: float = REVERSALS) -> Card:
+    """Карта дня пользователя: не меняется до конца дня"""
+    return draw(1, seed_for(user_id, day), reversals)[0]
 
 
 def get_card_emoji() -> str:
     """Возвращает случайный эмодзи карты"""
     return random.choice(["🃏", "🎴", "🔮"])
+
+
+# ============= ЗАМЕР =============
+
+def _legacy_draw_cards(count: int) -> List[str]:
+    """Прежняя реализация: колода собиралась заново при каждом вызове"""
+    deck = list(MAJOR_ARCANA)
+    for suit in SUITS:
+        for rank in RANKS:
+            deck.append(f"{rank} {suit}")
+    return random.sample(deck, count)
+
+
+def bench(spreads: int, count: int):
+    def measure(func) -> float:
+        started = time.perf_counter()
+        func()
+        return (time.perf_counter() - started) / spreads * 1e6
+
+    legacy = measure(lambda: [_legacy_draw_cards(count) for _ in range(spreads)])
+    single = measure(lambda: [draw(count) for _ in range(spreads)])
+    seeded = measure(lambda: [draw(count, seed=i) for i in range(spreads)])
+
+    print(f"{spreads} раскладов по {count} карт, мкс на расклад:")
+    for title, value in (("прежний draw_cards", legacy), ("draw", single),
+                         ("draw с seed", seeded)):
+        print(f"  {title:<20}{value:>8.2f}  (x{legacy / value:.1f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Колода Таро")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="замер скорости вытягивания карт")
+    bench_parser.add_argument("--spreads", type=int, default=100000)
+    bench_parser.add_argument("--count", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench(args.spreads, args.count)
+
+
+if __name__ == '__main__':
+    main()
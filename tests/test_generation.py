@@ -0,0 +1,131 @@
+"""
+Очередь генераций: уведомления о месте в очереди не должны затирать готовый ответ,
+а задания, не дождавшиеся слота, завершаются отказом, а не повторяются;
+при старте в очередь возвращаются только свои и брошенные задания
+"""
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+from contextlib import asynccontextmanager
+from unittest import mock
+
+import admission
+import generation
+
+
+class RecoverTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, "jobs.db")
+        # Два воркера с одним файлом очереди
+        self.first = generation.JobStore(path)
+        self.second = generation.JobStore(path)
+        for n in range(3):
+            self.first.push({"n": n}, priority=0)
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        self.dir.cleanup()
+
+    def test_other_workers_running_jobs_are_left_alone(self):
+        running = self.first.claim(owner="0")[0]
+        self.assertEqual(self.second.recover(owner="1"), 0)
+        self.assertFalse(self.second.is_queued(running))
+
+    def test_own_interrupted_jobs_are_requeued(self):
+        running = self.first.claim(owner="0")[0]
+        # Воркер 0 перезапущен
+        self.assertEqual(self.second.recover(owner="0"), 1)
+        self.assertTrue(self.second.is_queued(running))
+
+    def test_expired_lease_is_requeued(self):
+        running = self.first.claim(owner="0")[0]
+        with mock.patch.object(time, "time", return_value=time.time() + generation.LEASE + 1):
+            self.assertEqual(self.second.recover(owner="1"), 1)
+        self.assertTrue(self.second.is_queued(running))
+
+
+class SlowBot:
+    """Бот, у которого первая правка ждёт, пока её не отпустят (как в планировщике отправки)"""
+
+    def __init__(self):
+        self.edits = []
+        self.release = asyncio.Event()
+        self._first = True
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None):
+        if self._first:
+            self._first = False
+            await self.release.wait()
+        self.edits.append((message_id, text))
+
+
+class ReportPositionsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pool = generation.GenerationPool(generation.JobStore(":memory:"), workers=1)
+        self.pool.bot = SlowBot()
+        for message_id in (1, 2):
+            self.pool.store.push({"chat_id": 10, "message_id": message_id}, priority=1)
+
+    async def asyncTearDown(self):
+        self.pool.store.close()
+
+    async def test_finished_job_is_not_overwritten(self):
+        bot = self.pool.bot
+        report = asyncio.create_task(self.pool._show_positions())
+        await asyncio.sleep(0)  # правка места для первого задания застряла в отправке
+
+        # Тем временем воркеры берут оба задания, второе завершается и показывает ответ
+        first = self.pool.store.claim()
+        second = self.pool.store.claim()
+        self.assertEqual(second[3]["message_id"], 2)
+        self.pool.store.delete(second[0])
+        bot.edits.append((2, "ответ"))
+
+        bot.release.set()
+        await report
+
+        self.assertEqual([text for message_id, text in bot.edits if message_id == 2], ["ответ"])
+        self.pool.store.delete(first[0])
+
+    async def test_waiting_jobs_get_positions(self):
+        self.pool.bot.release.set()
+        await self.pool._show_positions()
+        self.assertEqual([message_id for message_id, _ in self.pool.bot.edits], [1, 2])
+        self.assertTrue(self.pool.bot.edits[1][1].endswith("Твоё место в очереди: 2"))
+
+
+
+@asynccontextmanager
+async def overloaded_slot(priority, max_wait):
+    raise admission.Overloaded("waited too long")
+    yield
+
+
+class RejectedJobTest(unittest.IsolatedAsyncioTestCase):
+    async def test_overloaded_job_is_failed_not_requeued(self):
+        pool = generation.GenerationPool(generation.JobStore(":memory:"), workers=1)
+        pool.bot = SlowBot()
+        pool.bot.release.set()
+        pool.store.push({"chat_id": 10, "message_id": 1}, priority=1)
+
+        with mock.patch.object(generation.admission, "slot", overloaded_slot):
+            worker = asyncio.create_task(pool._worker(0))
+            for _ in range(100):
+                if pool.bot.edits:
+                    break
+                await asyncio.sleep(0.01)
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+        self.assertEqual(pool.bot.edits, [(1, admission.Rejected.user_message)])
+        self.assertEqual(pool.store.depth(), 0)
+        self.assertIsNone(pool.store.claim())
+        pool.store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
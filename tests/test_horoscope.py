@@ -0,0 +1,40 @@
+"""
+Кэш гороскопов общий для процессов: записанное одним виден другому
+"""
+import os
+import tempfile
+import unittest
+from datetime import date
+
+import horoscope
+
+DAY = date(2026, 10, 17)
+
+
+class HoroscopeStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, "horoscopes.db")
+        # Два соединения с одним файлом - как у двух воркеров
+        self.first = horoscope.HoroscopeStore(path)
+        self.second = horoscope.HoroscopeStore(path)
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        self.dir.cleanup()
+
+    def test_entries_are_shared_between_stores(self):
+        self.first.put_daily("Овен", "гороскоп", DAY)
+        self.first.put_weekly("неделя", DAY)
+        self.first.put_card_of_day(3, True, "карта", DAY)
+        self.assertEqual(self.second.get_daily("Овен", DAY), "гороскоп")
+        self.assertEqual(self.second.get_weekly(DAY), "неделя")
+        self.assertEqual(self.second.get_card_of_day(3, True, DAY), "карта")
+        self.assertIsNone(self.second.get_card_of_day(3, False, DAY))
+
+    def test_expired_entries_are_not_returned(self):
+        self.first.put(("day", "Овен", DAY), "вчерашний", 0)
+        self.assertIsNone(self.second.get(("day", "Овен", DAY)))
+        self.second.purge()
+        self.assertIsNone(self.first.get(("day", "Овен", DAY)))
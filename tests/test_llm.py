@@ -0,0 +1,52 @@
+"""
+SLO деградированного режима меряет сам API: очередь к семафору не в счёт,
+каждая попытка учитывается отдельно
+"""
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import llm
+import degraded
+from router import NoEndpointAvailable
+
+
+class FakeRouter:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+
+    async def call(self, kind, make_call, discard=None, vision=False):
+        if self.failures:
+            self.failures -= 1
+            raise NoEndpointAvailable("stub")
+        return SimpleNamespace(usage=None)
+
+
+class CompleteSloTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.semaphore = asyncio.Semaphore(1)
+        self.record = mock.Mock()
+        for patcher in (
+            mock.patch.object(llm, "_semaphore", self.semaphore),
+            mock.patch.object(llm, "backoff_delay", lambda attempt: 0),
+            mock.patch.object(degraded, "record", self.record),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_waiting_for_the_semaphore_is_not_counted(self):
+        await self.semaphore.acquire()
+        asyncio.get_running_loop().call_later(0.2, self.semaphore.release)
+        with mock.patch.object(llm, "get_router", lambda: FakeRouter()):
+            await llm._complete_upstream("вопрос", None, None, 0.9, 100)
+        (latency, slo), _ = self.record.call_args
+        self.assertLess(latency, 0.1)
+        self.assertEqual(slo, degraded.COMPLETE_SLO)
+
+    async def test_each_failed_attempt_is_recorded(self):
+        with mock.patch.object(llm, "get_router", lambda: FakeRouter(failures=2)):
+            await llm._complete_upstream("вопрос", None, None, 0.9, 100)
+        calls = [c.args for c in self.record.call_args_list]
+        self.assertEqual(calls[:2], [(None,), (None,)])
+        self.assertEqual(len(calls), 3)
@@ -0,0 +1,42 @@
+"""
+Выключатель API срабатывает от сбоев API, а не от плохих запросов
+"""
+import unittest
+
+import httpx
+import openai
+
+import router
+
+
+def status_error(status: int) -> openai.APIStatusError:
+    response = httpx.Response(status, request=httpx.Request("POST", "http://api.test/v1/chat/completions"))
+    return openai.APIStatusError("stub", response=response, body=None)
+
+
+class BreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.primary = router.Endpoint("primary", None, "model")
+        self.backup = router.Endpoint("backup", None, "model", cost=2.0)
+        self.router = router.Router([self.primary, self.backup])
+        self.called = []
+
+    async def fail_with(self, error: Exception):
+        async def make_call(endpoint):
+            self.called.append(endpoint.name)
+            raise error
+
+        for _ in range(router.BREAKER_FAILURES):
+            with self.assertRaises(type(error)):
+                await self.router.call("complete", make_call)
+
+    async def test_bad_requests_do_not_trip_the_breaker(self):
+        await self.fail_with(status_error(400))
+        self.assertEqual(self.primary.breaker.state, router.CircuitBreaker.CLOSED)
+        # Плохой запрос не уходит в резервный API
+        self.assertNotIn("backup", self.called)
+
+    async def test_server_errors_trip_the_breaker(self):
+        await self.fail_with(status_error(503))
+        self.assertEqual(self.primary.breaker.state, router.CircuitBreaker.OPEN)
+        self.assertIn("backup", self.called)
@@ -0,0 +1,17 @@
+"""
+Публичный сервер webhook не отдаёт внутренние метрики
+"""
+from tornado.testing import AsyncHTTPTestCase
+
+import server
+
+
+class PublicServerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return server.make_app(lambda data: None, lambda: {"ready": True})
+
+    def test_metrics_are_not_public(self):
+        self.assertEqual(self.fetch("/metrics").code, 404)
+
+    def test_health_is_served(self):
+        self.assertEqual(self.fetch("/health").code, 200)
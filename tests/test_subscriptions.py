@@ -0,0 +1,55 @@
+"""
+Возобновляемая рассылка: прерванные захваты и неудачные отправки не теряются
+"""
+import time
+import unittest
+from unittest import mock
+
+import subscriptions
+
+DAY = "2026-10-17"
+
+
+class SubscriptionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = subscriptions.SubscriptionStore(":memory:")
+        for chat_id in (1, 2, 3):
+            self.store.subscribe(chat_id, "Овен")
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_claim_is_exclusive_within_a_run(self):
+        self.assertEqual(self.store.claim("Овен", DAY, 0, limit=2), [1, 2])
+        self.assertEqual(self.store.claim("Овен", DAY, 0), [3])
+        self.assertFalse(self.store.has_pending("Овен", DAY))
+
+    def test_interrupted_claims_are_reclaimed_after_restart(self):
+        self.store.claim("Овен", DAY, 0, limit=2, owner="0")
+        self.store.mark_delivered([1], DAY)
+        # Воркер 0 перезапущен: захват чата 2 остался от прерванной рассылки
+        self.assertEqual(self.store.release_owned("0"), 1)
+        self.assertTrue(self.store.has_pending("Овен", DAY))
+        self.assertEqual(self.store.claim("Овен", DAY, 0), [2, 3])
+
+    def test_live_claims_of_other_workers_are_not_taken(self):
+        self.store.claim("Овен", DAY, 0, limit=2, owner="1")
+        # Воркер 0 перезапущен, воркер 1 ещё отправляет свою пачку
+        self.assertEqual(self.store.release_owned("0"), 0)
+        self.assertEqual(self.store.claim("Овен", DAY, 0, owner="0"), [3])
+        self.assertFalse(self.store.has_pending("Овен", DAY))
+
+    def test_expired_claims_are_reclaimed(self):
+        self.store.claim("Овен", DAY, 0, limit=2, owner="1")
+        with mock.patch.object(time, "time", return_value=time.time() + subscriptions.LEASE + 1):
+            self.assertEqual(self.store.claim("Овен", DAY, 0, owner="0"), [1, 2, 3])
+
+    def test_released_chats_are_claimed_again(self):
+        self.assertEqual(self.store.claim("Овен", DAY, 0), [1, 2, 3])
+        self.store.mark_delivered([1, 3], DAY)
+        self.store.release([2])
+        self.assertEqual(self.store.claim("Овен", DAY, 0), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
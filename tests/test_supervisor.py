@@ -0,0 +1,71 @@
+"""
+Настройки воркера действуют с первого импорта: модули читают окружение при импорте
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import supervisor
+
+
+def report_config(index, workers, updates, token):
+    """Вместо worker_main: сообщает настройки, которые увидели модули воркера"""
+    import tracing
+    import outbound
+    import horoscope
+    import generation
+    import subscriptions
+
+    updates.put({
+        "jobs": generation.JOBS_DB_PATH,
+        "trace": tracing.TRACE_PATH,
+        "broadcast": subscriptions.BROADCAST,
+        "warmup": horoscope.WARMUP_ENABLED,
+        "global_rate": outbound.GLOBAL_RATE,
+        "metrics_port": os.getenv("METRICS_PORT"),
+        "owner": generation.OWNER,
+    })
+
+
+class WorkerEnvTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = {
+            "JOBS_DB_PATH": os.path.join(self.dir.name, "jobs.db"),
+            "TRACE_PATH": os.path.join(self.dir.name, "traces.jsonl"),
+            "OUTBOUND_GLOBAL_RATE": "30",
+            "METRICS_PORT": "9000",
+        }
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def config(self, index: int, workers: int) -> dict:
+        pool = supervisor.Supervisor("123:test", workers, "polling")
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch.object(supervisor, "worker_main", report_config):
+            pool.start_worker(index)
+            # Окружение супервизора после запуска воркера не меняется
+            self.assertEqual(os.environ["JOBS_DB_PATH"], self.env["JOBS_DB_PATH"])
+        try:
+            return pool.queues[index].get(timeout=60)
+        finally:
+            pool.processes[index].join(30)
+
+    def test_spawned_workers_see_their_own_settings(self):
+        first = self.config(0, 2)
+        self.assertEqual(first["jobs"], os.path.join(self.dir.name, "jobs-0.db"))
+        self.assertEqual(first["trace"], os.path.join(self.dir.name, "traces-0.jsonl"))
+        self.assertTrue(first["broadcast"])
+        self.assertTrue(first["warmup"])
+        self.assertEqual(first["global_rate"], 15.0)
+        self.assertEqual(first["metrics_port"], "9001")
+
+        second = self.config(1, 2)
+        self.assertEqual(second["jobs"], os.path.join(self.dir.name, "jobs-1.db"))
+        self.assertEqual(second["trace"], os.path.join(self.dir.name, "traces-1.jsonl"))
+        self.assertFalse(second["broadcast"])
+        self.assertFalse(second["warmup"])
+        self.assertEqual(second["metrics_port"], "9002")
+        self.assertEqual((first["owner"], second["owner"]), ("0", "1"))
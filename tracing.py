@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Трассировка запросов: на что ушло время ответа пользователю.
+
+Каждый апдейт открывает трассу, текущий спан передаётся через contextvars: в неё
+попадают запросы к Telegram (из планировщика отправки), обращения к LLM и
+генерация из очереди (контекст трассы сохраняется в задании). Спаны пишутся
+строками JSON в файл с ротацией; трассируется доля TRACE_SAMPLE апдейтов,
+у остальных трассировка ничего не стоит, кроме проверки контекста.
+
+Сводка по самым долгим трассам и по этапам:
+    python tracing.py summary --top 10
+"""
+import os
+import glob
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Пустой путь выключает трассировку
+TRACE_PATH = os.getenv('TRACE_PATH', 'traces.jsonl')
+# Доля апдейтов, для которых пишется трасса
+TRACE_SAMPLE = float(os.getenv('TRACE_SAMPLE', '0.01'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv('TRACE_BACKUPS', '3'))
+
+
+class Span:
+    """Отрезок работы внутри трассы"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "started_at", "_started")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, attrs: dict):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(32):08x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def end(self, **attrs):
+        """Завершает спан и отдаёт его на запись"""
+        self.attrs.update(attrs)
+        _write({
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": round(self.started_at, 6),
+            "seconds": round(self.elapsed(), 6),
+            "attrs": self.attrs,
+        })
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def context() -> Optional[List[str]]:
+    """[трасса, спан] текущего спана - чтобы продолжить трассу в другой задаче"""
+    span = _current.get()
+    return [span.trace_id, span.span_id] if span is not None else None
+
+
+@contextmanager
+def _activate(span: Span) -> Iterator[Span]:
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        span.end()
+
+
+@contextmanager
+def trace(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """Корень новой трассы (с вероятностью TRACE_SAMPLE, иначе None)"""
+    if not TRACE_PATH or random.random() >= TRACE_SAMPLE:
+        yield None
+        return
+    with _activate(Span(f"{random.getrandbits(64):016x}", None, name, attrs)) as span:
+        yield span
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """Дочерний спан текущего; вне трассы ничего не делает"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    with _activate(Span(parent.trace_id, parent.span_id, name, attrs)) as child:
+        yield child
+
+
+@contextmanager
+def resume(saved: Optional[List[str]], name: str, **attrs) -> Iterator[Optional[Span]]:
+    """Продолжает трассу по context() из другой задачи (например, из очереди генераций)"""
+    if not saved:
+        yield None
+        return
+    trace_id, parent_id = saved
+    with _activate(Span(trace_id, parent_id, name, attrs)) as child:
+        yield child
+
+
+def start(name: str, **attrs) -> Optional[Span]:
+    """
+    Дочерний спан без смены текущего - для асинхронных генераторов, которые
+    нельзя обернуть в with (контекст между yield принадлежит вызывающему).
+    Завершается явным span.end().
+    """
+    parent = _current.get()
+    if parent is None:
+        return None
+    return Span(parent.trace_id, parent.span_id, name, attrs)
+
+
+def stream(name: str, chunks: AsyncIterator[str], **attrs) -> AsyncIterator[str]:
+    """Поток в спане: время до первого фрагмента и до конца; вне трассы - поток как есть"""
+    span = start(name, **attrs)
+    return chunks if span is None else _traced(span, chunks)
+
+
+async def _traced(span: Span, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    count = 0
+    # Получатель может бросить поток, не дочитав (например, ответив запасным текстом)
+    outcome = "abandoned"
+    try:
+        async for chunk in chunks:
+            if not count:
+                span.set(first_chunk=round(span.elapsed(), 3))
+            count += 1
+            yield chunk
+        outcome = "ok"
+    except Exception as e:
+        outcome = "error"
+        span.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        span.end(chunks=count, outcome=outcome)
+
+
+# ============= ЗАПИСЬ =============
+# Спаны кладутся в очередь, а в файл их пишет отдельный поток - event loop не ждёт диск
+
+_records: Optional[logging.Logger] = None
+
+
+def _writer() -> logging.Logger:
+    global _records
+    if _records is None:
+        handler = RotatingFileHandler(TRACE_PATH, maxBytes=TRACE_MAX_BYTES,
+                                      backupCount=TRACE_BACKUPS, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        buffer: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        listener = QueueListener(buffer, handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+        records = logging.getLogger("tracing.spans")
+        records.setLevel(logging.INFO)
+        records.propagate = False
+        records.addHandler(QueueHandler(buffer))
+        _records = records
+    return _records
+
+
+def _write(record: dict):
+    try:
+        _writer().info(json.dumps(record, ensure_ascii=False, default=str))
+    except Exception as e:
+        logger.error(f"Не удалось записать спан {record['name']}: {e}")
+
+
+# ============= ТРАССА НА АПДЕЙТ =============
+
+def describe(update: object) -> dict:
+    """Что за апдейт: для поиска трассы по жалобе пользователя"""
+    if not isinstance(update, Update):
+        return {"kind": type(update).__name__}
+    attrs = {"user": update.effective_user.id if update.effective_user else None}
+    if update.callback_query is not None:
+        attrs.update(kind="button", data=update.callback_query.data)
+    elif update.message is not None and update.message.photo:
+        attrs["kind"] = "photo"
+    elif update.message is not None and (update.message.text or "").startswith("/"):
+        attrs.update(kind="command", data=update.message.text.split()[0])
+    else:
+        attrs["kind"] = "message"
+    return attrs
+
+
+class TracedApplication(Application):
+    """Application, открывающее трассу на каждый апдейт (ApplicationBuilder.application_class)"""
+
+    async def process_update(self, update: object):
+        with trace("update") as root:
+            if root is not None:
+                root.set(**describe(update))
+            await super().process_update(update)
+
+
+# ============= СВОДКА =============
+
+def load(paths: List[str]) -> Dict[str, List[dict]]:
+    """Спаны из файлов, сгруппированные по трассам"""
+    traces: Dict[str, List[dict]] = defaultdict(list)
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                traces[record["trace"]].append(record)
+    return traces
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def duration(spans: List[dict]) -> float:
+    """От начала первого спана до конца последнего (генерация идёт дольше апдейта)"""
+    return max(s["start"] + s["seconds"] for s in spans) - min(s["start"] for s in spans)
+
+
+def summary(traces: Dict[str, List[dict]], top: int = 10):
+    total_spans = sum(len(spans) for spans in traces.values())
+    print(f"Трасс: {len(traces)}, спанов: {total_spans}")
+    if not traces:
+        return
+
+    print("\nСамые долгие трассы:")
+    slowest = sorted(traces.items(), key=lambda item: -duration(item[1]))[:top]
+    for trace_id, spans in slowest:
+        spans.sort(key=lambda s: s["start"])
+        root = next((s for s in spans if s["parent"] is None), spans[0])
+        attrs = " ".join(f"{key}={value}" for key, value in root["attrs"].items() if value is not None)
+        print(f"  {duration(spans):>8.2f} с  {trace_id}  {attrs}")
+        began = spans[0]["start"]
+        for s in spans:
+            extra = " ".join(f"{key}={value}" for key, value in s["attrs"].items())
+            print(f"      +{s['start'] - began:>7.2f}  {s['seconds']:>7.2f} с  {s['name']:<28}{extra}")
+
+    by_name: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    for spans in traces.values():
+        for s in spans:
+            by_name[s["name"]].append(s["seconds"])
+            errors[s["name"]] += "error" in s["attrs"]
+
+    print(f"\n{'этап':<28}{'кол-во':>7}{'ошибки':>8}{'p50, с':>9}{'p95, с':>9}{'p99, с':>9}{'всего, с':>10}")
+    for name, values in sorted(by_name.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:<28}{len(values):>7}{errors[name]:>8}{percentile(values, 50):>9.2f}"
+              f"{percentile(values, 95):>9.2f}{percentile(values, 99):>9.2f}{sum(values):>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Трассы запросов бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary_parser = sub.add_parser("summary", help="самые долгие трассы и время по этапам")
+    summary_parser.add_argument(
+        "paths", nargs="*",
+        help="файлы трасс (по умолчанию TRACE_PATH, его ротации и файлы воркеров)"
+    )
+    summary_parser.add_argument("--top", type=int, default=10, help="сколько самых долгих трасс показать")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        paths = args.paths
+        if not paths:
+            base, ext = os.path.splitext(TRACE_PATH)
+            paths = sorted(set(glob.glob(f"{TRACE_PATH}*") + glob.glob(f"{base}-*{ext}*")))
+        summary(load(paths), args.top)
+
+
+if __name__ == '__main__':
+    main()